@@ -13,65 +13,141 @@ import sys
 import typing
 from math import floor
 
+from instrumentation import instrumentation
 
-def find_boxes(file_stream: typing.BinaryIO, start_offset: int = 0, end_offset: int = sys.maxsize) -> typing.Dict[bytes, typing.Tuple[int, int]]:
-    """Returns a dictionary of all the data boxes and their absolute starting
-    and ending offsets inside the video file.
+
+def find_all_boxes(file_stream: typing.BinaryIO, start_offset: int = 0, end_offset: int = sys.maxsize) -> typing.List[typing.Tuple[bytes, int, int]]:
+    """Returns a list of all the data boxes in file order as (type, start, end),
+    boxes of the same type, e.g. several 'trak's inside 'moov', are all kept.
 
     Specify a start_offset and end_offset to read sub-boxes.
+    Boxes with a 64-bit 'largesize' (size field == 1) and boxes extending to
+    the end of the file (size field == 0) are supported.
     """
     s = struct.Struct("> I 4s")
-    boxes = {}
+    boxes = []
     offset = start_offset
     file_stream.seek(offset, 0)
     while offset < end_offset:
         # read box header
         data = file_stream.read(8)
-        if data == b"":
+        if len(data) < 8:
             # EOF
             break
         length, text = s.unpack(data)
-        file_stream.seek(length - 8, 1)          # skip to next box
-        boxes[text] = (offset, offset + length)
+        if length == 1:
+            # 64-bit largesize follows the box type
+            data = file_stream.read(8)
+            if len(data) < 8:
+                break
+            length = struct.unpack("> Q", data)[0]
+        elif length == 0:
+            # box extends to the end of the enclosing box / file
+            if end_offset == sys.maxsize:
+                length = file_stream.seek(0, 2) - offset
+            else:
+                length = end_offset - offset
+        if length < 8:
+            # corrupt box, stop instead of looping forever
+            break
+        boxes.append((text, offset, offset + length))
         offset += length
+        file_stream.seek(offset, 0)          # skip to next box
     return boxes
 
 
-def parse_highlights(file_stream: typing.BinaryIO, start_offset: int = 0, end_offset: int = sys.maxsize) -> typing.List[float]:
-    inHighlights = False
-    inHLMT = False
+def find_boxes(file_stream: typing.BinaryIO, start_offset: int = 0, end_offset: int = sys.maxsize) -> typing.Dict[bytes, typing.Tuple[int, int]]:
+    """Returns a dictionary of all the data boxes and their absolute starting
+    and ending offsets inside the video file.
 
-    listOfHighlights = []
+    Specify a start_offset and end_offset to read sub-boxes.
+    If a box type occurs more than once the last one is returned,
+    use 'find_all_boxes' to get all of them.
+    """
+    return {text: (start, end) for text, start, end in find_all_boxes(file_stream, start_offset, end_offset)}
 
-    offset = start_offset
-    file_stream.seek(offset, 0)
 
-    while offset < end_offset:
-        # read box header
-        data = file_stream.read(4)
-        if data == b"":  # EOF
+def box_header_size(file_stream: typing.BinaryIO, box: typing.Tuple[int, int]) -> int:
+    """Returns the size of the header of a box found by 'find_boxes',
+    i.e. the offset of its payload relative to the box start."""
+    file_stream.seek(box[0], 0)
+    length = struct.unpack("> I", file_stream.read(4))[0]
+    return 16 if length == 1 else 8
+
+
+def iter_klv(data: bytes, start: int = 0, end: typing.Optional[int] = None) -> typing.Iterator[typing.Tuple[bytes, int, int, int]]:
+    """Walks the GPMF KLV entries in data[start:end] depth first.
+
+    Yields (key, type, payload_start, payload_end) for every entry, nested
+    entries (type 0) are yielded before their children.
+    Each entry is a 4 byte key, a 1 byte type, a 1 byte struct size and a 2 byte
+    repeat count, followed by struct size * repeat bytes padded to 4 bytes.
+    """
+    if end is None:
+        end = len(data)
+    offset = start
+    while offset + 8 <= end:
+        key, klv_type, struct_size, repeat = struct.unpack_from("> 4s B B H", data, offset)
+        payload_start = offset + 8
+        payload_end = payload_start + struct_size * repeat
+        if payload_end > end:
+            # truncated or corrupt entry
             break
+        yield key, klv_type, payload_start, payload_end
+        if klv_type == 0:
+            yield from iter_klv(data, payload_start, payload_end)
+        offset = payload_start + ((struct_size * repeat + 3) & ~3)
+
+
+def parse_highlights(file_stream: typing.BinaryIO, start_offset: int = 0, end_offset: int = sys.maxsize) -> typing.List[float]:
+    """Reads the GPMF payload between start_offset and end_offset with a single
+    bounded read and returns the manual HiLight timestamps in seconds.
+
+    Inside the 'HLMT' container every manual HiLight entry is tagged 'MANL',
+    its timestamp in milliseconds is stored 16 bytes ahead of that tag.
+    """
+    file_stream.seek(start_offset, 0)
+    if end_offset == sys.maxsize:
+        data = file_stream.read()
+    else:
+        data = file_stream.read(max(end_offset - start_offset, 0))
+
+    return parse_highlights_from_bytes(data)
+
+
+def parse_highlights_from_bytes(data: bytes) -> typing.List[float]:
+    inHighlights = False
+    hlmt_start: typing.Optional[int] = None
+    seen_tags: typing.Set[int] = set()
+
+    listOfHighlights = []
 
-        if data == b'High' and inHighlights is False:
-            data = file_stream.read(4)
-            if data == b'ligh':
-                inHighlights = True  # set flag, that highlights were reached
+    for key, _, payload_start, payload_end in iter_klv(data):
+        if inHighlights is False and data.find(b"Highligh", payload_start, payload_end) != -1:
+            inHighlights = True  # set flag, that highlights were reached
 
-        if data == b'HLMT' and inHighlights is True and inHLMT is False:
-            inHLMT = True  # set flag that HLMT was reached
+        if key == b"HLMT" and inHighlights is True and hlmt_start is None:
+            hlmt_start = payload_start  # set flag that HLMT was reached
 
-        if data == b'MANL' and inHighlights is True and inHLMT is True:
+        if hlmt_start is None:
+            continue
 
-            currPos = file_stream.tell()  # remember current pointer/position
-            file_stream.seek(currPos - 20)  # go back to highlight timestamp
+        if key == b"MANL":
+            tag_offset = payload_start - 8
+        elif data[payload_start:payload_start + 4] == b"MANL":
+            tag_offset = payload_start
+        else:
+            continue
 
-            data = file_stream.read(4)  # readout highlight
-            timestamp = int.from_bytes(data, "big")
+        # a container starting with a 'MANL' entry is the same tag as that entry
+        if tag_offset in seen_tags or tag_offset - 16 < hlmt_start:
+            continue
+        seen_tags.add(tag_offset)
 
-            if timestamp != 0:
-                listOfHighlights.append(timestamp / 1000)
+        timestamp = int.from_bytes(data[tag_offset - 16:tag_offset - 12], "big")
 
-            file_stream.seek(currPos)  # go forward again (to the saved position)
+        if timestamp != 0:
+            listOfHighlights.append(timestamp / 1000)
 
     return listOfHighlights
 
@@ -85,11 +161,13 @@ def get_hilights(filename: str) -> typing.List[float]:
         if b"ftyp" not in boxes or boxes[b"ftyp"][0] != 0:
             raise ValueError(f"""ERROR, file "{filename}" is not an mp4-video-file!""")
 
-        moov_boxes = find_boxes(file_stream, boxes[b"moov"][0] + 8, boxes[b"moov"][1])
-        udta_boxes = find_boxes(file_stream, moov_boxes[b"udta"][0] + 8, moov_boxes[b"udta"][1])
+        moov_boxes = find_boxes(file_stream, boxes[b"moov"][0] + box_header_size(file_stream, boxes[b"moov"]), boxes[b"moov"][1])
+        udta_boxes = find_boxes(file_stream, moov_boxes[b"udta"][0] + box_header_size(file_stream, moov_boxes[b"udta"]), moov_boxes[b"udta"][1])
 
         # get GPMF Box
-        return parse_highlights(file_stream, udta_boxes[b'GPMF'][0] + 8, udta_boxes[b'GPMF'][1])
+        gpmf_box = udta_boxes[b'GPMF']
+        instrumentation.record_read(filename, gpmf_box[1] - gpmf_box[0])
+        return parse_highlights(file_stream, gpmf_box[0] + box_header_size(file_stream, gpmf_box), gpmf_box[1])
 
 
 def sec2dtime(secs: float) -> str:
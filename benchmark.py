@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of discovery, probing, HiLight parsing, planning and extraction
+on synthetic recordings written by fixtures.py, at several numbers of chapters.
+
+Timings are compared against a baseline stored by '--save' on the same host, timings of other hosts are no comparison,
+a stage more than '--tolerance' times slower is reported as regression.
+Extraction needs ffmpeg and only runs up to '--extract_max' chapters.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, TypeVar
+
+import GP_Highlight_Extractor
+import probe_cache
+import telemetry
+from executor import run_extractions
+from fixtures import ffmpeg_template, synthetic_template, write_recordings
+from gopro_names import index_recordings, is_video_candidate
+from scan import discover_files, scan_files
+from timeline import plan_recording_extractions
+from video_file_data import VideoFileData
+from video_metadata import registry
+
+T = TypeVar("T")
+
+# next to the probe cache, outside the repository: timings only compare on the host they were measured on
+DEFAULT_BASELINE = os.path.join(os.path.dirname(probe_cache.default_cache_path()), "benchmark_baseline.json")
+
+# shorter stages are mostly noise
+MIN_COMPARED_SECONDS = 0.01
+
+
+def timed(results: Dict[str, float], stage: str, function: Callable[[], T]) -> T:
+    start = time.perf_counter()
+    value = function()
+    results[stage] = time.perf_counter() - start
+    return value
+
+
+def run_scale(chapters: int, args: argparse.Namespace, template: bytes, extract: bool) -> Dict[str, float]:
+    """seconds each stage took for 'chapters' chapters"""
+    results: Dict[str, float] = {}
+    registry.clear()
+
+    with tempfile.TemporaryDirectory() as folder:
+        input_folder = os.path.join(folder, "in")
+        write_recordings(input_folder, chapters, chapters_per_recording=args.chapters_per_recording, hilights_per_chapter=args.hilights_per_chapter, seconds=args.seconds, template=template)
+
+        def discover() -> List[List[str]]:
+            return index_recordings([filename for filename in discover_files([input_folder]) if is_video_candidate(filename)])
+
+        recordings = timed(results, "discover", discover)
+        filenames = [filename for recording in recordings for filename in recording]
+
+        timed(results, "hilights", lambda: [GP_Highlight_Extractor.get_hilights(filename) for filename in filenames])
+        if args.telemetry_events:
+            timed(results, "events", lambda: [telemetry.detect_events(filename) for filename in filenames])
+
+        registry.clear()
+        scanned = timed(results, "probe", lambda: scan_files(filenames, jobs=args.scan_jobs))
+
+        def plan() -> list:
+            extractions = []
+            for recording in recordings:
+                chapters_data: List[VideoFileData] = [data for data in (scanned[filename] for filename in recording) if data is not None]
+                extractions.extend(plan_recording_extractions(chapters_data, os.path.join(folder, "out"), time_before=args.pre_time, time_after=args.post_time))
+            return extractions
+
+        extractions = timed(results, "plan", plan)
+
+        if extract:
+            timed(results, "extract", lambda: run_extractions(extractions, jobs=args.jobs))
+
+    return results
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], tolerance: float) -> List[str]:
+    """descriptions of every stage slower than tolerance times its baseline"""
+    regressions = []
+    for scale, stages in results.items():
+        for stage, seconds in stages.items():
+            base = baseline.get(scale, {}).get(stage)
+            if base is not None and base >= MIN_COMPARED_SECONDS and seconds > base * tolerance:
+                regressions.append(f"{stage} at {scale} chapters: {seconds:.3f}s, baseline {base:.3f}s ({seconds / base:.2f}x)")
+    return regressions
+
+
+def print_results(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]]) -> None:
+    for scale, stages in results.items():
+        for stage, seconds in stages.items():
+            base = baseline.get(scale, {}).get(stage)
+            relative = f"  ({seconds / base:.2f}x baseline)" if base else ""
+            print(f"{scale:>6} chapters  {stage:<9} {seconds:9.3f}s  {seconds / int(scale) * 1e6:12.1f}us/chapter{relative}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="benchmarks on synthetic GoPro recordings")
+    parser.add_argument("-n", "--chapters", metavar="CHAPTERS", type=int, nargs="+", default=[1, 10, 100, 1000, 10000], help="numbers of chapters to benchmark")
+    parser.add_argument("-per_rec", "--chapters_per_recording", metavar="CHAPTERS", type=int, default=10, help="chapters per recording, at most 99")
+    parser.add_argument("-hl", "--hilights_per_chapter", metavar="HILIGHTS", type=float, default=1.0, help="average number of HiLights per chapter")
+    parser.add_argument("-s", "--seconds", metavar="SECONDS", type=float, default=10.0, help="length of each chapter")
+    parser.add_argument("-pre_t", "--pre_time", metavar="TIME_BEFORE", type=float, default=30, help="timespan to include before a HiLight mark, in seconds")
+    parser.add_argument("-post_t", "--post_time", metavar="TIME_AFTER", type=float, default=10, help="timespan to include after a HiLight mark, in seconds")
+    parser.add_argument("-scan_j", "--scan_jobs", metavar="JOBS", type=int, default=1, help="processes probing files")
+    parser.add_argument("-j", "--jobs", metavar="JOBS", type=int, default=1, help="extractions running at the same time")
+    parser.add_argument("-extract_max", "--extract_max", metavar="CHAPTERS", type=int, default=10, help="run the extraction only up to this many chapters, needs ffmpeg")
+    parser.add_argument("-events", "--telemetry_events", action="store_true", help="also benchmark decoding the telemetry and detecting events, needs NumPy")
+    parser.add_argument("-baseline", "--baseline", metavar="BASELINE_FILE", default=DEFAULT_BASELINE, help="json file with the baseline timings of this host")
+    parser.add_argument("-save", "--save_baseline", action="store_true", help="store the timings as new baseline")
+    parser.add_argument("-tolerance", "--tolerance", metavar="FACTOR", type=float, default=1.5, help="a stage slower than FACTOR times its baseline is a regression")
+    args = parser.parse_args()
+
+    has_ffmpeg = shutil.which("ffmpeg") is not None
+    if not has_ffmpeg:
+        print("ffmpeg not found, skipping the extraction benchmarks.", file=sys.stderr)
+
+    # a real video only matters for extracting, every other stage reads the headers only
+    header_template = synthetic_template(args.seconds, telemetry_events=[args.seconds / 2] if args.telemetry_events else None)
+    video_template = ffmpeg_template(args.seconds) if has_ffmpeg and min(args.chapters) <= args.extract_max else header_template
+
+    results: Dict[str, Dict[str, float]] = {}
+    for chapters in args.chapters:
+        extract = has_ffmpeg and chapters <= args.extract_max
+        results[str(chapters)] = run_scale(chapters, args, video_template if extract else header_template, extract=extract)
+
+    baseline: Dict[str, Dict[str, float]] = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r") as baseline_file:
+            baseline = json.load(baseline_file)
+    elif not args.save_baseline:
+        print(f"""no baseline "{args.baseline}" yet, store one with --save.""", file=sys.stderr)
+
+    print_results(results, baseline)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w") as baseline_file:
+            json.dump({**baseline, **results}, baseline_file, indent=1, sort_keys=True)
+            baseline_file.write("\n")
+        print(f"""stored the baseline in "{args.baseline}".""")
+        return
+
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print("regressions:", file=sys.stderr)
+        for regression in regressions:
+            print(f"  {regression}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,9 @@
 import os
-import subprocess
-from typing import Optional
+from functools import partial
+from typing import Dict, List, Optional, Tuple
 
-from run_bash import run_bash
+import ffmpeg_runner
+from video_metadata import VideoMetadata, get_metadata
 
 
 class Clip:
@@ -14,22 +15,20 @@ class Clip:
     base_filename: str
     start: float
     end: float
-    video_length: Optional[float]
-    date_taken: Optional[str]
-    hilight_pos: int
-    hilight_time: float
+    metadata: VideoMetadata
+    hilights: List[float]  # times of the HiLights in this clip, in file time
     metadata_filename: str
+    proxy_filename: Optional[str]  # low resolution proxy of the file, same timeline
 
-    def __init__(self: 'Clip', filename: str, start: float, end: float, hilight_pos: int, hilight_time: float) -> None:
-        self.video_length = None
-        self.date_taken = None
+    def __init__(self: 'Clip', filename: str, start: float, end: float, hilights: List[float], metadata: Optional[VideoMetadata] = None, proxy_filename: Optional[str] = None) -> None:
+        self.metadata = metadata if metadata is not None else get_metadata(filename)
 
         self.abs_filename = os.path.abspath(filename)
         self.base_filename = os.path.basename(filename)
         self.start = max(start, 0)
         self.end = min(end, self.get_video_length())
-        self.hilight_pos = hilight_pos
-        self.hilight_time = hilight_time
+        self.hilights = hilights
+        self.proxy_filename = proxy_filename
 
         assert start < end  # yes no empty clips where start == end are allowed
 
@@ -38,32 +37,46 @@ class Clip:
             out_name = f"{self.base_filename}_extract.mkv"
         out_name = out_name.replace(os.sep * 2, os.sep)
 
+        # maybe ffmpeg always keeps the metadata for a single clip?
+        ffmpeg_runner.run_ffmpeg(["-y", "-i", self.abs_filename, *self.get_cut_options(), "-codec", "copy", out_name], duration=self.get_clip_length())
+        return out_name
+
+    def get_cut_options(self: 'Clip') -> List[str]:
+        """ffmpeg output options cutting this clip from its file"""
         assert self.start >= 0.0, f"""start={self.start} is less than 0, setting to 0."""
         assert self.end >= 0.0, f"""end={self.end} is less than 0, setting to 0."""
         assert self.start <= self.get_video_length(), f"""start={self.start} is greater than clip length {self.get_video_length()}, setting to clip length."""
         assert self.end <= self.get_video_length(), f"""end={self.end} is greater than clip length {self.get_video_length()}, setting to clip length."""
 
-        start_time = "" if self.start == 0.0 else f"-ss {self.start}"
+        start_time = [] if self.start == 0.0 else ["-ss", f"{self.start}"]
         duration = self.end - self.start if self.end is not None else 0
-        end_time = f"-t {duration}" if self.end is not None and self.end < self.get_video_length() else ""
-
-        # maybe ffmpeg always keeps the metadata for a single clip?
-
-        # self.metadata_filename = f"{out_name}.ffmetadata"
-        # run_bash(f"""ffmpeg -hide_banner -loglevel error -stats -i "{self.abs_filename}" -f ffmetadata "{self.metadata_filename} -y\"""")
-        run_bash(f"""ffmpeg -hide_banner -loglevel error -stats -i "{self.abs_filename}" {start_time} {end_time} -codec copy "{out_name}" -y""".replace("  ", " ").replace("  ", " ").replace("  ", " "))
-        # run_bash(f"""ffmpeg -hide_banner -loglevel error -stats -i "{out_name}_nometadata.mkv" -i "{self.metadata_filename}" -map_metadata 1 -codec copy "{out_name}" -y""".replace("  ", " ").replace("  ", " ").replace("  ", " "))
-        # run_bash(f"""rm "{self.metadata_filename}\"""")
-        return out_name
-
-    def overlaps(self: 'Clip', other: 'Clip') -> bool:
-        if self.abs_filename == other.abs_filename:
-            # if the filename is the same perform a range-check:
-            # https://stackoverflow.com/a/3269471/10314791
-            return self.start <= other.end and other.start <= self.end
-        else:
-            # assume 'other' comes immediately after 'self' for later concatenation
-            return self.start <= other.end + self.get_video_length() and other.start + self.get_video_length() <= self.end
+        end_time = ["-t", f"{duration}"] if self.end is not None and self.end < self.get_video_length() else []
+        return start_time + end_time
+
+    def snap_to_keyframes(self: 'Clip') -> None:
+        """
+        moves start back onto the keyframe a stream copy really starts at.
+        The end stays, a stream copy with '-t' already ends at the last packet before it.
+        Without a readable keyframe index the clip stays as is
+        """
+        keyframe_index = self.metadata.get_keyframe_index()
+        if keyframe_index is None:
+            return
+        self.start = max(keyframe_index.snap_start(self.start), 0.0)
+
+    def get_byte_range(self: 'Clip') -> Optional[Tuple[int, Optional[int]]]:
+        """file offsets of the keyframes enclosing the clip, None as end means until the end of the file"""
+        keyframe_index = self.metadata.get_keyframe_index()
+        if keyframe_index is None:
+            return None
+        return keyframe_index.byte_range(self.start, self.end)
+
+    def estimate_size(self: 'Clip') -> Optional[int]:
+        """bytes a stream copy of this clip writes, None if unknown"""
+        keyframe_index = self.metadata.get_keyframe_index()
+        if keyframe_index is None:
+            return None
+        return keyframe_index.estimate_size(self.start, self.end)
 
     def clamp_start(self: 'Clip') -> None:
         if self.start < 0:
@@ -74,53 +87,47 @@ class Clip:
             self.end = self.get_video_length()
 
     def __repr__(self: 'Clip') -> str:
-        length = self.video_length if self.video_length is not None else 0
-        return f"CLIP=[{self.abs_filename=}, {self.start=: 19.14f}, {self.end=: 19.14f}, {self.hilight_pos=: 1}, {length=: 19.14f}, {self.date_taken=}]"
+        length = self.metadata.duration if self.metadata.duration is not None else 0
+        return f"CLIP=[{self.abs_filename=}, {self.start=: 19.14f}, {self.end=: 19.14f}, {self.hilights=}, {length=: 19.14f}, {self.metadata.creation_time=}]"
 
     def get_out_name(self: 'Clip') -> str:
         return f"{self.get_date_taken()}_{self.base_filename}"
 
     def get_video_length(self: 'Clip') -> float:
-        if self.video_length is None:
-            result = subprocess.run(
-                [
-                    "ffprobe",
-                    "-v",
-                    "error",
-                    "-show_entries",
-                    "format=duration",
-                    "-of",
-                    "default=noprint_wrappers=1:nokey=1",
-                    self.abs_filename
-                ],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT
-            )
-            self.video_length = float(result.stdout)
-        return self.video_length
+        return self.metadata.get_duration()
 
     def get_clip_length(self: 'Clip') -> float:
         return self.end - self.start
 
     def get_date_taken(self: 'Clip') -> str:
-        if self.date_taken is None:
-            p = subprocess.Popen(
-                [
-                    "ffprobe",
-                    "-v", "quiet",
-                    "-select_streams",
-                    "v:0",
-                    "-show_entries",
-                    "stream_tags=creation_time",
-                    "-of", "default=noprint_wrappers=1:nokey=1",
-                    self.abs_filename
-                ],
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE)
-            stdout, _ = p.communicate()
-            self.date_taken = stdout.decode("ascii")[:10]
-        return self.date_taken
+        return self.metadata.get_date_taken()
+
+    def to_json(self: 'Clip') -> Dict[str, object]:
+        """the clip and the metadata of its file needed to extract it without probing the file again"""
+        return {
+            "filename": self.abs_filename,
+            "start": self.start,
+            "end": self.end,
+            "hilights": self.hilights,
+            "duration": self.metadata.duration,
+            "creation_time": self.metadata.creation_time,
+            "streams": self.metadata.streams,
+            "proxy_filename": self.proxy_filename,
+        }
+
+    @staticmethod
+    def from_json(data: Dict[str, object]) -> 'Clip':
+        filename, start, end, hilights = data["filename"], data["start"], data["end"], data["hilights"]
+        assert isinstance(filename, str) and isinstance(start, (int, float)) and isinstance(end, (int, float)) and isinstance(hilights, list)
+
+        metadata = get_metadata(filename)
+        if not metadata.probed:
+            metadata.load({"duration": data.get("duration"), "creation_time": data.get("creation_time"), "streams": data.get("streams")})
+
+        proxy_filename = data.get("proxy_filename")
+        assert proxy_filename is None or isinstance(proxy_filename, str)
+
+        return Clip(filename, start=float(start), end=float(end), hilights=[float(hilight) for hilight in hilights], metadata=metadata, proxy_filename=proxy_filename)
 
     def __lt__(self: 'Clip', other: 'Clip') -> bool:
         if self is other:
@@ -130,3 +137,54 @@ class Clip:
             return self.start < other.start
         else:
             return self.base_filename < other.base_filename
+
+
+def create_clip_extractions(clip_outputs: List[Tuple[Clip, str]]) -> List[str]:
+    """
+    extracts every (clip, out_name) pair,
+    with a single ffmpeg per source file writing all of its clips as separate outputs,
+    so each source is opened and read sequentially only once.
+    returns the out_names in the given order
+    """
+    by_source: Dict[str, List[Tuple[Clip, str]]] = {}
+    for clip, out_name in clip_outputs:
+        by_source.setdefault(clip.abs_filename, []).append((clip, out_name))
+
+    # one event loop runs the ffmpegs of all sources
+    ffmpeg_runner.run_ffmpeg_all([partial(extract_clips_from_source, source_outputs) for source_outputs in by_source.values()])
+
+    return [out_name.replace(os.sep * 2, os.sep) for _, out_name in clip_outputs]
+
+
+def get_source_extraction_arguments(clip_outputs: List[Tuple[Clip, str]]) -> Tuple[List[str], List[str]]:
+    """
+    (ffmpeg arguments, out_names) reading the source of all clip_outputs once, with one output per clip.
+    All clip_outputs have to cut from the same source file
+    """
+    assert len({clip.abs_filename for clip, _ in clip_outputs}) == 1, "clips of more than one source file"
+
+    arguments = ["-y", "-i", clip_outputs[0][0].abs_filename]
+    out_names = []
+    for clip, out_name in clip_outputs:
+        out_name = out_name.replace(os.sep * 2, os.sep)
+        arguments += [*clip.get_cut_options(), "-codec", "copy", out_name]
+        out_names.append(out_name)
+    return arguments, out_names
+
+
+async def extract_clips_from_source(clip_outputs: List[Tuple[Clip, str]]) -> List[str]:
+    """extracts clip_outputs of a single source file on the running event loop"""
+    arguments, out_names = get_source_extraction_arguments(clip_outputs)
+    # the outputs are written side by side, the longest one takes the longest
+    await ffmpeg_runner.runner.run(arguments, duration=max(clip.get_clip_length() for clip, _ in clip_outputs))
+    return out_names
+
+
+def create_clip_extractions_from_source(clip_outputs: List[Tuple[Clip, str]]) -> List[str]:
+    """all clip_outputs have to cut from the same source file"""
+    if len(clip_outputs) == 1:
+        return [clip_outputs[0][0].create_clip_extraction(clip_outputs[0][1])]
+
+    arguments, out_names = get_source_extraction_arguments(clip_outputs)
+    ffmpeg_runner.run_ffmpeg(arguments, duration=max(clip.get_clip_length() for clip, _ in clip_outputs))
+    return out_names
@@ -0,0 +1,265 @@
+import os
+import sys
+import threading
+import traceback
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from clip import Clip, create_clip_extractions_from_source
+from extraction import Extraction
+from instrumentation import instrumentation, stage
+from manifest import Manifest
+from smart_cut import create_smart_cut_extractions
+from staging import ScratchFolder, check_free_space, get_partial_name, publish, remove_if_exists  # NOQA
+
+
+def get_device(filename: str) -> int:
+    try:
+        return os.stat(filename).st_dev
+    except OSError:
+        return -1
+
+
+def get_source_device(extraction: Extraction) -> int:
+    """
+    st_dev of the file the extraction reads first,
+    all chapters of one recording are on the same card
+    """
+    if len(extraction.clips) == 0:
+        return -1
+    return get_device(extraction.clips[0].abs_filename)
+
+
+def record_bytes(source_clips: List[Clip], out_names: List[str]) -> None:
+    """bytes read from source files as estimated from their keyframe index, and the sizes of the outputs written"""
+    for clip in source_clips:
+        size = clip.estimate_size()
+        if size is not None:
+            instrumentation.record_read(clip.abs_filename, size)
+    for out_name in out_names:
+        if os.path.exists(out_name):
+            instrumentation.record_written(out_name, os.path.getsize(out_name))
+
+
+def check_free_space_for(clip_outputs: List[Tuple[Clip, str]], description: str) -> None:
+    """checks every folder clip_outputs are written to has room for their estimated sizes"""
+    needed: Dict[str, Optional[int]] = {}
+    for clip, clip_out_name in clip_outputs:
+        folder = os.path.dirname(clip_out_name)
+        size, clip_size = needed.get(folder, 0), clip.estimate_size()
+        needed[folder] = size + clip_size if size is not None and clip_size is not None else None
+    for folder, size in needed.items():
+        check_free_space(folder, size, description)
+
+
+def report_failure(description: str, e: Exception) -> None:
+    print(f"""{description} failed: {e}""", file=sys.stderr)
+    print(traceback.format_exc(), file=sys.stderr)
+
+
+class ExtractionExecutor:
+    """
+    runs many extractions in a pool of worker threads.
+
+    First every source file is read once by a single ffmpeg writing all clips
+    any extraction needs from it, then extractions of more than one clip are combined
+    (extractions with direct_concat cut their clips while combining,
+    smart cut clips are cut by ffmpegs of their own, see smart_cut.py,
+    transcodes encode straight from the sources while combining, see transcode.py).
+    At most 'jobs' of these tasks run at once, and at most 'jobs_per_device' of them read
+    from the same source device, so several cards are read in parallel
+    while no single card is thrashed by interleaved reads.
+    Jobs of one device are started in the given order.
+
+    Everything ffmpeg writes is staged in a private folder below 'scratch_path'
+    (or in hidden files in the output folder without one), finished outputs are published with a rename.
+    Each job checks the folders it writes to have room for its estimated output first.
+    """
+    jobs: int
+    jobs_per_device: int
+    manifest: Optional[Manifest]
+    parameters: Dict[str, object]
+    scratch_path: Optional[str]
+
+    def __init__(self: 'ExtractionExecutor', jobs: int = 1, jobs_per_device: int = 1, manifest: Optional[Manifest] = None, parameters: Optional[Dict[str, object]] = None, scratch_path: Optional[str] = None) -> None:
+        self.jobs = max(jobs, 1)
+        self.jobs_per_device = max(jobs_per_device, 1)
+        self.manifest = manifest
+        self.parameters = parameters if parameters is not None else {}
+        self.scratch_path = scratch_path
+
+    def run(self: 'ExtractionExecutor', extractions: List[Extraction]) -> List[Optional[str]]:
+        """
+        returns the output name of each extraction in the given order,
+        None if it failed or had nothing to extract.
+        Extractions the manifest has an up to date output for are skipped,
+        every finished extraction is recorded in the manifest, which is saved at the latest when the run ends or is interrupted.
+        """
+        try:
+            with ScratchFolder(self.scratch_path) as staging_path:
+                return self._run(extractions, staging_path)
+        finally:
+            if self.manifest is not None:
+                self.manifest.flush()
+
+    def _run(self: 'ExtractionExecutor', extractions: List[Extraction], staging_path: Optional[str]) -> List[Optional[str]]:
+        out_names: List[Optional[str]] = []
+        staged_names: Dict[int, str] = {}
+        smart_cut_names: Set[str] = set()
+        skipped: Set[int] = set()
+        by_source: Dict[str, List[Tuple[Clip, str]]] = {}
+        finished_by_source: Dict[str, List[int]] = {}
+        for index, extraction in enumerate(extractions):
+            out_name: Optional[str] = None
+            try:
+                if len(extraction.get_clean_clip_lengths()) > 0:
+                    out_name = extraction.get_out_name()
+                    assert out_name is not None
+                    if self.manifest is not None and self.manifest.is_up_to_date(extraction, out_name, self.parameters):
+                        print(f"""{out_name} is up to date, skipping it.""")
+                        skipped.add(index)
+                    else:
+                        extraction.scratch_path = staging_path
+                        staged_names[index] = get_partial_name(staging_path if staging_path is not None else extraction.output_path, out_name, f"{os.getpid()}-{index}")
+                        clip_outputs = extraction.get_clip_outputs(staged_names[index])
+                        for clip, clip_out_name in clip_outputs:
+                            by_source.setdefault(clip.abs_filename, []).append((clip, clip_out_name))
+                            if extraction.smart_cut:
+                                smart_cut_names.add(clip_out_name)
+                        if not extraction.needs_combine():
+                            # single clips are finished once their source is extracted
+                            finished_by_source.setdefault(clip_outputs[0][0].abs_filename, []).append(index)
+            except Exception as e:
+                report_failure(f"planning extraction {extraction.extraction_number}", e)
+                out_name = None
+            out_names.append(out_name)
+
+        final_names = set(staged_names.values())
+
+        def finish(index: int) -> None:
+            out_name = out_names[index]
+            assert out_name is not None
+            with stage("publish"):
+                publish(staged_names[index], out_name)
+            record_bytes([], [out_name])
+            if self.manifest is not None:
+                self.manifest.record(extractions[index], out_name, self.parameters)
+
+        def extract_source(source: str, source_outputs: List[Tuple[Clip, str]]) -> Callable[[], object]:
+            def task() -> None:
+                check_free_space_for(source_outputs, f"""extracting "{source}\"""")
+                with stage("extract"):
+                    # a single ffmpeg reads the source for all stream copied clips, smart cuts run their own
+                    copy_outputs = [(clip, clip_out_name) for clip, clip_out_name in source_outputs if clip_out_name not in smart_cut_names]
+                    if len(copy_outputs) > 0:
+                        create_clip_extractions_from_source(copy_outputs)
+                    smart_cut_outputs = [(clip, clip_out_name) for clip, clip_out_name in source_outputs if clip_out_name in smart_cut_names]
+                    if len(smart_cut_outputs) > 0:
+                        create_smart_cut_extractions(smart_cut_outputs)
+                # outputs are counted once published, intermediary files right away
+                record_bytes([clip for clip, _ in source_outputs], [clip_out_name for _, clip_out_name in source_outputs if clip_out_name not in final_names])
+                for index in finished_by_source.get(source, []):
+                    finish(index)
+            return task
+
+        extracted = self._run_tasks(
+            [(f"extracting {source}", get_device(source), extract_source(source, source_outputs)) for source, source_outputs in by_source.items()]
+        )
+        failed_sources = {source for source, ok in zip(by_source, extracted) if not ok}
+
+        def combine(index: int, out_name: str) -> Callable[[], object]:
+            def task() -> None:
+                staged_name = staged_names[index]
+                check_free_space(os.path.dirname(staged_name), extractions[index].estimate_size(), f"""combining "{out_name}\"""")
+                with stage("combine"):
+                    extractions[index].combine(out_file_name=staged_name)
+                # direct concats and transcodes read their sources while combining
+                reads_sources = extractions[index].direct_concat or extractions[index].transcode is not None
+                record_bytes(extractions[index].clips if reads_sources else [], [])
+                finish(index)
+            return task
+
+        combine_tasks: List[Tuple[str, int, Callable[[], object]]] = []
+        combine_indices: List[int] = []
+        for index, (extraction, out_name) in enumerate(zip(extractions, out_names)):
+            if out_name is None or index in skipped:
+                continue
+            if any(clip.abs_filename in failed_sources for clip in extraction.clips):
+                out_names[index] = None
+                continue
+            if extraction.needs_combine():
+                combine_tasks.append((f"combining extraction {extraction.extraction_number}", get_source_device(extraction), combine(index, out_name)))
+                combine_indices.append(index)
+
+        for index, ok in zip(combine_indices, self._run_tasks(combine_tasks)):
+            if not ok:
+                out_names[index] = None
+
+        # published outputs are gone from staging, what is left belongs to failed extractions
+        for staged_name in staged_names.values():
+            remove_if_exists(staged_name)
+
+        return out_names
+
+    def _run_tasks(self: 'ExtractionExecutor', tasks: List[Tuple[str, int, Callable[[], object]]]) -> List[bool]:
+        """
+        runs (description, device, task) tuples, returns whether each task succeeded
+        """
+        succeeded: List[bool] = [False] * len(tasks)
+
+        if self.jobs == 1:
+            for index, (description, _, task) in enumerate(tasks):
+                succeeded[index] = self._run_one(description, task)
+            return succeeded
+
+        pending: Dict[int, List[int]] = {}
+        for index, (_, device, _) in enumerate(tasks):
+            pending.setdefault(device, []).append(index)
+        active: Dict[int, int] = {device: 0 for device in pending}
+        condition = threading.Condition()
+
+        def next_job() -> Optional[int]:
+            # with condition held: pick from the least busy device that is below its limit
+            candidates = [device for device, indices in pending.items() if len(indices) > 0 and active[device] < self.jobs_per_device]
+            if len(candidates) == 0:
+                return None
+            device = min(candidates, key=lambda d: active[d])
+            active[device] += 1
+            return pending[device].pop(0)
+
+        def worker() -> None:
+            while True:
+                with condition:
+                    index = next_job()
+                    while index is None:
+                        if all(len(indices) == 0 for indices in pending.values()):
+                            return
+                        condition.wait()
+                        index = next_job()
+                description, device, task = tasks[index]
+                try:
+                    succeeded[index] = self._run_one(description, task)
+                finally:
+                    with condition:
+                        active[device] -= 1
+                        condition.notify_all()
+
+        threads = [threading.Thread(target=worker, name=f"extraction-worker-{i}", daemon=True) for i in range(self.jobs)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return succeeded
+
+    @staticmethod
+    def _run_one(description: str, task: Callable[[], object]) -> bool:
+        try:
+            task()
+            return True
+        except Exception as e:
+            report_failure(description, e)
+            return False
+
+
+def run_extractions(extractions: List[Extraction], jobs: int = 1, jobs_per_device: int = 1, manifest: Optional[Manifest] = None, parameters: Optional[Dict[str, object]] = None, scratch_path: Optional[str] = None) -> List[Optional[str]]:
+    return ExtractionExecutor(jobs=jobs, jobs_per_device=jobs_per_device, manifest=manifest, parameters=parameters, scratch_path=scratch_path).run(extractions)
@@ -1,13 +1,13 @@
 import os
 from copy import copy
-from fractions import Fraction
-from itertools import chain
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 
-from more_itertools import pairwise
-
-from clip import Clip
-from run_bash import run_bash
+import ffmpeg_runner
+from clip import Clip, create_clip_extractions
+from ffconcat import build_concat_list, build_ffmetadata, concat_file_line, get_concat_arguments  # NOQA
+from smart_cut import create_smart_cut_extractions
+from staging import get_partial_name, remove_if_exists
+from transcode import OUT_EXTENSION, TranscodeSettings, create_transcode
 
 
 class Extraction:
@@ -18,103 +18,192 @@ class Extraction:
     """
     clips: List[Clip]
     output_path: str
+    direct_concat: bool
+    smart_cut: bool  # re-encode the partial GOPs at the cuts instead of cutting at keyframes
+    transcode: Optional[TranscodeSettings]  # encode a small H.264 mp4 instead of stream copying, see transcode.py
+    scratch_path: Optional[str]  # folder for the intermediary files, the output_path if None
 
-    combine_file_path: str
-
-    def __init__(self: 'Extraction', extraction_number: int, output_path: str) -> None:
+    def __init__(self: 'Extraction', extraction_number: int, output_path: str, direct_concat: bool = False, smart_cut: bool = False, transcode: Optional[TranscodeSettings] = None) -> None:
         self.extraction_number = extraction_number
         self.clips = []
         self.output_path = (output_path + os.sep).replace(os.sep * 2, os.sep).replace(os.sep * 2, os.sep)
-        self.combine_file_path = f"""{self.output_path}{os.sep}combine_{extraction_number}.ffmpeg_combine_list""".replace(os.sep * 2, os.sep).replace(os.sep * 2, os.sep)
+        # a transcode cuts exactly from the sources by itself, smart cut clips are extracted one by one,
+        # neither leaves anything to cut while combining
+        self.direct_concat = direct_concat and not smart_cut and transcode is None
+        self.smart_cut = smart_cut and transcode is None
+        self.transcode = transcode
+        self.scratch_path = None
 
     def add_clip(self: 'Extraction', clip: Clip) -> None:
         self.clips.append(clip)
 
     def extract_and_combine_all_clips(self: "Extraction", *, out_file_name: str) -> str:
-        extract_filenames = []
-        for index, clip in enumerate(self.clips):
-            extract_filenames.append(clip.create_clip_extraction(f"""{self.output_path}extraction_{self.extraction_number}_{clip.base_filename}_clip_{index+1}_of_{len(self.clips)}.mkv"""))
-
-        with open(self.combine_file_path, "w") as file:
-            for extract_filename in extract_filenames:
-                file.write(f"file '{extract_filename}'\n")
-
-        out_file_name = f"{self.output_path}{os.path.basename(out_file_name)}"
-
-        # export metadata
-        ffmetadata_file_name = f"{self.output_path}combine_{self.extraction_number}.ffmetadata"
-        run_bash(f"""ffmpeg -hide_banner -loglevel error -stats -i "{self.clips[0].abs_filename}" -f ffmetadata "{ffmetadata_file_name} -y\"""")
-
-        # remove other chapter markers
-        with open(ffmetadata_file_name, "r") as ffmetadata_file:
-            metadata = ffmetadata_file.read()
-        with open(ffmetadata_file_name, "w") as ffmetadata_file:
-            ffmetadata_file.write(metadata.split("[CHAPTER]")[0])
-
-        # add metadata for other clips
-        if len(self.clips) > 1:
-            prev_time = 0.0
-            for clip in self.clips:
-                frac = Fraction(prev_time + clip.hilight_time - clip.start)
-                limited = frac.limit_denominator(10000)
-                with open(ffmetadata_file_name, "a") as ffmetadata_file:
-                    ffmetadata_file.write("[CHAPTER]\n")
-                    ffmetadata_file.write(f"TIMEBASE=1/{limited.denominator}\n")
-                    ffmetadata_file.write(f"START={limited.numerator}\n")
-                    ffmetadata_file.write(f"END={limited.numerator}\n")
-                prev_time += clip.get_clip_length()
-
-        # combine
-        run_bash(f"""ffmpeg -hide_banner -loglevel error -stats -f concat -safe 0 -i "{self.combine_file_path}" -i "{ffmetadata_file_name}" -map_metadata 1 -c copy "{out_file_name}" -y""")
-
-        # cleanup
-        run_bash(f"""rm -f "{self.combine_file_path}"\"""")
-        run_bash(f"""rm -f "{ffmetadata_file_name}"\"""")
+        if self.transcode is not None:
+            return self.transcode_clips(out_file_name=out_file_name)
+        if self.direct_concat:
+            return self.combine_clips_directly(out_file_name=out_file_name)
+
+        extract_filenames = self.extract_clips(self.get_intermediate_clip_outputs(out_file_name))
+        return self.combine_clip_extractions(extract_filenames, out_file_name=out_file_name)
+
+    def extract_clips(self: 'Extraction', clip_outputs: List[Tuple[Clip, str]]) -> List[str]:
+        """extracts (clip, out_name) pairs as returned by 'get_clip_outputs', smart cut or stream copied"""
+        if self.smart_cut:
+            return create_smart_cut_extractions(clip_outputs)
+        return create_clip_extractions(clip_outputs)
+
+    def combine(self: 'Extraction', *, out_file_name: str) -> str:
+        """combines the clips once all outputs of 'get_clip_outputs' have been extracted"""
+        if self.transcode is not None:
+            return self.transcode_clips(out_file_name=out_file_name)
+        if self.direct_concat:
+            return self.combine_clips_directly(out_file_name=out_file_name)
+        return self.combine_clip_extractions([extract_filename for _, extract_filename in self.get_intermediate_clip_outputs(out_file_name)], out_file_name=out_file_name)
+
+    def get_intermediate_clip_outputs(self: 'Extraction', out_name: str) -> List[Tuple[Clip, str]]:
+        """
+        (clip, intermediary file) pairs, named after out_name: extraction numbers restart for every recording
+        and chapter names repeat across cards, the (staged) output name is the only name unique to this extraction
+        """
+        out_base_name = os.path.splitext(os.path.basename(out_name))[0].lstrip(".")
+        return [
+            (clip, get_partial_name(self.get_work_path(), f"{out_base_name}.mkv", f"clip_{index+1}_of_{len(self.clips)}"))
+            for index, clip in enumerate(self.clips)
+        ]
+
+    def get_work_path(self: 'Extraction') -> str:
+        """folder the intermediary files are written to, with a trailing separator"""
+        if self.scratch_path is None:
+            return self.output_path
+        return os.path.join(self.scratch_path, "")
+
+    def get_clip_outputs(self: 'Extraction', out_name: str) -> List[Tuple[Clip, str]]:
+        """
+        (clip, out_name) pairs this extraction needs extracted from its source files,
+        a single clip is extracted directly to out_name, several clips to intermediary files.
+        With direct_concat several clips are cut while combining, nothing has to be extracted beforehand,
+        a transcode reads its sources only while combining
+        """
+        if self.transcode is not None:
+            return []
+        clips = self.get_clean_clip_lengths()
+        if len(clips) == 1:
+            return [(clips[0], out_name)]
+        if self.direct_concat:
+            return []
+        return self.get_intermediate_clip_outputs(out_name)
+
+    def needs_combine(self: 'Extraction') -> bool:
+        """whether 'combine' has to run after the 'get_clip_outputs' are extracted, a single stream copied clip is done by then"""
+        return self.transcode is not None or len(self.get_clean_clip_lengths()) > 1
+
+    def combine_clip_extractions(self: 'Extraction', extract_filenames: List[str], *, out_file_name: str) -> str:
+        """combines the already extracted intermediary files and adds chapter markers for the HiLights"""
+        combine_list = ""
+        for extract_filename in extract_filenames:
+            combine_list += concat_file_line(extract_filename)
+
+        out_file_name = self._combine(combine_list, out_file_name=out_file_name)
+
         for extract_filename in extract_filenames:
-            run_bash(f"""rm -f "{extract_filename}"\"""")
+            remove_if_exists(extract_filename)
 
         return out_file_name
 
-    def get_clean_clip_lengths(self: 'Extraction') -> List[Clip]:
-        clips_copy = sorted(self.clips)
+    def combine_clips_directly(self: 'Extraction', *, out_file_name: str) -> str:
+        """
+        combines the clips straight from their source files with inpoint/outpoint directives,
+        no intermediary clip files are written
+        """
+        return self._combine(build_concat_list(self.clips), out_file_name=out_file_name)
 
-        # make sure the clips overlap!
-        for clip, next_clip in pairwise(clips_copy):
-            assert clip.overlaps(next_clip)
+    def transcode_clips(self: 'Extraction', *, out_file_name: str) -> str:
+        """encodes the clips straight from their source files in parallel chunks, with chapter markers for the HiLights"""
+        assert self.transcode is not None
+        chapter_times = self.get_chapter_times() if len(self.clips) > 1 else []
+        return create_transcode(self.get_output_clips(), self.transcode, chapter_times, out_file_name)
 
-        returnable: List[Clip] = []
+    def _combine(self: 'Extraction', combine_list: str, *, out_file_name: str) -> str:
+        # chapter markers for the HiLights, the source's own chapters are dropped
+        chapter_times = self.get_chapter_times() if len(self.clips) > 1 else []
+
+        ffmpeg_runner.run_ffmpeg(
+            ["-y", *get_concat_arguments(combine_list, build_ffmetadata(chapter_times), self.clips[0].abs_filename), "-c", "copy", out_file_name],
+            duration=sum(clip.get_clip_length() for clip in self.clips),
+        )
+
+        return out_file_name
+
+    def get_chapter_times(self: 'Extraction') -> List[float]:
+        """times of the HiLights in the combined output"""
+        chapter_times = []
+        prev_time = 0.0
+        for clip in self.clips:
+            for hilight in clip.hilights:
+                chapter_times.append(prev_time + hilight - clip.start)
+            prev_time += clip.get_clip_length()
+        return chapter_times
 
-        clamp_next_start = True  # clamp first clip, always
-        next_start_time: Optional[float] = None
-        for clip, next_clip in pairwise(chain(clips_copy, [None])):
+    def get_clean_clip_lengths(self: 'Extraction') -> List[Clip]:
+        """
+        the clips clamped to their files in the order they were added,
+        consecutive clips of the same file merged into one
+        """
+        returnable: List[Clip] = []
+        for clip in self.clips:
             this_clip = copy(clip)
-            if clamp_next_start:
-                clamp_next_start = False
-                this_clip.clamp_start()
-            if next_start_time is not None:
-                this_clip.start = next_start_time
-                next_start_time = None
-
-            if next_clip is not None and this_clip.base_filename == next_clip.base_filename:
-                # same file, remove one clip, change ending accordingly
-                next_start_time = this_clip.start
+            this_clip.clamp_start()
+            this_clip.clamp_end()
+            if len(returnable) > 0 and returnable[-1].abs_filename == this_clip.abs_filename:
+                previous_clip = returnable[-1]
+                previous_clip.start = min(previous_clip.start, this_clip.start)
+                previous_clip.end = max(previous_clip.end, this_clip.end)
+                previous_clip.hilights = previous_clip.hilights + this_clip.hilights
             else:
-                # differing files, clamp end/start and append
-                this_clip.clamp_end()
-                clamp_next_start = True
                 returnable.append(this_clip)
 
         return returnable
 
     @staticmethod
     def add_metadata(in_name: str, out_name: str, hilights: List[float]) -> str:
-        ffmetadata_file_name = f"{in_name}.ffmetadata"
-        run_bash(f"""ffmpeg -hide_banner -loglevel error -stats -i "{in_name}" -f ffmetadata "{ffmetadata_file_name}\"""")
-        run_bash(f"""ffmpeg -hide_banner -loglevel error -stats -i "{in_name}" -i "{ffmetadata_file_name}" -map_metadata 1 -codec copy "{out_name}\"""")
-        # run_bash(f"""rm "{in_name}\"""")
-        # run_bash(f"""rm "{ffmetadata_file_name}\"""")
+        """copies in_name to out_name with a chapter marker at each of the hilights"""
+        ffmpeg_runner.run_ffmpeg([
+            "-y", "-i", in_name, "-f", "ffmetadata", "-i", ffmpeg_runner.PipeInput(build_ffmetadata(hilights)),
+            "-map", "0", "-map_metadata", "0", "-map_chapters", "1", "-codec", "copy", out_name,
+        ])
         return out_name
 
+    def get_output_clips(self: 'Extraction') -> List[Clip]:
+        """the clips that end up in the output"""
+        clips = self.get_clean_clip_lengths()
+        if len(clips) <= 1:
+            return clips
+        return self.clips
+
+    def snap_to_keyframes(self: 'Extraction') -> None:
+        """moves the start of every clip onto the keyframe a stream copy really starts at, so chapter markers match the output"""
+        for clip in self.clips:
+            clip.snap_to_keyframes()
+
+    def estimate_size(self: 'Extraction') -> Optional[int]:
+        """bytes of the output, None if unknown"""
+        if self.transcode is not None:
+            return self.transcode.estimate_size(sum(clip.get_clip_length() for clip in self.get_output_clips()))
+        size = 0
+        for clip in self.get_output_clips():
+            clip_size = clip.estimate_size()
+            if clip_size is None:
+                return None
+            size += clip_size
+        return size
+
+    def get_out_name(self: 'Extraction') -> Optional[str]:
+        extension = OUT_EXTENSION if self.transcode is not None else ".mkv"
+        for clip in self.clips:
+            if len(clip.hilights) > 0:
+                return f"{self.output_path}{os.sep}{clip.get_out_name()}_clip_{self.extraction_number:03}{extension}".replace(os.sep * 2, os.sep).replace(os.sep * 2, os.sep)
+        return None
+
     def create_extraction(self: 'Extraction', out_name: Optional[str] = None) -> Optional[str]:
         clips = self.get_clean_clip_lengths()
 
@@ -122,18 +211,48 @@ class Extraction:
             return None
 
         if out_name is None:
-            for clip in self.clips:
-                if clip.hilight_pos == 0:
-                    out_name = f"{self.output_path}{os.sep}{clip.get_out_name()}_clip_{self.extraction_number:03}.mkv".replace(os.sep * 2, os.sep).replace(os.sep * 2, os.sep)
-                    break
+            out_name = self.get_out_name()
 
         assert out_name is not None
 
-        if len(clips) == 1:
-            return clips[0].create_clip_extraction(out_name)
+        if len(clips) == 1 and self.transcode is None:
+            return self.extract_clips([(clips[0], out_name)])[0]
 
         return self.extract_and_combine_all_clips(out_file_name=out_name)
 
+    def to_json(self: 'Extraction') -> Dict[str, object]:
+        return {
+            "extraction_number": self.extraction_number,
+            "output_path": self.output_path,
+            "direct_concat": self.direct_concat,
+            "smart_cut": self.smart_cut,
+            "transcode": self.transcode.to_json() if self.transcode is not None else None,
+            "out_name": self.get_out_name(),
+            "chapter_times": self.get_chapter_times(),
+            "estimated_bytes": self.estimate_size(),
+            "clips": [clip.to_json() for clip in self.clips],
+        }
+
+    @staticmethod
+    def from_json(data: Dict[str, object]) -> 'Extraction':
+        """out_name, chapter_times and estimated_bytes are informational, they are derived from the clips again"""
+        extraction_number, output_path, direct_concat, clips = data["extraction_number"], data["output_path"], data["direct_concat"], data["clips"]
+        assert isinstance(extraction_number, int) and isinstance(output_path, str) and isinstance(direct_concat, bool) and isinstance(clips, list)
+
+        smart_cut = data.get("smart_cut", False)
+        assert isinstance(smart_cut, bool)
+        transcode = data.get("transcode")
+        assert transcode is None or isinstance(transcode, dict)
+
+        extraction = Extraction(
+            extraction_number=extraction_number, output_path=output_path, direct_concat=direct_concat, smart_cut=smart_cut,
+            transcode=TranscodeSettings.from_json(transcode) if transcode is not None else None,
+        )
+        for clip in clips:
+            assert isinstance(clip, dict)
+            extraction.add_clip(Clip.from_json(clip))
+        return extraction
+
     def __repr__(self: 'Extraction') -> str:
         ret = "EXTRACTION=[clips=\n"
         for clip in self.clips:
@@ -0,0 +1,50 @@
+"""
+Inputs of ffmpeg's concat demuxer and ffmetadata chapters, built in memory to be piped to ffmpeg.
+"""
+
+from fractions import Fraction
+from typing import List
+
+import ffmpeg_runner
+from clip import Clip
+
+
+def concat_file_line(filename: str) -> str:
+    """a 'file' directive of ffmpeg's concat demuxer, quotes in filename escaped"""
+    escaped = filename.replace("'", "'\\''")
+    return f"file '{escaped}'\n"
+
+
+def build_concat_list(clips: List[Clip]) -> str:
+    """a concat list cutting the clips straight from their source files with inpoint/outpoint directives"""
+    combine_list = ""
+    for clip in clips:
+        combine_list += concat_file_line(clip.abs_filename)
+        if clip.start > 0.0:
+            combine_list += f"inpoint {clip.start}\n"
+        if clip.end < clip.get_video_length():
+            combine_list += f"outpoint {clip.end}\n"
+    return combine_list
+
+
+def build_ffmetadata(chapter_times: List[float]) -> str:
+    """ffmetadata with a zero length chapter at each of chapter_times, global metadata is mapped from the source instead"""
+    ffmetadata = ";FFMETADATA1\n"
+    for chapter_time in chapter_times:
+        limited = Fraction(chapter_time).limit_denominator(10000)
+        ffmetadata += f"[CHAPTER]\nTIMEBASE=1/{limited.denominator}\nSTART={limited.numerator}\nEND={limited.numerator}\n"
+    return ffmetadata
+
+
+def get_concat_arguments(combine_list: str, ffmetadata: str, metadata_source: str) -> List[ffmpeg_runner.Argument]:
+    """
+    ffmpeg input and mapping options concatenating the streams of combine_list, both lists fed through pipes,
+    with the chapters of ffmetadata and the global metadata of metadata_source.
+    Nothing but its header is read from metadata_source, no stream of it is mapped
+    """
+    return [
+        "-f", "concat", "-safe", "0", "-protocol_whitelist", "file,pipe", "-i", ffmpeg_runner.PipeInput(combine_list),
+        "-f", "ffmetadata", "-i", ffmpeg_runner.PipeInput(ffmetadata),
+        "-i", metadata_source,
+        "-map", "0:v:0", "-map", "0:a:0?", "-map_metadata", "2", "-map_chapters", "1",
+    ]
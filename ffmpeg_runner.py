@@ -0,0 +1,284 @@
+"""
+Runs ffmpeg from asyncio with argument lists, so paths with spaces or quotes stay intact.
+
+Inputs built in memory, like concat lists and ffmetadata, are passed as 'PipeInput' arguments
+and fed to ffmpeg through anonymous pipes instead of temporary files.
+
+ffmpeg is started with '-progress pipe:1', its progress blocks are parsed into throughput and eta
+and handed to an optional callback. Runs have a timeout and are killed when cancelled,
+a run exiting with an error raises 'FFmpegError' with the end of ffmpeg's stderr.
+"""
+
+import asyncio
+import os
+import sys
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple, Union  # NOQA
+
+from instrumentation import instrumentation
+
+FFMPEG = "ffmpeg"
+COMMON_OPTIONS = ["-hide_banner", "-loglevel", "error", "-nostats", "-progress", "pipe:1"]
+
+# lines of stderr kept for the error message
+STDERR_TAIL_LINES = 20
+
+# seconds between two progress lines printed by 'print_progress' for the same run
+PROGRESS_PRINT_INTERVAL = 2.0
+
+
+class FFmpegError(Exception):
+    """an ffmpeg run that exited with an error, timed out or could not be started"""
+    command: List[str]
+    returncode: Optional[int]
+    stderr: str
+
+    def __init__(self: 'FFmpegError', message: str, command: List[str], returncode: Optional[int] = None, stderr: str = "") -> None:
+        super().__init__(f"{message}: {' '.join(command)}" + (f"\n{stderr}" if stderr else ""))
+        self.command = command
+        self.returncode = returncode
+        self.stderr = stderr
+
+
+class FFmpegTimeout(FFmpegError):
+    pass
+
+
+class PipeInput:
+    """data ffmpeg reads from an anonymous pipe, stands for 'pipe:FD' in the arguments"""
+    data: bytes
+
+    def __init__(self: 'PipeInput', data: Union[str, bytes]) -> None:
+        self.data = data.encode("UTF-8") if isinstance(data, str) else data
+
+
+Argument = Union[str, PipeInput]
+
+
+def _write_pipe(fd: int, data: bytes) -> None:
+    try:
+        with open(fd, "wb") as pipe:
+            pipe.write(data)
+    except BrokenPipeError:
+        # ffmpeg stopped before reading it all, its exit code tells why
+        pass
+
+
+class Progress:
+    """the latest progress block of an ffmpeg run"""
+    description: str
+    duration: Optional[float]  # expected length of the output in seconds, None if unknown
+    out_time: float  # seconds of output written
+    total_size: int  # bytes of output written
+    speed: Optional[float]  # output seconds per wall second
+    elapsed: float  # wall seconds since the start
+    finished: bool
+
+    def __init__(self: 'Progress', description: str, duration: Optional[float]) -> None:
+        self.description = description
+        self.duration = duration
+        self.out_time = 0.0
+        self.total_size = 0
+        self.speed = None
+        self.elapsed = 0.0
+        self.finished = False
+
+    def update(self: 'Progress', values: Dict[str, str], elapsed: float) -> None:
+        self.elapsed = elapsed
+        out_time_us = values.get("out_time_us", values.get("out_time_ms", ""))
+        if out_time_us.lstrip("-").isdigit():
+            self.out_time = max(int(out_time_us) / 1e6, 0.0)
+        if values.get("total_size", "").isdigit():
+            self.total_size = int(values["total_size"])
+        speed = values.get("speed", "").rstrip("x").strip()
+        try:
+            self.speed = float(speed)
+        except ValueError:
+            pass
+        self.finished = values.get("progress") == "end"
+
+    def get_throughput(self: 'Progress') -> Optional[float]:
+        """bytes written per second"""
+        return self.total_size / self.elapsed if self.elapsed > 0 else None
+
+    def get_eta(self: 'Progress') -> Optional[float]:
+        """seconds until the run is done, None if unknown"""
+        if self.finished:
+            return 0.0
+        if self.duration is None or self.out_time <= 0:
+            return None
+        return max(self.duration - self.out_time, 0.0) * self.elapsed / self.out_time
+
+    def __str__(self: 'Progress') -> str:
+        text = f"{self.description}: {self.out_time:.1f}s"
+        if self.duration is not None:
+            text += f" of {self.duration:.1f}s"
+        throughput = self.get_throughput()
+        if throughput is not None:
+            text += f", {throughput / 2**20:.1f} MiB/s"
+        if self.speed is not None:
+            text += f", {self.speed:.1f}x"
+        eta = self.get_eta()
+        if eta is not None:
+            text += f", eta {eta:.0f}s"
+        return text
+
+
+ProgressCallback = Callable[[Progress], None]
+
+
+def print_progress() -> ProgressCallback:
+    """a callback printing progress lines to stderr, at most one every PROGRESS_PRINT_INTERVAL seconds per run"""
+    last_printed: Dict[str, float] = {}
+
+    def callback(progress: Progress) -> None:
+        now = time.monotonic()
+        if progress.finished or now - last_printed.get(progress.description, 0.0) >= PROGRESS_PRINT_INTERVAL:
+            last_printed[progress.description] = now
+            print(progress, file=sys.stderr)
+
+    return callback
+
+
+class FFmpegRunner:
+    """
+    runs ffmpeg commands on the running event loop, at most 'max_concurrency' of one 'run_all' at once.
+    'timeout' (seconds, None for none) applies to every run that does not set its own
+    """
+    max_concurrency: int
+    timeout: Optional[float]
+    progress_callback: Optional[ProgressCallback]
+
+    def __init__(self: 'FFmpegRunner', max_concurrency: int = 1, timeout: Optional[float] = None, progress_callback: Optional[ProgressCallback] = None) -> None:
+        self.max_concurrency = max(max_concurrency, 1)
+        self.timeout = timeout
+        self.progress_callback = progress_callback
+
+    async def run(self: 'FFmpegRunner', arguments: Sequence[Argument], duration: Optional[float] = None, timeout: Optional[float] = None, description: Optional[str] = None) -> None:
+        """
+        runs ffmpeg with the arguments after COMMON_OPTIONS,
+        duration is the expected length of the output in seconds for the eta.
+        raises 'FFmpegError' if ffmpeg fails, 'FFmpegTimeout' if it runs longer than the timeout
+        """
+        pipes: List[Tuple[int, int, bytes]] = []  # (read fd, write fd, data)
+        command = [FFMPEG, *COMMON_OPTIONS]
+        for argument in arguments:
+            if isinstance(argument, PipeInput):
+                read_fd, write_fd = os.pipe()
+                pipes.append((read_fd, write_fd, argument.data))
+                argument = f"pipe:{read_fd}"
+            command.append(argument)
+        if description is None:
+            description = os.path.basename(command[-1]) if len(arguments) > 0 else FFMPEG
+        timeout = timeout if timeout is not None else self.timeout
+        progress = Progress(description, duration)
+
+        start = time.perf_counter()
+        failed = True
+        try:
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *command,
+                    stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                    pass_fds=[read_fd for read_fd, _, _ in pipes],
+                )
+            except OSError as e:
+                for read_fd, write_fd, _ in pipes:
+                    os.close(read_fd)
+                    os.close(write_fd)
+                raise FFmpegError(f"could not start {FFMPEG} ({e})", command) from e
+
+            # ffmpeg holds the read ends now, the writes run alongside as it opens its inputs one after another
+            loop = asyncio.get_running_loop()
+            writers = []
+            for read_fd, write_fd, data in pipes:
+                os.close(read_fd)
+                writers.append(loop.run_in_executor(None, _write_pipe, write_fd, data))
+
+            async def communicate() -> None:
+                await self._read_progress(process, progress, start)
+                await process.wait()
+                await asyncio.gather(*writers)
+
+            stderr_task = asyncio.ensure_future(self._read_stderr(process))
+            try:
+                await asyncio.wait_for(communicate(), timeout)
+            except asyncio.TimeoutError:
+                await self._kill(process)
+                raise FFmpegTimeout(f"{FFMPEG} ran longer than {timeout}s", command, process.returncode, await stderr_task)
+            except BaseException:
+                # cancelled, don't leave ffmpeg running
+                await self._kill(process)
+                stderr_task.cancel()
+                raise
+
+            stderr = await stderr_task
+            if process.returncode != 0:
+                raise FFmpegError(f"{FFMPEG} exited with {process.returncode}", command, process.returncode, stderr)
+            failed = False
+        finally:
+            instrumentation.record_subprocess(FFMPEG, time.perf_counter() - start, failed)
+
+    async def run_all(self: 'FFmpegRunner', runs: List[Callable[[], Awaitable[object]]], max_concurrency: Optional[int] = None) -> None:
+        """awaits every run with at most max_concurrency (the runner's if None) at once, raises the first error once all are done"""
+        semaphore = asyncio.Semaphore(max(max_concurrency if max_concurrency is not None else self.max_concurrency, 1))
+
+        async def limited(run: Callable[[], Awaitable[object]]) -> None:
+            async with semaphore:
+                await run()
+
+        results = await asyncio.gather(*(limited(run) for run in runs), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    async def _read_progress(self: 'FFmpegRunner', process: 'asyncio.subprocess.Process', progress: Progress, start: float) -> None:
+        assert process.stdout is not None
+        values: Dict[str, str] = {}
+        async for line in process.stdout:
+            key, _, value = line.decode("UTF-8", errors="replace").strip().partition("=")
+            values[key] = value
+            # every block ends with progress=continue or progress=end
+            if key == "progress":
+                progress.update(values, time.perf_counter() - start)
+                values = {}
+                if self.progress_callback is not None:
+                    self.progress_callback(progress)
+
+    @staticmethod
+    async def _read_stderr(process: 'asyncio.subprocess.Process') -> str:
+        assert process.stderr is not None
+        lines: List[str] = []
+        async for line in process.stderr:
+            lines.append(line.decode("UTF-8", errors="replace").rstrip())
+            del lines[:-STDERR_TAIL_LINES]
+        return "\n".join(lines)
+
+    @staticmethod
+    async def _kill(process: 'asyncio.subprocess.Process') -> None:
+        if process.returncode is None:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+            await process.wait()
+
+
+runner = FFmpegRunner()
+
+
+def configure(max_concurrency: int = 1, timeout: Optional[float] = None, show_progress: bool = False) -> None:
+    """sets up the module level 'runner' used by 'run_ffmpeg' and 'run_ffmpeg_all'"""
+    runner.max_concurrency = max(max_concurrency, 1)
+    runner.timeout = timeout
+    runner.progress_callback = print_progress() if show_progress else None
+
+
+def run_ffmpeg(arguments: Sequence[Argument], duration: Optional[float] = None, timeout: Optional[float] = None) -> None:
+    """runs a single ffmpeg on its own event loop, for callers that are not async, e.g. the executor's threads"""
+    asyncio.run(runner.run(arguments, duration=duration, timeout=timeout))
+
+
+def run_ffmpeg_all(runs: List[Callable[[], Awaitable[object]]]) -> None:
+    """runs several ffmpeg runs of 'runner' from one event loop"""
+    asyncio.run(runner.run_all(runs))
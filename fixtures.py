@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Synthetic GoPro recordings for benchmarks:
+small mp4 files with a 'udta/GPMF' box holding HLMT HiLights, named and split into chapters like a GoPro does.
+Header only files can carry a telemetry track (ACCL, GYRO, GPS5) of a drive with hard braking events.
+
+The video comes from ffmpeg's testsrc, encoded once into a template that is copied for every chapter.
+Without ffmpeg a header only mp4 is written instead (sample tables, but no real samples),
+which is enough for discovery, probing, HiLight parsing and planning, but not for extracting.
+"""
+
+import argparse
+import io
+import math
+import os
+import random
+import shutil
+import struct
+import tempfile
+from typing import List, Optional
+
+from ffmpeg_runner import run_ffmpeg
+from GP_Highlight_Extractor import find_all_boxes
+
+CREATION_TIME = 3734000000  # 2022-04-28, seconds since 1904
+
+# samples per second of the telemetry streams, like a HERO8
+ACCL_RATE = 200
+GYRO_RATE = 200
+GPS_RATE = 18
+ACCL_SCALE = 418  # GoPro's scale of ACCL, per m/s²
+GYRO_SCALE = 939  # per rad/s
+GPS_SCALES = (10**7, 10**7, 1000, 1000, 100)
+
+DRIVING_SPEED = 20.0  # m/s
+BRAKING = 7.0  # m/s² while braking
+BRAKING_TIME = 2.0  # seconds
+HIT = 3 * 9.81  # m/s² at the start of each braking
+HIT_TIME = 0.2  # seconds
+
+
+def box(box_type: bytes, payload: bytes) -> bytes:
+    return struct.pack("> I", 8 + len(payload)) + box_type + payload
+
+
+def full_box(box_type: bytes, version: int, payload: bytes) -> bytes:
+    return box(box_type, bytes([version, 0, 0, 0]) + payload)
+
+
+def klv(key: bytes, value_type: int, struct_size: int, repeat: int, payload: bytes) -> bytes:
+    """a GPMF key-length-value entry, value_type 0 nests further entries"""
+    return key + struct.pack("> B B H", value_type, struct_size, repeat) + payload + b"\0" * (-len(payload) % 4)
+
+
+def gpmf_udta(hilights_ms: List[int]) -> bytes:
+    """a 'udta' box with a 'GPMF' box holding the HiLights the way a GoPro writes them"""
+    entries = b""
+    for hilight_ms in hilights_ms:
+        entry = klv(b"TIMS", ord("L"), 4, 2, struct.pack("> I I", hilight_ms, 0)) + klv(b"TYPE", ord("F"), 4, 1, b"MANL")
+        entries += klv(b"HLEN", 0, 1, len(entry), entry)
+    gpmf = klv(b"DVNM", ord("c"), 10, 1, b"Highlights") + klv(b"HLMT", 0, 1, len(entries), entries)
+    return box(b"udta", box(b"GPMF", gpmf))
+
+
+def gpmf_telemetry(start: float, duration: float, events: List[float]) -> bytes:
+    """
+    the telemetry of [start, start + duration) in a 'DEVC' like a GoPro writes it every second:
+    driving straight at DRIVING_SPEED with a GPS fix, a hit and a hard braking at each of events (seconds)
+    """
+    def in_event(time: float, length: float) -> Optional[float]:
+        """seconds since the start of the event time is in, None if none"""
+        return next((time - event for event in events if event <= time < event + length), None)
+
+    accl = b""
+    for index in range(int(ACCL_RATE * duration)):
+        since_hit = in_event(start + index / ACCL_RATE, HIT_TIME)
+        x = HIT if since_hit is not None else 0.0
+        accl += struct.pack("> h h h", round(x * ACCL_SCALE), 0, round(9.81 * ACCL_SCALE))
+    gyro = struct.pack("> h h h", 0, 0, 0) * int(GYRO_RATE * duration)
+    gps5 = b""
+    for index in range(int(GPS_RATE * duration)):
+        since_braking = in_event(start + index / GPS_RATE, BRAKING_TIME)
+        speed = DRIVING_SPEED - BRAKING * since_braking if since_braking is not None else DRIVING_SPEED
+        gps5 += struct.pack("> 5i", *(round(value * scale) for value, scale in zip((48.137, 11.575, 520.0, speed, speed), GPS_SCALES)))
+
+    def stream(entries: bytes) -> bytes:
+        return klv(b"STRM", 0, 1, len(entries), entries)
+
+    streams = (
+        stream(klv(b"SCAL", ord("s"), 2, 1, struct.pack("> h", ACCL_SCALE)) + klv(b"ACCL", ord("s"), 6, len(accl) // 6, accl))
+        + stream(klv(b"SCAL", ord("s"), 2, 1, struct.pack("> h", GYRO_SCALE)) + klv(b"GYRO", ord("s"), 6, len(gyro) // 6, gyro))
+        + stream(klv(b"GPSF", ord("L"), 4, 1, struct.pack("> I", 3)) + klv(b"SCAL", ord("l"), 4, 5, struct.pack("> 5i", *GPS_SCALES)) + klv(b"GPS5", ord("l"), 20, len(gps5) // 20, gps5))
+    )
+    return klv(b"DEVC", 0, 1, len(streams), streams)
+
+
+def _sample_tables(sample_count: int, delta: int, sample_size: int, keyframe_interval: int, first_offset: int) -> bytes:
+    """one sample per chunk, chunks back to back from first_offset"""
+    tables = full_box(b"stts", 0, struct.pack("> I I I", 1, sample_count, delta))
+    tables += full_box(b"stsz", 0, struct.pack("> I I", 0, sample_count) + struct.pack(f"> {sample_count}I", *([sample_size] * sample_count)))
+    tables += full_box(b"stsc", 0, struct.pack("> I I I I", 1, 1, 1, 1))
+    tables += full_box(b"stco", 0, struct.pack("> I", sample_count) + struct.pack(f"> {sample_count}I", *[first_offset + i * sample_size for i in range(sample_count)]))
+    if keyframe_interval > 0:
+        keyframes = list(range(1, sample_count + 1, keyframe_interval))
+        tables += full_box(b"stss", 0, struct.pack("> I", len(keyframes)) + struct.pack(f"> {len(keyframes)}I", *keyframes))
+    return tables
+
+
+def _track(track_id: int, handler_type: bytes, codec_tag: bytes, timescale: int, duration: int, tables: bytes, width: int = 0, height: int = 0) -> bytes:
+    tkhd = full_box(b"tkhd", 0, struct.pack("> I I I I I", CREATION_TIME, CREATION_TIME, track_id, 0, 0) + b"\0" * 60)
+    mdhd = full_box(b"mdhd", 0, struct.pack("> I I I I", CREATION_TIME, CREATION_TIME, timescale, duration) + b"\0" * 4)
+    hdlr = full_box(b"hdlr", 0, b"\0" * 4 + handler_type + b"\0" * 12 + b"\0")
+    sample_entry = b"\0" * 6 + struct.pack("> H", 1) + b"\0" * 16 + struct.pack("> H H", width, height) + b"\0" * 50
+    stsd = full_box(b"stsd", 0, struct.pack("> I", 1) + box(codec_tag, sample_entry))
+    return box(b"trak", tkhd + box(b"mdia", mdhd + hdlr + box(b"minf", box(b"stbl", stsd + tables))))
+
+
+def synthetic_template(seconds: float, fps: int = 30, telemetry_events: Optional[List[float]] = None) -> bytes:
+    """
+    a header only mp4 of a GoPro-like video, audio and gpmd track.
+    With telemetry_events the gpmd track has one telemetry sample per second in 'mdat', with events at these times
+    """
+    frames = int(seconds * fps)
+    mvhd = full_box(b"mvhd", 0, struct.pack("> I I I I", CREATION_TIME, CREATION_TIME, 1000, int(seconds * 1000)) + b"\0" * 80)
+    video = _track(1, b"vide", b"hvc1", 90000, int(seconds * 90000), _sample_tables(frames, 90000 // fps, 1000, fps, 1000), 3840, 2160)
+    audio = _track(2, b"soun", b"mp4a", 48000, int(seconds * 48000), _sample_tables(int(seconds * 10), 4800, 100, 0, 1000 + frames * 1000))
+    ftyp = box(b"ftyp", b"mp41")
+
+    payloads: List[bytes] = []
+    if telemetry_events is not None:
+        # whole seconds, every payload has the same size
+        payloads = [gpmf_telemetry(float(second), 1.0, telemetry_events) for second in range(math.ceil(seconds))]
+
+    def moov(first_offset: int) -> bytes:
+        tables = _sample_tables(len(payloads), 1000, len(payloads[0]), 0, first_offset) if len(payloads) > 0 else b""
+        gpmd = _track(3, b"meta", b"gpmd", 1000, int(seconds * 1000), tables)
+        return box(b"moov", mvhd + video + audio + gpmd)
+
+    # the offsets do not change the size of 'moov'
+    first_offset = len(ftyp) + len(moov(0)) + 8
+    return ftyp + moov(first_offset) + box(b"mdat", b"".join(payloads))
+
+
+def ffmpeg_template(seconds: float, fps: int = 30) -> bytes:
+    """a real, playable mp4 from ffmpeg's testsrc with a keyframe every second"""
+    with tempfile.TemporaryDirectory() as folder:
+        filename = os.path.join(folder, "template.mp4")
+        run_ffmpeg([
+            "-f", "lavfi", "-i", f"testsrc=size=320x240:rate={fps}:duration={seconds}", "-f", "lavfi", "-i", f"sine=duration={seconds}",
+            "-c:v", "mpeg4", "-g", f"{fps}", "-c:a", "aac", "-metadata", "creation_time=2022-04-28T12:00:00Z", "-y", filename,
+        ], duration=seconds)
+        with open(filename, "rb") as file:
+            return file.read()
+
+
+def _shift_chunk_offsets(moov: bytearray, start: int, end: int, delta: int) -> None:
+    """adds delta to every stco/co64 entry below the box [start, end) of moov"""
+    stream = io.BytesIO(bytes(moov))
+    for box_type, box_start, box_end in find_all_boxes(stream, start + 8, end):
+        if box_type in (b"trak", b"mdia", b"minf", b"stbl"):
+            _shift_chunk_offsets(moov, box_start, box_end, delta)
+        elif box_type in (b"stco", b"co64"):
+            entry_format = "> I" if box_type == b"stco" else "> Q"
+            entry_size = struct.calcsize(entry_format)
+            count = struct.unpack_from("> I", moov, box_start + 12)[0]
+            for index in range(count):
+                offset = box_start + 16 + index * entry_size
+                struct.pack_into(entry_format, moov, offset, struct.unpack_from(entry_format, moov, offset)[0] + delta)
+
+
+def inject_udta(mp4: bytes, udta: bytes) -> bytes:
+    """mp4 with its 'moov/udta' replaced by udta, chunk offsets moved if 'moov' comes before the media data"""
+    stream = io.BytesIO(mp4)
+    boxes = find_all_boxes(stream)
+    moov_start, moov_end = next((start, end) for box_type, start, end in boxes if box_type == b"moov")
+    assert struct.unpack_from("> I", mp4, moov_start)[0] == moov_end - moov_start, "moov with a 64 bit size"
+
+    children = b"".join(mp4[start:end] for box_type, start, end in find_all_boxes(stream, moov_start + 8, moov_end) if box_type != b"udta")
+    moov = bytearray(box(b"moov", children + udta))
+
+    if any(box_type == b"mdat" and start > moov_start for box_type, start, _ in boxes):
+        _shift_chunk_offsets(moov, 0, len(moov), len(moov) - (moov_end - moov_start))
+
+    return mp4[:moov_start] + bytes(moov) + mp4[moov_end:]
+
+
+def write_recordings(folder: str, chapters: int, chapters_per_recording: int = 10, hilights_per_chapter: float = 1.0, seconds: float = 10.0, template: Optional[bytes] = None, other_files: bool = True, seed: int = 0) -> List[str]:
+    """
+    writes 'chapters' chapters as GHccnnnn.MP4 recordings of up to 'chapters_per_recording' (at most 99) chapters,
+    with on average 'hilights_per_chapter' HiLights at random times.
+    other_files adds the .THM and .LRV files a GoPro writes next to each chapter.
+    returns the names of the chapters
+    """
+    assert 1 <= chapters_per_recording <= 99
+    if template is None:
+        template = synthetic_template(seconds)
+    rng = random.Random(seed)
+
+    os.makedirs(folder, exist_ok=True)
+    filenames = []
+    for index in range(chapters):
+        recording, chapter = divmod(index, chapters_per_recording)
+        hilight_count = int(hilights_per_chapter) + (1 if rng.random() < hilights_per_chapter % 1 else 0)
+        hilights_ms = sorted(rng.randrange(1, int(seconds * 1000)) for _ in range(hilight_count))
+
+        filename = os.path.join(folder, f"GH{chapter + 1:02}{recording + 1:04}.MP4")
+        with open(filename, "wb") as file:
+            file.write(inject_udta(template, gpmf_udta(hilights_ms)))
+        filenames.append(filename)
+
+        if other_files:
+            for other_name in (f"GH{chapter + 1:02}{recording + 1:04}.THM", f"GL{chapter + 1:02}{recording + 1:04}.LRV"):
+                with open(os.path.join(folder, other_name), "wb") as file:
+                    file.write(b"\0" * 64)
+
+    return filenames
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="writes synthetic GoPro recordings with HiLights")
+    parser.add_argument("-o", "--output", metavar="OUTPUT_FOLDER", required=True, help="folder to write the chapters to")
+    parser.add_argument("-n", "--chapters", metavar="CHAPTERS", type=int, default=10, help="number of chapters")
+    parser.add_argument("-per_rec", "--chapters_per_recording", metavar="CHAPTERS", type=int, default=10, help="chapters per recording, at most 99")
+    parser.add_argument("-hl", "--hilights_per_chapter", metavar="HILIGHTS", type=float, default=1.0, help="average number of HiLights per chapter")
+    parser.add_argument("-s", "--seconds", metavar="SECONDS", type=float, default=10.0, help="length of each chapter")
+    parser.add_argument("-synthetic", "--synthetic", action="store_true", help="write header only files instead of encoding a template with ffmpeg")
+    args = parser.parse_args()
+
+    template = synthetic_template(args.seconds) if args.synthetic or shutil.which("ffmpeg") is None else ffmpeg_template(args.seconds)
+    filenames = write_recordings(args.output, args.chapters, args.chapters_per_recording, args.hilights_per_chapter, args.seconds, template)
+    print(f"""wrote {len(filenames)} chapters to "{args.output}".""")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+GoPro file naming convention, used to pick and group video files by their name alone, before any of them is opened.
+https://community.gopro.com/s/article/GoPro-Camera-File-Naming-Convention?language=en_US
+
+HERO6 and later: GHccnnnn.MP4 (AVC) or GXccnnnn.MP4 (HEVC), cc is the chapter (01, 02, ...), nnnn the recording.
+HERO5 and earlier: GOPRnnnn.MP4 is the first chapter, GPccnnnn.MP4 the following ones (GP01nnnn is the second chapter).
+Thumbnails (.THM) and audio (.WAV) share these names, but are no candidates.
+Low resolution proxies (.LRV) are no candidates either, they are paired with their chapter instead:
+GLccnnnn.LRV belongs to GHccnnnn.MP4 or GXccnnnn.MP4, older cameras name it like the chapter (GOPRnnnn.LRV).
+"""
+
+import os
+import re
+from typing import Dict, List, Optional, Tuple, Union
+
+VIDEO_EXTENSIONS = (".mp4", ".mov")
+PROXY_EXTENSION = ".lrv"
+
+NAME_PATTERN = re.compile(
+    r"^(?:(?P<encoding>G[HXL])(?P<chapter>\d{2})|GOPR|GP(?P<old_chapter>\d{2}))(?P<recording>\d{4})\.[^.]+$",
+    re.IGNORECASE
+)
+
+RecordingKey = Tuple[str, str, Union[int, str]]
+
+
+class GoProName:
+    """
+    encoding, chapter and recording number of a file named by a GoPro
+    """
+    encoding: str  # "GH", "GX", "GL" for proxies or "GP" for the old scheme
+    chapter: int  # 1 based
+    recording: int
+
+    def __init__(self: 'GoProName', encoding: str, chapter: int, recording: int) -> None:
+        self.encoding = encoding
+        self.chapter = chapter
+        self.recording = recording
+
+    def __repr__(self: 'GoProName') -> str:
+        return f"GOPRO_NAME=[{self.encoding=}, {self.chapter=}, {self.recording=}]"
+
+
+def parse_gopro_name(filename: str) -> Optional[GoProName]:
+    """None if the base name of filename does not follow the naming convention"""
+    match = NAME_PATTERN.match(os.path.basename(filename))
+    if match is None:
+        return None
+    if match.group("encoding") is not None:
+        return GoProName(match.group("encoding").upper(), int(match.group("chapter")), int(match.group("recording")))
+    if match.group("old_chapter") is not None:
+        return GoProName("GP", int(match.group("old_chapter")) + 1, int(match.group("recording")))
+    return GoProName("GP", 1, int(match.group("recording")))
+
+
+def is_video_candidate(filename: str) -> bool:
+    """whether filename may be a video worth opening, judged by its name only"""
+    basename = os.path.basename(filename)
+    # hidden files include the "._" resource forks macOS writes next to every file
+    return not basename.startswith(".") and os.path.splitext(basename)[1].lower() in VIDEO_EXTENSIONS
+
+
+def is_proxy(filename: str) -> bool:
+    """whether filename is a low resolution proxy written by a GoPro, judged by its name only"""
+    basename = os.path.basename(filename)
+    return not basename.startswith(".") and os.path.splitext(basename)[1].lower() == PROXY_EXTENSION
+
+
+def get_proxy_key(filename: str) -> Tuple[str, str]:
+    """a chapter and its proxy share a key"""
+    name = parse_gopro_name(filename)
+    if name is not None and name.encoding != "GP":
+        return os.path.dirname(filename), f"{name.chapter:02}{name.recording:04}"
+    return os.path.dirname(filename), os.path.splitext(os.path.basename(filename))[0].upper()
+
+
+def pair_proxies(filenames: List[str]) -> Dict[str, str]:
+    """the proxy among filenames of each video candidate among filenames that has one"""
+    proxies = {get_proxy_key(filename): filename for filename in filenames if is_proxy(filename)}
+    pairs: Dict[str, str] = {}
+    for filename in filenames:
+        if is_video_candidate(filename):
+            proxy = proxies.get(get_proxy_key(filename))
+            if proxy is not None:
+                pairs[filename] = proxy
+    return pairs
+
+
+def get_recording_key(filename: str) -> RecordingKey:
+    """chapters of the same recording share a key, files not named by a GoPro are a recording of their own"""
+    name = parse_gopro_name(filename)
+    if name is None:
+        return os.path.dirname(filename), "", os.path.basename(filename)
+    return os.path.dirname(filename), name.encoding, name.recording
+
+
+def get_chapter(filename: str) -> int:
+    name = parse_gopro_name(filename)
+    return name.chapter if name is not None else 1
+
+
+def index_recordings(filenames: List[str]) -> List[List[str]]:
+    """filenames grouped into recordings sorted by chapter, recordings sorted by folder and first chapter name"""
+    recordings: Dict[RecordingKey, List[str]] = {}
+    for filename in filenames:
+        recordings.setdefault(get_recording_key(filename), []).append(filename)
+
+    chapters_lists = [sorted(chapters, key=lambda f: (get_chapter(f), f)) for chapters in recordings.values()]
+    return sorted(chapters_lists, key=lambda chapters: (os.path.dirname(chapters[0]), os.path.basename(chapters[0])))
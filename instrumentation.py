@@ -0,0 +1,183 @@
+"""
+Per stage wall and cpu times, counts and durations of the subprocesses launched, and bytes read and written per file.
+Everything is recorded into the module level 'Instrumentation', reported as json or as Prometheus textfile.
+"""
+
+import json
+import os
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from typing import ContextManager, Dict, Iterator, List, Optional
+
+PROMETHEUS_PREFIX = "gopro_dashcam"
+
+
+class StageStats:
+    runs: int
+    wall_seconds: float
+    cpu_seconds: float  # the thread running the stage
+    children_cpu_seconds: float  # subprocesses of any thread finished while the stage ran
+
+    def __init__(self: 'StageStats') -> None:
+        self.runs = 0
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.children_cpu_seconds = 0.0
+
+
+class SubprocessStats:
+    runs: int
+    failures: int
+    seconds: float
+
+    def __init__(self: 'SubprocessStats') -> None:
+        self.runs = 0
+        self.failures = 0
+        self.seconds = 0.0
+
+
+class Instrumentation:
+    """
+    thread safe, stages running in several threads at once add up their times.
+    The cpu time of a stage is that of its own thread, stages running at once do not count each other's
+    """
+    stages: Dict[str, StageStats]
+    subprocesses: Dict[str, SubprocessStats]  # by program
+    bytes_read: Dict[str, int]  # by file
+    bytes_written: Dict[str, int]  # by file
+
+    def __init__(self: 'Instrumentation') -> None:
+        self.stages = {}
+        self.subprocesses = {}
+        self.bytes_read = {}
+        self.bytes_written = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self: 'Instrumentation', name: str) -> Iterator[None]:
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        times_start = os.times()
+        try:
+            yield
+        finally:
+            times_end = os.times()
+            with self._lock:
+                stats = self.stages.setdefault(name, StageStats())
+                stats.runs += 1
+                stats.wall_seconds += time.perf_counter() - wall_start
+                stats.cpu_seconds += time.thread_time() - cpu_start
+                stats.children_cpu_seconds += (times_end.children_user + times_end.children_system) - (times_start.children_user + times_start.children_system)
+
+    def record_subprocess(self: 'Instrumentation', program: str, seconds: float, failed: bool) -> None:
+        with self._lock:
+            stats = self.subprocesses.setdefault(os.path.basename(program), SubprocessStats())
+            stats.runs += 1
+            stats.failures += 1 if failed else 0
+            stats.seconds += seconds
+
+    def record_read(self: 'Instrumentation', filename: str, size: int) -> None:
+        with self._lock:
+            self.bytes_read[filename] = self.bytes_read.get(filename, 0) + size
+
+    def record_written(self: 'Instrumentation', filename: str, size: int) -> None:
+        with self._lock:
+            self.bytes_written[filename] = self.bytes_written.get(filename, 0) + size
+
+    def merge(self: 'Instrumentation', data: Dict[str, Dict[str, object]]) -> None:
+        """adds a report of another process, e.g. a scan worker, as returned by 'to_json'"""
+        with self._lock:
+            for name, stage_data in data.get("stages", {}).items():
+                assert isinstance(stage_data, dict)
+                stats = self.stages.setdefault(name, StageStats())
+                stats.runs += int(stage_data["runs"])
+                stats.wall_seconds += float(stage_data["wall_seconds"])
+                stats.cpu_seconds += float(stage_data["cpu_seconds"])
+                stats.children_cpu_seconds += float(stage_data["children_cpu_seconds"])
+            for program, subprocess_data in data.get("subprocesses", {}).items():
+                assert isinstance(subprocess_data, dict)
+                subprocess_stats = self.subprocesses.setdefault(program, SubprocessStats())
+                subprocess_stats.runs += int(subprocess_data["runs"])
+                subprocess_stats.failures += int(subprocess_data["failures"])
+                subprocess_stats.seconds += float(subprocess_data["seconds"])
+            for filename, size in data.get("bytes_read", {}).items():
+                self.bytes_read[filename] = self.bytes_read.get(filename, 0) + int(str(size))
+            for filename, size in data.get("bytes_written", {}).items():
+                self.bytes_written[filename] = self.bytes_written.get(filename, 0) + int(str(size))
+
+    def reset(self: 'Instrumentation') -> None:
+        with self._lock:
+            self.stages.clear()
+            self.subprocesses.clear()
+            self.bytes_read.clear()
+            self.bytes_written.clear()
+
+    def to_json(self: 'Instrumentation') -> Dict[str, Dict[str, object]]:
+        with self._lock:
+            return {
+                "stages": {name: dict(vars(stats)) for name, stats in self.stages.items()},
+                "subprocesses": {program: dict(vars(stats)) for program, stats in self.subprocesses.items()},
+                "bytes_read": dict(self.bytes_read),
+                "bytes_written": dict(self.bytes_written),
+            }
+
+    def to_prometheus(self: 'Instrumentation') -> str:
+        """totals in the Prometheus text format, bytes are summed up over all files to keep the number of series small"""
+        lines: List[str] = []
+
+        def metric(name: str, help_text: str, values: Dict[str, float], label: str) -> None:
+            lines.append(f"# HELP {PROMETHEUS_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name} counter")
+            for key, value in sorted(values.items()):
+                label_text = f'{{{label}="{key}"}}' if label else ""
+                lines.append(f"{PROMETHEUS_PREFIX}_{name}{label_text} {value}")
+
+        with self._lock:
+            metric("stage_runs_total", "number of times a stage ran", {name: stats.runs for name, stats in self.stages.items()}, "stage")
+            metric("stage_wall_seconds_total", "wall time spent in a stage", {name: stats.wall_seconds for name, stats in self.stages.items()}, "stage")
+            metric("stage_cpu_seconds_total", "cpu time of the thread running a stage", {name: stats.cpu_seconds for name, stats in self.stages.items()}, "stage")
+            metric("stage_children_cpu_seconds_total", "cpu time of subprocesses finished while a stage ran", {name: stats.children_cpu_seconds for name, stats in self.stages.items()}, "stage")
+            metric("subprocess_runs_total", "number of subprocesses launched", {program: stats.runs for program, stats in self.subprocesses.items()}, "program")
+            metric("subprocess_failures_total", "number of subprocesses exiting with an error", {program: stats.failures for program, stats in self.subprocesses.items()}, "program")
+            metric("subprocess_seconds_total", "wall time subprocesses ran", {program: stats.seconds for program, stats in self.subprocesses.items()}, "program")
+            metric("read_bytes_total", "bytes read from input files", {"": sum(self.bytes_read.values())}, "")
+            metric("written_bytes_total", "bytes written to output files", {"": sum(self.bytes_written.values())}, "")
+
+        return "\n".join(lines) + "\n"
+
+
+instrumentation = Instrumentation()
+
+
+def stage(name: str) -> ContextManager[None]:
+    return instrumentation.stage(name)
+
+
+def run_subprocess(command: List[str], stdout: Optional[int] = None, stderr: Optional[int] = None) -> 'subprocess.CompletedProcess[bytes]':
+    """subprocess.run, counted and timed per program"""
+    start = time.perf_counter()
+    failed = True
+    try:
+        completed_process = subprocess.run(command, stdout=stdout, stderr=stderr)
+        failed = completed_process.returncode != 0
+        return completed_process
+    finally:
+        instrumentation.record_subprocess(command[0], time.perf_counter() - start, failed)
+
+
+def _write_atomically(filename: str, text: str) -> None:
+    # scrapers reading a textfile must never see half of it
+    temp_filename = f"{filename}.{os.getpid()}.tmp"
+    with open(temp_filename, "w") as file:
+        file.write(text)
+    os.replace(temp_filename, filename)
+
+
+def write_report(filename: str) -> None:
+    _write_atomically(filename, json.dumps(instrumentation.to_json(), indent=1, sort_keys=True) + "\n")
+
+
+def write_prometheus(filename: str) -> None:
+    _write_atomically(filename, instrumentation.to_prometheus())
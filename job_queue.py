@@ -0,0 +1,249 @@
+"""
+Job queue on a shared folder, for running the extractions of a plan on several processes or hosts without a broker.
+
+    QUEUE_DIR/pending/JOB.json          waiting to be claimed
+    QUEUE_DIR/claimed/JOB.WORKER.json   leased by WORKER, kept alive by touching it
+    QUEUE_DIR/done/JOB.json             result of a finished job
+    QUEUE_DIR/failed/JOB.json           error of a failed job
+
+Jobs are claimed and handed back by renaming their file, which only one process can do successfully.
+A lease not touched for 'lease_time' seconds is expired and the job is handed back to pending,
+so the jobs of a crashed worker are picked up by the others.
+"""
+
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+from typing import Dict, List, Optional
+
+from extraction import Extraction
+from staging import ScratchFolder, check_free_space, get_partial_name, publish, remove_if_exists  # NOQA
+
+QUEUE_FOLDERS = ("pending", "claimed", "done", "failed")
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def write_json_atomically(filename: str, data: Dict[str, object]) -> None:
+    temp_filename = f"{filename}.{default_worker_id()}.tmp"
+    with open(temp_filename, "w") as file:
+        json.dump(data, file, indent=1)
+    os.replace(temp_filename, filename)
+
+
+class LeaseLost(Exception):
+    """the lease of a job expired and the job was handed back, its result belongs to whoever runs it next"""
+
+
+class Lease:
+    """
+    a claimed job, touched every 'heartbeat_interval' seconds while it is used as a context manager
+    """
+    job_id: str
+    path: str
+    data: Dict[str, object]
+    heartbeat_interval: float
+    lost: bool
+
+    def __init__(self: 'Lease', job_id: str, path: str, data: Dict[str, object], heartbeat_interval: float) -> None:
+        self.job_id = job_id
+        self.path = path
+        self.data = data
+        self.heartbeat_interval = heartbeat_interval
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._heartbeat, name=f"lease-{job_id}", daemon=True)
+
+    def touch(self: 'Lease') -> None:
+        try:
+            os.utime(self.path)
+        except FileNotFoundError:
+            # expired and handed back, someone else may run the job too
+            self.lost = True
+
+    def check(self: 'Lease') -> None:
+        """touches the lease once more, raises LeaseLost if it is not held anymore"""
+        self.touch()
+        if self.lost:
+            raise LeaseLost(f"""the lease of job {self.job_id} expired, it was handed back""")
+
+    def _heartbeat(self: 'Lease') -> None:
+        while not self._stop.wait(self.heartbeat_interval):
+            self.touch()
+
+    def __enter__(self: 'Lease') -> 'Lease':
+        self._thread.start()
+        return self
+
+    def __exit__(self: 'Lease', *args: object) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+class JobQueue:
+    path: str
+    lease_time: float
+
+    def __init__(self: 'JobQueue', path: str, lease_time: float = 300) -> None:
+        self.path = path
+        self.lease_time = lease_time
+        for folder in QUEUE_FOLDERS:
+            os.makedirs(self.get_folder(folder), exist_ok=True)
+
+    def get_folder(self: 'JobQueue', folder: str) -> str:
+        return os.path.join(self.path, folder)
+
+    def list_jobs(self: 'JobQueue', folder: str) -> List[str]:
+        return sorted(name for name in os.listdir(self.get_folder(folder)) if name.endswith(".json"))
+
+    def enqueue(self: 'JobQueue', extractions: List[Extraction], parameters: Dict[str, object]) -> int:
+        """adds one job per extraction with something to extract, returns the number of jobs added"""
+        added = 0
+        for extraction in extractions:
+            out_name = extraction.get_out_name()
+            if out_name is None:
+                continue
+            # no dots, they separate the job from the worker in claimed file names
+            job_id = os.path.splitext(os.path.basename(out_name))[0].replace(".", "_")
+            write_json_atomically(os.path.join(self.get_folder("pending"), f"{job_id}.json"), {
+                "job_id": job_id,
+                "extraction": extraction.to_json(),
+                "parameters": parameters,
+            })
+            added += 1
+        return added
+
+    def claim(self: 'JobQueue', worker_id: str) -> Optional[Lease]:
+        """the first pending job this worker wins the rename race for, None if there is none"""
+        for name in self.list_jobs("pending"):
+            job_id = name[:-len(".json")]
+            claimed_path = os.path.join(self.get_folder("claimed"), f"{job_id}.{worker_id}.json")
+            try:
+                os.rename(os.path.join(self.get_folder("pending"), name), claimed_path)
+            except FileNotFoundError:
+                continue
+            os.utime(claimed_path)
+            with open(claimed_path, "r") as file:
+                data = json.load(file)
+            return Lease(job_id, claimed_path, data, heartbeat_interval=self.lease_time / 3)
+        return None
+
+    def requeue_expired(self: 'JobQueue') -> List[str]:
+        """hands jobs with expired leases back to pending, returns their ids"""
+        requeued = []
+        now = time.time()
+        for name in self.list_jobs("claimed"):
+            claimed_path = os.path.join(self.get_folder("claimed"), name)
+            try:
+                stat = os.stat(claimed_path)
+                # a rename only updates ctime, a heartbeat mtime
+                if now - max(stat.st_mtime, stat.st_ctime) < self.lease_time:
+                    continue
+                job_id = name.split(".", 1)[0]
+                os.rename(claimed_path, os.path.join(self.get_folder("pending"), f"{job_id}.json"))
+                requeued.append(job_id)
+            except FileNotFoundError:
+                continue
+        return requeued
+
+    def complete(self: 'JobQueue', lease: Lease, result: Dict[str, object]) -> None:
+        write_json_atomically(os.path.join(self.get_folder("done"), f"{lease.job_id}.json"), {**lease.data, "result": result})
+        self._release(lease)
+
+    def fail(self: 'JobQueue', lease: Lease, error: str) -> None:
+        write_json_atomically(os.path.join(self.get_folder("failed"), f"{lease.job_id}.json"), {**lease.data, "error": error})
+        self._release(lease)
+
+    @staticmethod
+    def _release(lease: Lease) -> None:
+        try:
+            os.remove(lease.path)
+        except FileNotFoundError:
+            pass
+
+    def get_counts(self: 'JobQueue') -> Dict[str, int]:
+        return {folder: len(self.list_jobs(folder)) for folder in QUEUE_FOLDERS}
+
+    def is_finished(self: 'JobQueue') -> bool:
+        counts = self.get_counts()
+        return counts["pending"] == 0 and counts["claimed"] == 0
+
+    def read_jobs(self: 'JobQueue', folder: str) -> List[Dict[str, object]]:
+        jobs = []
+        for name in self.list_jobs(folder):
+            try:
+                with open(os.path.join(self.get_folder(folder), name), "r") as file:
+                    jobs.append(json.load(file))
+            except (OSError, ValueError) as e:
+                print(f"""could not read job "{name}": {e}""", file=sys.stderr)
+        return jobs
+
+
+def run_job(lease: Lease, worker_id: str, scratch_path: Optional[str] = None) -> Dict[str, object]:
+    """runs the extraction of a job into a staged file, in scratch_path if given, then publishes it"""
+    extraction_data = lease.data["extraction"]
+    assert isinstance(extraction_data, dict)
+    extraction = Extraction.from_json(extraction_data)
+    out_name = extraction.get_out_name()
+    assert out_name is not None
+
+    with ScratchFolder(scratch_path) as staging_path:
+        extraction.scratch_path = staging_path
+        # hidden, so discovery ignores it when staged in the output folder
+        staged_name = get_partial_name(staging_path if staging_path is not None else extraction.output_path, out_name, worker_id)
+        check_free_space(os.path.dirname(staged_name), extraction.estimate_size(), f"""job {lease.job_id}""")
+        try:
+            written = extraction.create_extraction(out_name=staged_name)
+            assert written is not None
+            # the job may belong to another worker by now, its output must not be replaced
+            lease.check()
+            publish(written, out_name)
+        finally:
+            remove_if_exists(staged_name)
+
+    return {
+        "out_name": out_name,
+        "output_size": os.path.getsize(out_name),
+        "worker": worker_id,
+        "finished": time.time(),
+    }
+
+
+def run_worker(queue: JobQueue, worker_id: Optional[str] = None, poll_interval: float = 5, scratch_path: Optional[str] = None) -> int:
+    """
+    claims and runs jobs until no job is pending or claimed anymore,
+    returns the number of jobs this worker finished
+    """
+    if worker_id is None:
+        worker_id = default_worker_id()
+
+    finished = 0
+    while True:
+        lease = queue.claim(worker_id)
+        if lease is None:
+            queue.requeue_expired()
+            if queue.is_finished():
+                return finished
+            time.sleep(poll_interval)
+            continue
+
+        with lease:
+            print(f"""{worker_id}: running job {lease.job_id}""")
+            try:
+                result = run_job(lease, worker_id, scratch_path)
+                lease.check()
+                queue.complete(lease, result)
+                finished += 1
+            except LeaseLost as e:
+                # neither done nor failed, the worker now holding the job reports it
+                print(f"""{worker_id}: dropped the result of job {lease.job_id}: {e}""", file=sys.stderr)
+            except Exception as e:
+                print(f"""{worker_id}: job {lease.job_id} failed: {e}""", file=sys.stderr)
+                print(traceback.format_exc(), file=sys.stderr)
+                queue.fail(lease, f"{e!r}")
@@ -1,36 +1,76 @@
 #!/usr/bin/env python3
 
 import argparse
+import cProfile
 import itertools
 import os
-import subprocess
+import pstats
 import sys
 import textwrap
+import time
 import traceback
-from itertools import chain
 from pathlib import Path
-from typing import TYPE_CHECKING, Dict, Generator, Iterable, List, Optional, Set  # NOQA
+from typing import TYPE_CHECKING, Dict, List, Optional  # NOQA
 
-from more_itertools import pairwise
-from pymediainfo import MediaInfo
-
-from clip import Clip
+import probe_cache
+from executor import run_extractions
 from extraction import Extraction
-from run_bash import run_bash
+from ffconcat import concat_file_line
+from ffmpeg_runner import PipeInput, configure, run_ffmpeg
+from gopro_names import index_recordings, is_proxy, is_video_candidate, pair_proxies  # NOQA
+from instrumentation import stage, write_prometheus, write_report
+from job_queue import JobQueue, run_worker
+from manifest import MANIFEST_FILE_NAME, Manifest, clean_intermediary_files
+from plan import read_plan, write_plan
+from preview import create_previews
+from scan import discover_files, scan_files
+from staging import remove_if_exists
+from telemetry import configure as configure_telemetry
+from telemetry import numpy_available
+from telemetry_export import export_recordings
+from timeline import plan_recording_extractions
+from transcode import OUT_EXTENSION as TRANSCODE_EXTENSION
+from transcode import TranscodeSettings
+from transcode import configure as configure_transcode
+from transcode import parse_bitrate
 from video_file_data import VideoFileData
+from video_metadata import get_metadata
+from watch import StableFileWatcher
 
 if TYPE_CHECKING:
     from argparse import Action
 
+COMMANDS = ("run", "plan", "preview", "export", "execute", "enqueue", "work", "collect")
+PLANNING_COMMANDS = ("run", "plan", "preview")
+# commands scanning the input files
+SCANNING_COMMANDS = PLANNING_COMMANDS + ("export",)
+EXECUTING_COMMANDS = ("run", "execute")
+COMMAND_DESCRIPTIONS = {
+    "run": "Plans and runs the extractions (the default command).",
+    "plan": "Writes the extractions to a json plan file instead of running them.",
+    "preview": "Writes a low resolution preview clip and a contact sheet of every planned extraction, made from the GoPro's low resolution proxies (.LRV).",
+    "export": "Writes the telemetry (accelerometer, gyroscope, GPS) and HiLights of every recording into a compressed columnar NumPy file (.npz) for analyses, decoding only chapters changed since the last export. Needs NumPy.",
+    "execute": "Runs the extractions of a plan file written by the plan command, without probing anything.",
+    "enqueue": "Adds the extractions of a plan file as jobs to a queue folder on a shared filesystem.",
+    "work": "Claims and runs jobs from a queue folder until it is empty, start as many workers on as many hosts as wanted.",
+    "collect": "Waits until all jobs of a queue folder are done, hands back jobs of crashed workers and records the results in the manifest.",
+}
+QUEUE_COMMANDS = ("enqueue", "work", "collect")
+
+# functions printed by --profile, sorted by cumulative time
+PROFILE_TOP_ENTRIES = 25
+
+
+def parse_arguments(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """
+    'main.py [run] ...' plans and runs the extractions in one go,
+    'main.py plan ...' only writes the plan, 'main.py execute ...' runs a written plan
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    command = "run"
+    if len(argv) > 0 and argv[0] in COMMANDS:
+        command, argv = argv[0], argv[1:]
 
-def triplewise(iterable: Iterable) -> Generator:
-    "Return overlapping triplets from an iterable"
-    # triplewise('ABCDEFG') -> ABC BCD CDE DEF EFG
-    for (a, _), (b, c) in pairwise(pairwise(chain([None], iterable, [None]))):
-        yield a, b, c
-
-
-def parse_arguments() -> argparse.Namespace:
     class CustomHelpFormatter(argparse.HelpFormatter):
         def __init__(self: 'CustomHelpFormatter', prog: str) -> None:
             super().__init__(prog, max_help_position=8)
@@ -62,35 +102,58 @@ def parse_arguments() -> argparse.Namespace:
             return ret
 
     parser = argparse.ArgumentParser(
+        prog=f"{os.path.basename(sys.argv[0])} {command}",
         formatter_class=CustomHelpFormatter,
-        description="""
+        description=f"""
         GoPro Dashcam toolkit.
         Find and print HiLight tags for GoPro videos.
+        {COMMAND_DESCRIPTIONS[command]}
         """,
         add_help=False
     )
 
     requiredNamed = parser.add_argument_group('required named arguments')
 
-    requiredNamed.add_argument(
-        "-i",
-        "--input",
-        metavar="INPUT_PATH(s)",
-        required=True,
-        help="Folder(s) to search for videos (recursively)",
-        type=str,
-        nargs='+',
-        action="append"
-    )
-
-    requiredNamed.add_argument(
-        "-o",
-        "--output",
-        metavar="OUTPUT_FOLDER",
-        required=True,
-        help="output video folder, where to put the extracted clips and intermediary files",
-        type=str
-    )
+    if command in SCANNING_COMMANDS:
+        requiredNamed.add_argument(
+            "-i",
+            "--input",
+            metavar="INPUT_PATH(s)",
+            required=True,
+            help="Folder(s) to search for videos (recursively)",
+            type=str,
+            nargs='+',
+            action="append"
+        )
+
+        requiredNamed.add_argument(
+            "-o",
+            "--output",
+            metavar="OUTPUT_FOLDER",
+            required=True,
+            help="output video folder, where to put the extracted clips and intermediary files",
+            type=str
+        )
+
+    if command in ("plan", "execute", "enqueue"):
+        requiredNamed.add_argument(
+            "-plan",
+            "--plan_file",
+            metavar="PLAN_FILE",
+            required=True,
+            help="json file the extraction plan is written to (plan) or read from (execute, enqueue)",
+            type=str
+        )
+
+    if command in QUEUE_COMMANDS:
+        requiredNamed.add_argument(
+            "-queue",
+            "--queue_dir",
+            metavar="QUEUE_DIR",
+            required=True,
+            help="folder on a filesystem shared by all workers, holding the jobs",
+            type=str
+        )
 
     optionalArgs = parser.add_argument_group('optional arguments:')
     optionalArgs.add_argument(
@@ -100,25 +163,284 @@ def parse_arguments() -> argparse.Namespace:
         help="show this help message and exit"
     )
 
+    if command in PLANNING_COMMANDS:
+        optionalArgs.add_argument(
+            "-pre_t",
+            "--pre_time",
+            metavar="TIME_BEFORE",
+            help="timespan to include before a HiLight mark, in seconds.",
+            type=float,
+            default=30
+        )
+
+        optionalArgs.add_argument(
+            "-post_t",
+            "--post_time",
+            metavar="TIME_AFTER",
+            help="timespan to include after a HiLight mark, in seconds.",
+            type=float,
+            default=10
+        )
+
+        optionalArgs.add_argument(
+            "-direct",
+            "--direct_concat",
+            help="combine clips spanning several files straight from the source files (concat inpoint/outpoint), without writing intermediary clip files.",
+            action="store_true"
+        )
+
+        optionalArgs.add_argument(
+            "-no_snap",
+            "--no_keyframe_snap",
+            help="do not move the start of clips onto the keyframes a stream copy really starts at, chapter markers may then be off by up to one GOP.",
+            action="store_true"
+        )
+
+        optionalArgs.add_argument(
+            "-smart",
+            "--smart_cut",
+            help="cut exactly at the requested times: re-encode only the partial GOPs at both ends of each clip and stream copy the rest. Needs ffmpeg with libx264/libx265, replaces -direct and -no_snap.",
+            action="store_true"
+        )
+
+        optionalArgs.add_argument(
+            "-transcode",
+            "--transcode",
+            help=f"write small H.264/AAC {TRANSCODE_EXTENSION} files instead of stream copies, e.g. for sharing. The timeline is encoded in chunks split at keyframes, several at once (see -tc_j), and cut exactly. Replaces -direct, -no_snap and -smart.",
+            action="store_true"
+        )
+
+        optionalArgs.add_argument(
+            "-tc_preset",
+            "--transcode_preset",
+            metavar="PRESET",
+            help="x264 preset of -transcode, from ultrafast to veryslow: slower presets give better quality at the same bitrate.",
+            type=str,
+            default="medium"
+        )
+
+        optionalArgs.add_argument(
+            "-tc_bitrate",
+            "--transcode_bitrate",
+            metavar="BITRATE",
+            help="video bitrate of -transcode in bits per second, e.g. 6M or 2500k.",
+            type=parse_bitrate,
+            default="6M"
+        )
+
+        optionalArgs.add_argument(
+            "-tc_height",
+            "--transcode_height",
+            metavar="HEIGHT",
+            help="-transcode scales taller videos down to this height, 0 keeps their size.",
+            type=int,
+            default=1080
+        )
+
+    if command in SCANNING_COMMANDS:
+        optionalArgs.add_argument(
+            "-events",
+            "--telemetry_events",
+            help="also extract hard braking, impacts and spins nobody marked, detected in the telemetry (accelerometer, gyroscope and GPS) of the videos, as virtual HiLights. Needs NumPy.",
+            action="store_true"
+        )
+
+        optionalArgs.add_argument(
+            "-scan_j",
+            "--scan_jobs",
+            metavar="JOBS",
+            help="number of processes probing input files and parsing their HiLights.",
+            type=int,
+            default=os.cpu_count() or 1
+        )
+
+        optionalArgs.add_argument(
+            "-cache",
+            "--cache_file",
+            metavar="CACHE_FILE",
+            help="sqlite file caching probed file metadata and HiLights between runs, keyed by path, size and mtime.\nAn empty string disables the cache.",
+            type=str,
+            default=probe_cache.default_cache_path()
+        )
+
+        optionalArgs.add_argument(
+            "-cache_age",
+            "--cache_max_age",
+            metavar="DAYS",
+            help="drop cache entries not used for this many days.",
+            type=float,
+            default=90
+        )
+
+        optionalArgs.add_argument(
+            "-cache_n",
+            "--cache_max_entries",
+            metavar="ENTRIES",
+            help="keep at most this many (most recently used) cache entries.",
+            type=int,
+            default=100000
+        )
+
+    if command in EXECUTING_COMMANDS + ("preview",):
+        optionalArgs.add_argument(
+            "-j",
+            "--jobs",
+            metavar="JOBS",
+            help="number of extractions to run at the same time.",
+            type=int,
+            default=1
+        )
+
+    if command in EXECUTING_COMMANDS:
+        optionalArgs.add_argument(
+            "-dev_j",
+            "--device_jobs",
+            metavar="JOBS",
+            help="number of extractions reading from the same source device (e.g. sd-card) at the same time.",
+            type=int,
+            default=1
+        )
+
+        optionalArgs.add_argument(
+            "-no_manifest",
+            "--no_manifest",
+            help=f"re-extract everything instead of skipping extractions recorded as up to date in the manifest ({MANIFEST_FILE_NAME}) of the output folder.",
+            action="store_true"
+        )
+
+    if command in EXECUTING_COMMANDS + ("work",):
+        optionalArgs.add_argument(
+            "-scratch",
+            "--scratch_dir",
+            metavar="SCRATCH_DIR",
+            help="folder for intermediary clips and unfinished outputs, e.g. on a local ssd or tmpfs. Finished outputs are moved into the output folder at once.",
+            type=str,
+            default=None
+        )
+
+        optionalArgs.add_argument(
+            "-tc_j",
+            "--transcode_jobs",
+            metavar="JOBS",
+            help="number of chunks of a transcoded extraction encoded at the same time, each encoder gets an equal share of the cpu cores.",
+            type=int,
+            default=os.cpu_count() or 1
+        )
+
+    if command in EXECUTING_COMMANDS + ("work", "preview"):
+        optionalArgs.add_argument(
+            "-ff_timeout",
+            "--ffmpeg_timeout",
+            metavar="SECONDS",
+            help="kill an ffmpeg running longer than this and fail its extraction.",
+            type=float,
+            default=None
+        )
+
+        optionalArgs.add_argument(
+            "-progress",
+            "--progress",
+            help="print the progress, throughput and eta of running ffmpegs.",
+            action="store_true"
+        )
+
+    if command == "preview":
+        optionalArgs.add_argument(
+            "-preview_dir",
+            "--preview_dir",
+            metavar="PREVIEW_FOLDER",
+            help="folder for the preview clips and contact sheets, the subfolder 'previews' of the output folder if not given.",
+            type=str,
+            default=None
+        )
+
+    if command in ("work", "collect"):
+        optionalArgs.add_argument(
+            "-lease",
+            "--lease_time",
+            metavar="SECONDS",
+            help="a claimed job not kept alive by its worker for this long is handed to another worker.",
+            type=float,
+            default=300
+        )
+
+        optionalArgs.add_argument(
+            "-poll",
+            "--poll_interval",
+            metavar="SECONDS",
+            help="time between two looks at the queue while waiting for jobs.",
+            type=float,
+            default=5
+        )
+
+    if command == "collect":
+        optionalArgs.add_argument(
+            "-no_manifest",
+            "--no_manifest",
+            help=f"do not record the finished jobs in the manifest ({MANIFEST_FILE_NAME}) of their output folder.",
+            action="store_true"
+        )
+
+    if command in ("run",):
+        optionalArgs.add_argument(
+            "-watch",
+            "--watch",
+            help="keep running and extract the HiLights of new files appearing in the input paths, e.g. while sd-cards are dumped into them. Always uses the manifest.",
+            action="store_true"
+        )
+
+        optionalArgs.add_argument(
+            "-watch_i",
+            "--watch_interval",
+            metavar="SECONDS",
+            help="time between two looks at the input paths in watch mode.",
+            type=float,
+            default=5
+        )
+
+        optionalArgs.add_argument(
+            "-watch_settle",
+            "--watch_settle_time",
+            metavar="SECONDS",
+            help="time a new file's size and modification time must stay unchanged before it is ingested in watch mode.",
+            type=float,
+            default=10
+        )
+
+    optionalArgs.add_argument(
+        "-report",
+        "--report",
+        metavar="REPORT_FILE",
+        help="write wall and cpu times per stage (cpu of the thread running the stage), subprocess counts and bytes read and written per file as json.",
+        type=str,
+        default=None
+    )
+
     optionalArgs.add_argument(
-        "-pre_t",
-        "--pre_time",
-        metavar="TIME_BEFORE",
-        help="timespan to include before a HiLight mark, in seconds.",
-        type=float,
-        default=30
+        "-prom",
+        "--prometheus",
+        metavar="PROM_FILE",
+        help="write the same totals in the Prometheus text format, e.g. for the node exporter's textfile collector.",
+        type=str,
+        default=None
     )
 
     optionalArgs.add_argument(
-        "-post_t",
-        "--post_time",
-        metavar="TIME_AFTER",
-        help="timespan to include after a HiLight mark, in seconds.",
-        type=float,
-        default=10
+        "-profile",
+        "--profile",
+        metavar="PROFILE_FILE",
+        help="run under cProfile, dump the stats to PROFILE_FILE and print the slowest functions.",
+        type=str,
+        default=None
     )
 
-    return parser.parse_args()
+    args = parser.parse_args(argv)
+    args.command = command
+    if getattr(args, "telemetry_events", False) and not numpy_available():
+        parser.error("-events needs NumPy, install it with 'pip install numpy'")
+    if command == "export" and not numpy_available():
+        parser.error("export needs NumPy, install it with 'pip install numpy'")
+    return args
 
 
 def is_existing_file(filename: str) -> bool:
@@ -129,70 +451,45 @@ def is_existing_file(filename: str) -> bool:
     )
 
 
-def get_date_taken(filename: str) -> str:
-    p = subprocess.Popen(
-        [
-            "ffprobe",
-            "-v", "quiet",
-            "-select_streams",
-            "v:0",
-            "-show_entries",
-            "stream_tags=creation_time",
-            "-of", "default=noprint_wrappers=1:nokey=1",
-            filename
-        ],
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE)
-    stdout, _ = p.communicate()
-    return stdout.decode("ascii")[:10]
+def is_video_file(filename: str) -> bool:
+    return get_metadata(filename).is_video()
 
 
-def is_video_file(filename: str) -> bool:
-    fileInfo = MediaInfo.parse(filename)
-    for track in fileInfo.tracks:
-        if track.track_type == "Video":
-            return True
-    return False
-
-
-def split_file_list_single_recording(lst: List[str]) -> List[List[VideoFileData]]:
-    folder_dict: Dict[str, Set[str]] = dict()
-    for abs_name in lst:
-        filename = os.path.basename(abs_name)
-        if abs_name.endswith(filename):
-            if abs_name[:-len(filename)] not in folder_dict:
-                folder_dict[abs_name[:-len(filename)]] = set()
-            folder_dict[abs_name[:-len(filename)]].add(abs_name)
-
-    folder_content_list = []
-    for _, folder_set in folder_dict.items():
-        folder_content_list.append(sorted(list(folder_set)))
+def select_video_candidates(lst: List[str]) -> List[str]:
+    """the files of lst that may be videos by their name, without opening any of them"""
+    candidates = [filename for filename in lst if is_video_candidate(filename)]
+    ignored = len(lst) - len(candidates) - sum(1 for filename in lst if is_proxy(filename))
+    if ignored > 0:
+        print(f"""ignoring {ignored} input file(s) that are no videos by their name.""", file=sys.stderr)
+    return candidates
 
-    result_lists = []
-    for folder in folder_content_list:
-        groups: Dict[str, Set[str]] = dict()
-        for file in folder:
-            filename = os.path.basename(file)
-            # https://community.gopro.com/s/article/GoPro-Camera-File-Naming-Convention?language=en_US
-            group_name = filename[0:4]
-            if group_name not in groups:
-                groups[group_name] = set()
-            if is_video_file(file):
-                groups[group_name].add(file)
-            else:
-                print(f"""Input file "{file}" is not a video file! ignoring it.""", file=sys.stderr)
 
-        for group_name, group_set in groups.items():
-            result_lists.append([VideoFileData(filename) for filename in sorted(list(group_set))])
+def split_file_list_single_recording(lst: List[str], jobs: int = 1) -> List[List[VideoFileData]]:
+    candidates = select_video_candidates(lst)
+    scanned = scan_files(candidates, jobs=jobs)
+    # proxies are never probed, they are known by their names
+    for filename, proxy_filename in pair_proxies(lst).items():
+        video_file_data = scanned.get(filename)
+        if video_file_data is not None:
+            video_file_data.proxy_filename = proxy_filename
+    return group_recordings(candidates, scanned)
 
-    return result_lists
 
+def group_recordings(lst: List[str], scanned: Dict[str, Optional[VideoFileData]]) -> List[List[VideoFileData]]:
+    """groups the scanned files of lst into recordings by their names, sorted by chapter"""
+    result_lists = []
+    for recording in index_recordings(lst):
+        chapters = []
+        for filename in recording:
+            video_file_data = scanned.get(filename)
+            if video_file_data is not None:
+                chapters.append(video_file_data)
+            else:
+                print(f"""Input file "{filename}" is not a video file! ignoring it.""", file=sys.stderr)
+        if len(chapters) > 0:
+            result_lists.append(chapters)
 
-def get_files_in_folder(folder: str) -> Iterable[str]:
-    for dirpath, _, filenames in os.walk(folder):
-        for f in filenames:
-            yield os.path.abspath(os.path.join(dirpath, f))
+    return result_lists
 
 
 def extract_clip(video_file_data: VideoFileData, out_name: Optional[str], start: float = 0.0, end: Optional[float] = None) -> str:
@@ -216,36 +513,185 @@ def extract_clip(video_file_data: VideoFileData, out_name: Optional[str], start:
         end = video_file_data.get_video_length()
         print(f"""end={end} is greater than clip length {video_file_data.get_video_length()}, setting to clip length.""", file=sys.stderr)
 
-    start_time = "" if start == 0.0 else f"-ss {start}"
-    duration = end - start if end is not None else 0
-    end_time = f"-t {duration}" if end is not None and end < video_file_data.get_video_length() else ""
-    run_bash(f"""ffmpeg -hide_banner -loglevel error -stats -i "{video_file_data.abs_filename}" {start_time} {end_time} -codec copy "{out_name}" -y""".replace("  ", " "))
+    start_time = [] if start == 0.0 else ["-ss", f"{start}"]
+    duration = end - start if end is not None else video_file_data.get_video_length() - start
+    end_time = ["-t", f"{duration}"] if end is not None and end < video_file_data.get_video_length() else []
+    run_ffmpeg(["-y", "-i", video_file_data.abs_filename, *start_time, *end_time, "-codec", "copy", out_name], duration=duration)
     return out_name
 
 
 def combine_clips(file_name_first: str, file_name_second: str, file_name_combined: Optional[str] = None) -> str:
     if file_name_combined is None:
         file_name_combined = f"{file_name_first}.combine.{file_name_second}"
-    list_name = f"{file_name_combined}.ffmpeg_combine_list"
 
-    # setup list of files to be combined for ffmpeg
-    run_bash(f"""echo "" > {list_name}""")
-    run_bash(f"""echo "file '{file_name_first}'" >> {list_name}""")
-    run_bash(f"""echo "file '{file_name_second}'" >> {list_name}""")
-
-    # combine
-    run_bash(f"""ffmpeg -hide_banner -loglevel error -stats -f concat -safe 0 -i {list_name} -c copy {file_name_combined} -y""")
+    # combine, the list of files is piped to ffmpeg
+    combine_list = concat_file_line(file_name_first) + concat_file_line(file_name_second)
+    run_ffmpeg(["-y", "-f", "concat", "-safe", "0", "-protocol_whitelist", "file,pipe", "-i", PipeInput(combine_list), "-c", "copy", file_name_combined])
 
     # cleanup
-    run_bash(f"rm -f {file_name_first} {file_name_second}")
-    run_bash(f"""rm {list_name}""")
+    for filename in (file_name_first, file_name_second):
+        remove_if_exists(filename)
     return file_name_combined
 
 
+def get_transcode_settings(args: argparse.Namespace) -> Optional[TranscodeSettings]:
+    if not args.transcode:
+        return None
+    return TranscodeSettings(preset=args.transcode_preset, video_bitrate=args.transcode_bitrate, max_height=args.transcode_height if args.transcode_height > 0 else None)
+
+
+def plan_extractions(recordings: List[List[VideoFileData]], args: argparse.Namespace, output_path: str) -> List[Extraction]:
+    all_extractions: List[Extraction] = []
+    for recording in recordings:
+        all_extractions.extend(plan_recording_extractions(
+            recording,
+            output_path,
+            time_before=args.pre_time,
+            time_after=args.post_time,
+            direct_concat=args.direct_concat,
+            keyframe_snap=not args.no_keyframe_snap,
+            smart_cut=args.smart_cut,
+            transcode=get_transcode_settings(args),
+        ))
+
+    estimated_sizes = [extraction.estimate_size() for extraction in all_extractions]
+    if len(estimated_sizes) > 0 and None not in estimated_sizes:
+        print(f"""planned {len(all_extractions)} extractions, about {sum(size or 0 for size in estimated_sizes) / 2**20:.0f} MiB""")
+
+    return all_extractions
+
+
+def watch_inputs(args: argparse.Namespace, input_folders: List[str], input_filenames: List[str], output_path: str, manifest: Manifest, parameters: Dict[str, object]) -> None:
+    """
+    extracts the HiLights of new files in the input paths as they arrive, until interrupted.
+    Only recordings with new chapters are planned again, the manifest skips their extractions that are already done.
+    """
+    watcher = StableFileWatcher(input_folders, input_filenames, settle_time=args.watch_settle_time)
+    scanned: Dict[str, Optional[VideoFileData]] = dict()
+    print(f"""watching {len(input_folders) + len(input_filenames)} input path(s) for new files, stop with ctrl+c.""")
+    try:
+        while True:
+            new_files = watcher.poll()
+            if len(new_files) > 0:
+                scanned.update(scan_files(new_files, jobs=args.scan_jobs))
+                new_files_set = set(new_files)
+                # previously ingested chapters are grouped again, so a new chapter can reach into earlier ones
+                recordings = group_recordings(sorted(filename for filename, data in scanned.items() if data is not None or filename in new_files_set), scanned)
+                recordings = [recording for recording in recordings if any(video_file_data.abs_filename in new_files_set for video_file_data in recording)]
+                run_extractions(plan_extractions(recordings, args, output_path), jobs=args.jobs, jobs_per_device=args.device_jobs, manifest=manifest, parameters=parameters, scratch_path=args.scratch_dir)
+            time.sleep(args.watch_interval)
+    except KeyboardInterrupt:
+        print("stopped watching.")
+
+
+def export_telemetry(args: argparse.Namespace, input_folders: List[str], input_filenames: List[str], output_path: str) -> None:
+    with stage("discover"):
+        input_filenames = input_filenames + discover_files(input_folders, jobs=args.scan_jobs)
+
+    with stage("scan"):
+        recordings = split_file_list_single_recording([filename for filename in input_filenames if os.path.exists(filename)], jobs=args.scan_jobs)
+
+    written = export_recordings(recordings, output_path)
+    print(f"""exported the telemetry of {len(written)} of {len(recordings)} recordings to "{output_path}", the others were up to date or failed.""")
+
+
+def execute_plan(args: argparse.Namespace) -> None:
+    extractions, parameters, estimated_bytes = read_plan(args.plan_file)
+    if estimated_bytes is not None:
+        print(f"""executing {len(extractions)} extractions, about {estimated_bytes / 2**20:.0f} MiB""")
+
+    manifest: Optional[Manifest] = None
+    if not args.no_manifest:
+        for output_path in sorted({extraction.output_path for extraction in extractions}):
+            Path(output_path).mkdir(parents=True, exist_ok=True)
+            for filename in clean_intermediary_files(output_path):
+                print(f"""removed intermediary file "{filename}" left behind by an earlier run.""", file=sys.stderr)
+        if len(extractions) > 0:
+            manifest = Manifest(extractions[0].output_path)
+
+    run_extractions(extractions, jobs=args.jobs, jobs_per_device=args.device_jobs, manifest=manifest, parameters=parameters, scratch_path=args.scratch_dir)
+
+
+def run_queue_command(args: argparse.Namespace) -> None:
+    if args.command == "enqueue":
+        queue = JobQueue(args.queue_dir)
+        extractions, parameters, _ = read_plan(args.plan_file)
+        print(f"""added {queue.enqueue(extractions, parameters)} jobs to "{args.queue_dir}".""")
+        return
+
+    queue = JobQueue(args.queue_dir, lease_time=args.lease_time)
+    if args.command == "work":
+        print(f"""finished {run_worker(queue, poll_interval=args.poll_interval, scratch_path=args.scratch_dir)} jobs.""")
+        return
+
+    # collect
+    while not queue.is_finished():
+        for job_id in queue.requeue_expired():
+            print(f"""lease of job {job_id} expired, handed it back.""", file=sys.stderr)
+        time.sleep(args.poll_interval)
+
+    manifests: Dict[str, Manifest] = dict()
+    try:
+        for job in queue.read_jobs("done"):
+            result = job["result"]
+            extraction_data = job["extraction"]
+            job_parameters = job["parameters"]
+            assert isinstance(result, dict)
+            assert isinstance(extraction_data, dict)
+            assert isinstance(job_parameters, dict)
+            print(f"""done: {result["out_name"]} ({result["worker"]})""")
+            if not args.no_manifest:
+                extraction = Extraction.from_json(extraction_data)
+                if extraction.output_path not in manifests:
+                    manifests[extraction.output_path] = Manifest(extraction.output_path)
+                manifests[extraction.output_path].record(extraction, result["out_name"], job_parameters)
+    finally:
+        for manifest in manifests.values():
+            manifest.flush()
+    for job in queue.read_jobs("failed"):
+        print(f"""failed: job {job["job_id"]}: {job["error"]}""", file=sys.stderr)
+
+
 def main() -> None:
     args = parse_arguments()
     # print(args)
 
+    try:
+        if args.profile is not None:
+            profiler = cProfile.Profile()
+            try:
+                profiler.runcall(run_command, args)
+            finally:
+                profiler.dump_stats(args.profile)
+                pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(PROFILE_TOP_ENTRIES)
+        else:
+            run_command(args)
+    finally:
+        if args.report is not None:
+            write_report(args.report)
+        if args.prometheus is not None:
+            write_prometheus(args.prometheus)
+
+
+def run_command(args: argparse.Namespace) -> None:
+    if args.command in EXECUTING_COMMANDS + ("work", "preview"):
+        configure(max_concurrency=getattr(args, "jobs", 1), timeout=args.ffmpeg_timeout, show_progress=args.progress)
+    if args.command in EXECUTING_COMMANDS + ("work",):
+        configure_transcode(jobs=args.transcode_jobs)
+
+    if args.command == "execute":
+        execute_plan(args)
+        return
+
+    if args.command in QUEUE_COMMANDS:
+        run_queue_command(args)
+        return
+
+    configure_telemetry(detect_events=args.telemetry_events)
+
+    if args.cache_file != "":
+        probe_cache.open_cache(args.cache_file, max_entries=args.cache_max_entries, max_age=args.cache_max_age * 24 * 3600)
+
     input_paths: List[str] = list(itertools.chain.from_iterable(args.input))
     output_path: str = args.output
 
@@ -263,111 +709,75 @@ def main() -> None:
             raise ValueError(f"""Input Path "{input_path}" does not exist!""")
 
     input_filenames: list = []
+    input_folders: List[str] = []
     for input_path in input_paths:
         input_path = os.path.abspath(input_path)
         if is_existing_file(input_path):
             input_filenames.append(input_path)
         else:
-            input_filenames.extend(get_files_in_folder(input_path))
-
-    input_filenames = [filename if os.path.exists(filename) else print(f"""Input filename "{filename}" does not exist!""", file=sys.stderr) for filename in input_filenames if os.path.exists(filename)]
+            input_folders.append(input_path)
 
-    input_recordings_VideoFileData: List[List[VideoFileData]] = split_file_list_single_recording(input_filenames)
+    if args.command == "export":
+        export_telemetry(args, input_folders, input_filenames, output_path)
+        return
 
     time_before: float = args.pre_time
     time_after: float = args.post_time
 
-    Path(output_path).mkdir(parents=True, exist_ok=True)
+    parameters: Dict[str, object] = {
+        "pre_time": time_before,
+        "post_time": time_after,
+        "direct_concat": args.direct_concat,
+    }
+    if args.smart_cut:
+        # only when set, outputs recorded before smart cuts existed stay up to date
+        parameters["smart_cut"] = True
+    if args.no_keyframe_snap:
+        # likewise only when disabled, snapping is the default outputs were recorded with
+        parameters["keyframe_snap"] = False
+    if args.telemetry_events:
+        parameters["telemetry_events"] = True
+    transcode_settings = get_transcode_settings(args)
+    if transcode_settings is not None:
+        parameters["transcode"] = transcode_settings.to_json()
+
+    manifest: Optional[Manifest] = None
+    if args.command == "run":
+        Path(output_path).mkdir(parents=True, exist_ok=True)
+
+        if not args.no_manifest or args.watch:
+            manifest = Manifest(output_path)
+            for filename in clean_intermediary_files(output_path):
+                print(f"""removed intermediary file "{filename}" left behind by an earlier run.""", file=sys.stderr)
+
+        if args.watch:
+            assert manifest is not None
+            watch_inputs(args, input_folders, input_filenames, output_path, manifest, parameters)
+            return
+
+    with stage("discover"):
+        input_filenames.extend(discover_files(input_folders, jobs=args.scan_jobs))
 
-    for recording in input_recordings_VideoFileData:
-        total_clips: int = 0
-        for video_file in recording:
-            total_clips += len(video_file.get_hilights())
-        total_clips = max(len(str(total_clips)), 2)
+    input_filenames = [filename if os.path.exists(filename) else print(f"""Input filename "{filename}" does not exist!""", file=sys.stderr) for filename in input_filenames if os.path.exists(filename)]
 
-        clips: List[Clip] = []
+    with stage("scan"):
+        input_recordings_VideoFileData: List[List[VideoFileData]] = split_file_list_single_recording(input_filenames, jobs=args.scan_jobs)
 
-        previous_video_file_data: Optional[VideoFileData]
-        video_file_data: VideoFileData
-        next_video_file_data: Optional[VideoFileData]
-        for previous_video_file_data, video_file_data, next_video_file_data in triplewise(recording):
-            try:
-                if len(video_file_data.get_hilights()) == 0:
-                    continue
-
-                for hilight_time in video_file_data.get_hilights():
-                    hilight_start = hilight_time - time_before
-                    hilight_end = hilight_time + time_after
-
-                    # use previous clip
-                    if previous_video_file_data is not None and hilight_start < 0:
-                        # assumes overhang into previous clip is shorter than the previous clip is long
-                        # otherwise only all of the previous clip will be used
-                        assert previous_video_file_data.get_video_length() + hilight_start >= 0
-
-                        clips.append(
-                            Clip(
-                                previous_video_file_data.abs_filename,
-                                start=previous_video_file_data.get_video_length() + hilight_start,
-                                end=previous_video_file_data.get_video_length() + hilight_end,
-                                hilight_pos=+1,
-                                hilight_time=hilight_time,
-                            )
-                        )
-
-                    # use the clip where the hilight is
-                    clips.append(
-                        Clip(
-                            video_file_data.abs_filename,
-                            start=hilight_start,
-                            end=hilight_end,
-                            hilight_pos=0,
-                            hilight_time=hilight_time,
-                        )
-                    )
-
-                    # use next clip
-                    if next_video_file_data is not None and hilight_end > video_file_data.get_video_length():
-                        # clip length depends on this clip, not the next
-                        # thus subtract this clip length from clip end and start to get the
-                        # start and end times in the next clip, no matter how long it is
-
-                        # assumes overhang into next clip is shorter than the next clip is long
-                        # otherwise only all of the next clip will be used
-                        assert -video_file_data.get_video_length() + hilight_end <= next_video_file_data.get_video_length()
-
-                        clips.append(
-                            Clip(
-                                next_video_file_data.abs_filename,
-                                start=-video_file_data.get_video_length() + hilight_start,
-                                end=-video_file_data.get_video_length() + hilight_end,
-                                hilight_pos=-1,
-                                hilight_time=hilight_time,
-                            )
-                        )
-
-            except Exception as e:
-                print(e, file=sys.stderr)
-
-        clips.sort()
-
-        clip: Clip
-        next_clip: Optional[Clip]
-        extractions: List[Extraction] = []  # per recording
-        extraction_number = 0
-        current_extraction = Extraction(extraction_number=extraction_number, output_path=output_path)
-
-        for clip, next_clip in pairwise(chain(clips, [None])):
-            current_extraction.add_clip(clip)
-            if (
-                next_clip is None  # no next clip to add, stop
-                or not clip.overlaps(next_clip)  # clips not overlapping, start next extraction
-            ):
-                extractions.append(current_extraction)  # finish compiling clips in extraction
-                current_extraction = Extraction(extraction_number=(extraction_number := extraction_number + 1), output_path=output_path)  # reset extraction
-
-        for extraction in extractions:
-            extraction.create_extraction()
+    with stage("plan"):
+        all_extractions = plan_extractions(input_recordings_VideoFileData, args, output_path)
+
+    if args.command == "plan":
+        write_plan(args.plan_file, all_extractions, parameters)
+        print(f"""wrote the plan of {len(all_extractions)} extractions to "{args.plan_file}".""")
+        return
+
+    if args.command == "preview":
+        preview_path = args.preview_dir if args.preview_dir is not None else os.path.join(output_path, "previews")
+        previews = create_previews(all_extractions, preview_path)
+        print(f"""wrote previews of {sum(1 for preview in previews if preview is not None)} of {len(all_extractions)} extractions to "{preview_path}".""")
+        return
+
+    run_extractions(all_extractions, jobs=args.jobs, jobs_per_device=args.device_jobs, manifest=manifest, parameters=parameters, scratch_path=args.scratch_dir)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,160 @@
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Dict, List
+
+from extraction import Extraction
+from staging import remove_if_exists
+
+MANIFEST_FILE_NAME = ".gopro_dashcam_manifest.json"
+# every record is appended here right away, 'flush' compacts it into the manifest
+JOURNAL_SUFFIX = ".journal"
+
+# intermediary files a crashed run may leave behind in the output folder
+INTERMEDIARY_PATTERNS = [
+    # intermediary clips are staged like the outputs now, these, the concat lists and ffmetadata are left over from older versions
+    "extraction_*_clip_*_of_*.mkv",
+    "combine_*.ffmpeg_combine_list",
+    "combine_*.ffmetadata",
+    # outputs and intermediary clips staged next to their final name
+    ".*.partial.*",
+]
+
+
+def file_checksum(filename: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(filename, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+class Manifest:
+    """
+    record of every extraction produced in an output folder:
+    its source files, clip ranges, pre/post times and the checksum of the output.
+    Extractions whose inputs and parameters did not change since they were recorded are skipped.
+    Each record is appended to a journal as one JSON line, so a crash loses no finished extraction,
+    'flush' rewrites the manifest with the journaled records once done
+    """
+    path: str
+    journal_path: str
+    entries: Dict[str, Dict[str, object]]
+    dirty: bool  # entries journaled since the last save
+
+    def __init__(self: 'Manifest', output_path: str) -> None:
+        self.path = os.path.join(output_path, MANIFEST_FILE_NAME)
+        self.journal_path = f"{self.path}{JOURNAL_SUFFIX}"
+        self.entries = {}
+        self.dirty = False
+        self._lock = threading.Lock()
+
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as manifest_file:
+                    self.entries = json.load(manifest_file).get("extractions", {})
+            except (OSError, ValueError) as e:
+                print(f"""could not read manifest "{self.path}", starting a new one: {e}""")
+        self._replay_journal()
+
+    def _replay_journal(self: 'Manifest') -> None:
+        """
+        adds the records journaled by a run that did not flush and compacts them into the manifest,
+        a line torn by a crash is skipped, new records are never appended after it
+        """
+        try:
+            with open(self.journal_path, "r") as journal_file:
+                for line in journal_file:
+                    try:
+                        record = json.loads(line)
+                        self.entries[record["name"]] = record["entry"]
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            print(f"""could not read manifest journal "{self.journal_path}": {e}""")
+            return
+        self.dirty = True
+        self.flush()
+
+    @staticmethod
+    def describe(extraction: Extraction, parameters: Dict[str, object]) -> Dict[str, object]:
+        """everything the output of extraction depends on"""
+        sources = []
+        for filename in sorted({clip.abs_filename for clip in extraction.clips}):
+            stat = os.stat(filename)
+            sources.append({"path": filename, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns})
+
+        return {
+            "sources": sources,
+            "clips": [[clip.abs_filename, clip.start, clip.end] for clip in extraction.get_output_clips()],
+            "parameters": parameters,
+        }
+
+    @staticmethod
+    def get_key(description: Dict[str, object]) -> str:
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def is_up_to_date(self: 'Manifest', extraction: Extraction, out_name: str, parameters: Dict[str, object]) -> bool:
+        with self._lock:
+            entry = self.entries.get(os.path.basename(out_name))
+        if entry is None:
+            return False
+
+        try:
+            if entry.get("key") != self.get_key(self.describe(extraction, parameters)):
+                return False
+            return os.path.getsize(out_name) == entry.get("output_size")
+        except OSError:
+            return False
+
+    def record(self: 'Manifest', extraction: Extraction, out_name: str, parameters: Dict[str, object]) -> None:
+        description = self.describe(extraction, parameters)
+        entry: Dict[str, object] = {
+            "key": self.get_key(description),
+            **description,
+            "output_size": os.path.getsize(out_name),
+            "output_sha256": file_checksum(out_name),
+            "created": time.time(),
+        }
+        name = os.path.basename(out_name)
+        with self._lock:
+            self.entries[name] = entry
+            self.dirty = True
+            with open(self.journal_path, "a") as journal_file:
+                journal_file.write(json.dumps({"name": name, "entry": entry}, sort_keys=True) + "\n")
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+
+    def flush(self: 'Manifest') -> None:
+        """saves the entries journaled since the last save and empties the journal"""
+        with self._lock:
+            if self.dirty:
+                self._save()
+                # the saved manifest holds every journaled record now
+                remove_if_exists(self.journal_path)
+
+    def _save(self: 'Manifest') -> None:
+        """with the lock held: write atomically, a crash never leaves a half written manifest"""
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as manifest_file:
+            json.dump({"version": 1, "extractions": self.entries}, manifest_file, indent=1, sort_keys=True)
+        os.replace(temp_path, self.path)
+        self.dirty = False
+
+
+def clean_intermediary_files(output_path: str) -> List[str]:
+    """removes intermediary files left behind by an interrupted run, returns their names"""
+    removed = []
+    for pattern in INTERMEDIARY_PATTERNS:
+        for filename in glob.glob(os.path.join(glob.escape(output_path), pattern)):
+            try:
+                os.remove(filename)
+                removed.append(filename)
+            except OSError:
+                pass
+    return removed
@@ -0,0 +1,228 @@
+"""
+Pure python reader for the mp4 headers in 'moov',
+built on the box walker in GP_Highlight_Extractor.
+Reads duration, creation time and the tracks of a file in-process instead of running ffprobe.
+"""
+
+import io
+import struct
+from datetime import datetime, timedelta, timezone
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+from GP_Highlight_Extractor import box_header_size, find_all_boxes, find_boxes
+from instrumentation import instrumentation
+
+MP4_EPOCH = datetime(1904, 1, 1, tzinfo=timezone.utc)
+
+# hdlr handler_type -> ffprobe codec_type
+CODEC_TYPES = {
+    b"vide": "video",
+    b"soun": "audio",
+    b"meta": "data",
+    b"tmcd": "data",
+    b"text": "subtitle",
+    b"sbtl": "subtitle",
+}
+
+# stsd sample entry type -> ffprobe codec_name
+CODEC_NAMES = {
+    b"avc1": "h264",
+    b"avc3": "h264",
+    b"hvc1": "hevc",
+    b"hev1": "hevc",
+    b"mp4a": "aac",
+    b"gpmd": "bin_data",
+}
+
+
+def format_mp4_time(seconds_since_1904: int) -> Optional[str]:
+    """same format as the creation_time tag ffprobe reports, None for an unset time"""
+    if seconds_since_1904 == 0:
+        return None
+    return (MP4_EPOCH + timedelta(seconds=seconds_since_1904)).strftime("%Y-%m-%dT%H:%M:%S.000000Z")
+
+
+def read_full_box_times(data: bytes, offset: int) -> Tuple[int, int, int]:
+    """
+    (creation_time, timescale, duration) of a 'mvhd' or 'mdhd' payload starting at offset
+    """
+    version = data[offset]
+    if version == 1:
+        creation_time, _, timescale, duration = struct.unpack_from("> Q Q I Q", data, offset + 4)
+    else:
+        creation_time, _, timescale, duration = struct.unpack_from("> I I I I", data, offset + 4)
+    return creation_time, timescale, duration
+
+
+class Mp4Track:
+    """
+    a single 'trak' inside 'moov'
+    """
+    track_id: int
+    codec_type: str
+    codec_tag: str
+    codec_name: str
+    timescale: int
+    duration: float
+    creation_time: Optional[str]
+    width: Optional[int]
+    height: Optional[int]
+
+    def __init__(self: 'Mp4Track', track_id: int, handler_type: bytes, codec_tag: bytes, timescale: int, duration: float, creation_time: Optional[str], width: Optional[int], height: Optional[int]) -> None:
+        self.track_id = track_id
+        self.codec_type = CODEC_TYPES.get(handler_type, "data")
+        self.codec_tag = codec_tag.decode("latin-1")
+        self.codec_name = CODEC_NAMES.get(codec_tag, self.codec_tag.strip())
+        self.timescale = timescale
+        self.duration = duration
+        self.creation_time = creation_time
+        self.width = width
+        self.height = height
+
+    def __repr__(self: 'Mp4Track') -> str:
+        return f"TRACK=[{self.track_id=}, {self.codec_type=}, {self.codec_name=}, {self.timescale=}, {self.duration=}]"
+
+
+class Mp4Info:
+    """
+    duration, creation time and tracks of a mp4 file, as read from 'moov/mvhd' and 'moov/trak'
+    """
+    duration: float
+    timescale: int
+    creation_time: Optional[str]
+    tracks: List[Mp4Track]
+
+    def __init__(self: 'Mp4Info', duration: float, timescale: int, creation_time: Optional[str], tracks: List[Mp4Track]) -> None:
+        self.duration = duration
+        self.timescale = timescale
+        self.creation_time = creation_time
+        self.tracks = tracks
+
+    def to_metadata(self: 'Mp4Info') -> Dict[str, object]:
+        """same layout as 'video_metadata.probe_metadata' returns"""
+        creation_time = self.creation_time
+        for track in self.tracks:
+            if track.codec_type == "video":
+                # ffprobe reports the creation_time of the first video stream
+                creation_time = track.creation_time
+                break
+
+        streams = []
+        for index, track in enumerate(self.tracks):
+            stream: Dict[str, str] = {
+                "index": str(index),
+                "codec_type": track.codec_type,
+                "codec_name": track.codec_name,
+                "codec_tag_string": track.codec_tag,
+                "time_base": f"1/{track.timescale}",
+            }
+            if track.width is not None and track.height is not None:
+                stream["width"] = str(track.width)
+                stream["height"] = str(track.height)
+            streams.append(stream)
+
+        return {
+            "duration": self.duration,
+            "creation_time": creation_time,
+            "streams": streams,
+            "format_tags": {},
+        }
+
+
+def read_moov(file_stream: BinaryIO) -> bytes:
+    """
+    the complete 'moov' box of a mp4 file, read with a single bounded read
+    """
+    boxes = find_boxes(file_stream)
+
+    if b"ftyp" not in boxes or boxes[b"ftyp"][0] != 0:
+        raise ValueError("not an mp4-video-file")
+    if b"moov" not in boxes:
+        raise ValueError("no moov box")
+
+    start, end = boxes[b"moov"]
+    file_stream.seek(start, 0)
+    moov = file_stream.read(end - start)
+    if len(moov) != end - start:
+        raise ValueError("truncated moov box")
+    return moov
+
+
+def child_boxes(stream: BinaryIO, box: Tuple[int, int]) -> List[Tuple[bytes, int, int]]:
+    return find_all_boxes(stream, box[0] + box_header_size(stream, box), box[1])
+
+
+def child_box(stream: BinaryIO, box: Tuple[int, int], box_type: bytes) -> Tuple[int, int]:
+    for text, start, end in child_boxes(stream, box):
+        if text == box_type:
+            return start, end
+    raise KeyError(box_type)
+
+
+def payload_offset(stream: BinaryIO, box: Tuple[int, int]) -> int:
+    return box[0] + box_header_size(stream, box)
+
+
+def read_track(moov: bytes, stream: BinaryIO, trak: Tuple[int, int]) -> Mp4Track:
+    tkhd = child_box(stream, trak, b"tkhd")
+    tkhd_offset = payload_offset(stream, tkhd)
+    track_id = struct.unpack_from("> I", moov, tkhd_offset + (20 if moov[tkhd_offset] == 1 else 12))[0]
+
+    mdia = child_box(stream, trak, b"mdia")
+    mdhd = child_box(stream, mdia, b"mdhd")
+    creation_time, timescale, duration = read_full_box_times(moov, payload_offset(stream, mdhd))
+
+    hdlr_offset = payload_offset(stream, child_box(stream, mdia, b"hdlr"))
+    handler_type = moov[hdlr_offset + 8:hdlr_offset + 12]
+
+    codec_tag = b"    "
+    width: Optional[int] = None
+    height: Optional[int] = None
+    try:
+        stsd = child_box(stream, child_box(stream, child_box(stream, mdia, b"minf"), b"stbl"), b"stsd")
+        entry_offset = payload_offset(stream, stsd) + 8
+        codec_tag = moov[entry_offset + 4:entry_offset + 8]
+        if handler_type == b"vide":
+            width, height = struct.unpack_from("> H H", moov, entry_offset + 32)
+    except (KeyError, struct.error):
+        pass
+
+    return Mp4Track(
+        track_id=track_id,
+        handler_type=handler_type,
+        codec_tag=codec_tag,
+        timescale=timescale,
+        duration=duration / timescale if timescale > 0 else 0.0,
+        creation_time=format_mp4_time(creation_time),
+        width=width,
+        height=height,
+    )
+
+
+def read_mp4_info(filename: str) -> Mp4Info:
+    """
+    raises ValueError if filename is no mp4 file with a complete 'moov/mvhd'
+    """
+    file_stream: BinaryIO
+    with open(filename, "rb") as file_stream:
+        moov = read_moov(file_stream)
+    instrumentation.record_read(filename, len(moov))
+
+    try:
+        stream = io.BytesIO(moov)
+        moov_box = (0, len(moov))
+        mvhd = child_box(stream, moov_box, b"mvhd")
+        creation_time, timescale, duration = read_full_box_times(moov, payload_offset(stream, mvhd))
+        if timescale <= 0 or duration <= 0:
+            raise ValueError("no duration in mvhd")
+
+        tracks = [read_track(moov, stream, (start, end)) for text, start, end in child_boxes(stream, moov_box) if text == b"trak"]
+    except (KeyError, struct.error, IndexError) as e:
+        raise ValueError(f"""incomplete moov box: {e!r}""")
+
+    return Mp4Info(
+        duration=duration / timescale,
+        timescale=timescale,
+        creation_time=format_mp4_time(creation_time),
+        tracks=tracks,
+    )
@@ -0,0 +1,40 @@
+"""
+Extraction plans as json: every extraction with its clips, cut times, chapter times, output name and estimated size.
+Written by 'main.py plan', run by 'main.py execute', possibly on another host.
+"""
+
+import json
+from typing import Dict, List, Optional, Tuple
+
+from extraction import Extraction
+
+PLAN_VERSION = 1
+
+
+def plan_to_json(extractions: List[Extraction], parameters: Dict[str, object]) -> Dict[str, object]:
+    estimated_sizes = [extraction.estimate_size() for extraction in extractions]
+    return {
+        "version": PLAN_VERSION,
+        "parameters": parameters,
+        "estimated_bytes": sum(size or 0 for size in estimated_sizes) if None not in estimated_sizes else None,
+        "extractions": [extraction.to_json() for extraction in extractions],
+    }
+
+
+def write_plan(plan_file: str, extractions: List[Extraction], parameters: Dict[str, object]) -> None:
+    with open(plan_file, "w") as file:
+        json.dump(plan_to_json(extractions, parameters), file, indent=1)
+        file.write("\n")
+
+
+def read_plan(plan_file: str) -> Tuple[List[Extraction], Dict[str, object], Optional[int]]:
+    """(extractions, parameters, estimated bytes), raises ValueError for plans of another version"""
+    with open(plan_file, "r") as file:
+        data = json.load(file)
+
+    if data.get("version") != PLAN_VERSION:
+        raise ValueError(f"""plan "{plan_file}" has version {data.get("version")}, expected {PLAN_VERSION}.""")
+
+    extractions = [Extraction.from_json(extraction) for extraction in data["extractions"]]
+    estimated_bytes = data.get("estimated_bytes")
+    return extractions, data.get("parameters", {}), estimated_bytes if isinstance(estimated_bytes, int) else None
@@ -0,0 +1,126 @@
+"""
+Previews of planned extractions for triaging the HiLights before the full resolution extraction:
+a small preview clip and a contact sheet of thumbnails per extraction.
+
+Both are made by a single ffmpeg decoding the low resolution proxies (.LRV) the GoPro writes next to each chapter,
+a fraction of the size of the chapters. Extractions with a chapter without proxy are read from the chapters instead.
+Cuts are only as exact as the concat demuxer's inpoint/outpoint, which is plenty for a preview.
+"""
+
+import os
+import sys
+from copy import copy
+from functools import partial
+from typing import List, Optional, Tuple
+
+import ffmpeg_runner
+from clip import Clip
+from executor import report_failure
+from extraction import Extraction
+from ffconcat import build_concat_list, build_ffmetadata
+from instrumentation import instrumentation, stage
+from staging import get_partial_name, publish, remove_if_exists
+
+PREVIEW_HEIGHT = 360
+PREVIEW_ENCODER = ["-c:v", "libx264", "-preset", "veryfast", "-crf", "28", "-pix_fmt", "yuv420p", "-c:a", "aac", "-b:a", "96k"]
+
+SHEET_COLUMNS = 4
+SHEET_ROWS = 4
+SHEET_TILE_WIDTH = 320
+
+
+def get_preview_names(extraction: Extraction, preview_path: str) -> Optional[Tuple[str, str]]:
+    """(preview clip, contact sheet) of extraction in preview_path, None if it has no output"""
+    out_name = extraction.get_out_name()
+    if out_name is None:
+        return None
+    base_name = os.path.join(preview_path, os.path.splitext(os.path.basename(out_name))[0])
+    return f"{base_name}_preview.mp4", f"{base_name}_sheet.jpg"
+
+
+def get_proxy_clips(extraction: Extraction) -> Optional[List[Clip]]:
+    """the output clips of extraction read from their proxies, None unless every clip has a proxy"""
+    clips = extraction.get_output_clips()
+    if len(clips) == 0 or any(clip.proxy_filename is None or not os.path.exists(clip.proxy_filename) for clip in clips):
+        return None
+    proxy_clips = []
+    for clip in clips:
+        proxy_clip = copy(clip)
+        proxy_clip.abs_filename = clip.proxy_filename or ""
+        proxy_clips.append(proxy_clip)
+    return proxy_clips
+
+
+def get_preview_arguments(clips: List[Clip], chapter_times: List[float], preview_name: str, sheet_name: str) -> List[ffmpeg_runner.Argument]:
+    # thumbnails evenly spread over the whole preview, the tile is written once it is full or the input ends
+    length = sum(clip.get_clip_length() for clip in clips)
+    thumbnail_rate = SHEET_COLUMNS * SHEET_ROWS / max(length, 0.001)
+    filters = (
+        f"[0:v:0]split[preview][sheet];"
+        f"[preview]scale=-2:'min({PREVIEW_HEIGHT},ih)'[preview_out];"
+        f"[sheet]fps={thumbnail_rate:.6f},scale={SHEET_TILE_WIDTH}:-2,tile={SHEET_COLUMNS}x{SHEET_ROWS}[sheet_out]"
+    )
+    return [
+        "-y", "-f", "concat", "-safe", "0", "-protocol_whitelist", "file,pipe", "-i", ffmpeg_runner.PipeInput(build_concat_list(clips)),
+        "-f", "ffmetadata", "-i", ffmpeg_runner.PipeInput(build_ffmetadata(chapter_times)),
+        "-filter_complex", filters,
+        "-map", "[preview_out]", "-map", "0:a:0?", "-map_chapters", "1", *PREVIEW_ENCODER, "-movflags", "+faststart", preview_name,
+        "-map", "[sheet_out]", "-frames:v", "1", "-update", "1", sheet_name,
+    ]
+
+
+def record_proxy_reads(clips: List[Clip]) -> None:
+    """bytes read from the proxies, estimated by each clip's share of its proxy"""
+    for clip in clips:
+        video_length = clip.get_video_length()
+        if video_length > 0:
+            instrumentation.record_read(clip.abs_filename, int(os.path.getsize(clip.abs_filename) * clip.get_clip_length() / video_length))
+
+
+async def create_preview(extraction: Extraction, preview_path: str) -> Optional[Tuple[str, str]]:
+    """writes the preview clip and contact sheet of extraction, None if it has nothing to preview"""
+    names = get_preview_names(extraction, preview_path)
+    proxy_clips = get_proxy_clips(extraction)
+    clips = proxy_clips if proxy_clips is not None else extraction.get_output_clips()
+    if len(clips) == 0:
+        return None
+    if proxy_clips is None:
+        print(f"""a chapter of extraction {extraction.extraction_number} has no proxy, previewing it from the full resolution chapters.""", file=sys.stderr)
+    assert names is not None
+
+    preview_name, sheet_name = names
+    staged_names = [get_partial_name(preview_path, name, f"{os.getpid()}") for name in names]
+    try:
+        await ffmpeg_runner.runner.run(
+            get_preview_arguments(clips, extraction.get_chapter_times(), *staged_names),
+            duration=sum(clip.get_clip_length() for clip in clips),
+            description=os.path.basename(preview_name),
+        )
+        for staged_name, name in zip(staged_names, names):
+            publish(staged_name, name)
+            instrumentation.record_written(name, os.path.getsize(name))
+    finally:
+        for staged_name in staged_names:
+            remove_if_exists(staged_name)
+    if proxy_clips is not None:
+        record_proxy_reads(proxy_clips)
+    return preview_name, sheet_name
+
+
+def create_previews(extractions: List[Extraction], preview_path: str) -> List[Optional[Tuple[str, str]]]:
+    """
+    previews of every extraction, at most the runner's max_concurrency at once.
+    Returns the (preview clip, contact sheet) of each extraction in the given order, None if it failed or had nothing to preview
+    """
+    os.makedirs(preview_path, exist_ok=True)
+    results: List[Optional[Tuple[str, str]]] = [None] * len(extractions)
+
+    async def preview(index: int) -> None:
+        try:
+            results[index] = await create_preview(extractions[index], preview_path)
+        except Exception as e:
+            report_failure(f"previewing extraction {extractions[index].extraction_number}", e)
+
+    with stage("preview"):
+        ffmpeg_runner.run_ffmpeg_all([partial(preview, index) for index in range(len(extractions))])
+    return results
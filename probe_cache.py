@@ -0,0 +1,172 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+FIELDS = ("metadata", "hilights", "keyframes", "events")
+SCHEMA_VERSION = 5
+
+
+def default_cache_path() -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "gopro_dashcam", "probe_cache.sqlite")
+
+
+class ProbeCache:
+    """
+    persistent cache of probed metadata per file on disc,
+    keyed by absolute path, size and mtime.
+    A row is dropped as soon as the file it describes has changed.
+    """
+    db_path: str
+    max_entries: int
+    max_age: float
+
+    def __init__(self: 'ProbeCache', db_path: str, max_entries: int = 100000, max_age: float = 90 * 24 * 3600) -> None:
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._lock = threading.Lock()
+
+        if os.path.dirname(db_path) != "":
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        if self._connection.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            # it is only a cache, start over instead of migrating
+            self._connection.execute("DROP TABLE IF EXISTS probe")
+            self._connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS probe (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                accessed REAL NOT NULL,
+                metadata TEXT,
+                hilights TEXT,
+                keyframes TEXT,
+                events TEXT
+            )
+            """
+        )
+        self.evict()
+
+    @staticmethod
+    def _file_key(filename: str) -> Tuple[str, int, int]:
+        stat = os.stat(filename)
+        return os.path.abspath(filename), stat.st_size, stat.st_mtime_ns
+
+    def get(self: 'ProbeCache', filename: str, field: str) -> Optional[str]:
+        """
+        returns the json encoded value of field for filename,
+        None if it is not cached or the file changed since it was cached
+        """
+        assert field in FIELDS, f"""unknown cache field "{field}" """
+        path, size, mtime_ns = self._file_key(filename)
+        with self._lock:
+            row = self._connection.execute(f"SELECT size, mtime_ns, {field} FROM probe WHERE path = ?", (path,)).fetchone()
+            if row is None:
+                return None
+            if row[0] != size or row[1] != mtime_ns:
+                self._connection.execute("DELETE FROM probe WHERE path = ?", (path,))
+                return None
+            self._connection.execute("UPDATE probe SET accessed = ? WHERE path = ?", (time.time(), path))
+            value: Optional[str] = row[2]
+            return value
+
+    def set(self: 'ProbeCache', filename: str, field: str, value: str) -> None:
+        assert field in FIELDS, f"""unknown cache field "{field}" """
+        path, size, mtime_ns = self._file_key(filename)
+        with self._lock:
+            row = self._connection.execute("SELECT size, mtime_ns FROM probe WHERE path = ?", (path,)).fetchone()
+            if row is not None and (row[0] != size or row[1] != mtime_ns):
+                self._connection.execute("DELETE FROM probe WHERE path = ?", (path,))
+            self._connection.execute(
+                f"""
+                INSERT INTO probe (path, size, mtime_ns, accessed, {field}) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(path) DO UPDATE SET accessed = excluded.accessed, {field} = excluded.{field}
+                """,
+                (path, size, mtime_ns, time.time(), value)
+            )
+
+    def invalidate(self: 'ProbeCache', filename: str) -> None:
+        with self._lock:
+            self._connection.execute("DELETE FROM probe WHERE path = ?", (os.path.abspath(filename),))
+
+    def clear(self: 'ProbeCache') -> None:
+        with self._lock:
+            self._connection.execute("DELETE FROM probe")
+
+    def evict(self: 'ProbeCache') -> int:
+        """
+        drops entries not accessed for longer than max_age seconds,
+        then the least recently accessed entries beyond max_entries.
+        returns the number of dropped entries
+        """
+        with self._lock:
+            before = self._connection.total_changes
+            self._connection.execute("DELETE FROM probe WHERE accessed < ?", (time.time() - self.max_age,))
+            self._connection.execute(
+                "DELETE FROM probe WHERE path NOT IN (SELECT path FROM probe ORDER BY accessed DESC LIMIT ?)",
+                (max(self.max_entries, 0),)
+            )
+            return self._connection.total_changes - before
+
+    def close(self: 'ProbeCache') -> None:
+        with self._lock:
+            self._connection.close()
+
+
+_cache: Optional[ProbeCache] = None
+
+
+def open_cache(db_path: str, max_entries: int = 100000, max_age: float = 90 * 24 * 3600) -> ProbeCache:
+    """opens the process wide cache used by 'cached'"""
+    global _cache
+    close_cache()
+    _cache = ProbeCache(db_path, max_entries=max_entries, max_age=max_age)
+    return _cache
+
+
+def close_cache() -> None:
+    global _cache
+    if _cache is not None:
+        _cache.close()
+        _cache = None
+
+
+def get_cache() -> Optional[ProbeCache]:
+    return _cache
+
+
+def cached(filename: str, field: str, compute: Callable[[], T], should_store: Optional[Callable[[T], bool]] = None) -> T:
+    """
+    returns the cached value of field for filename,
+    calls compute and stores its result if there is none.
+    Results should_store rejects, e.g. failures that may be transient, are returned without storing them.
+    Without an open cache compute is always called.
+    """
+    if _cache is None:
+        return compute()
+
+    try:
+        encoded = _cache.get(filename, field)
+    except (OSError, sqlite3.Error):
+        return compute()
+    if encoded is not None:
+        value: T = json.loads(encoded)
+        return value
+
+    value = compute()
+    if should_store is not None and not should_store(value):
+        return value
+    try:
+        _cache.set(filename, field, json.dumps(value))
+    except (OSError, sqlite3.Error):
+        pass
+    return value
@@ -0,0 +1,255 @@
+"""
+Keyframe index of a mp4 file, built from the sample tables (stts, ctts, stss, stsc, stsz, stco/co64)
+of its tracks with the box walker in GP_Highlight_Extractor.
+Used to plan cuts on the keyframes ffmpeg actually cuts at when stream copying,
+and to know byte ranges and output sizes before running anything.
+"""
+
+import io
+import struct
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+from instrumentation import instrumentation
+from mp4_metadata import child_box, child_boxes, payload_offset, read_moov
+
+
+class TrackSamples:
+    """
+    decode times, sizes and file offsets of all samples of a single track
+    """
+    timescale: int
+    handler_type: bytes
+    sample_format: bytes  # codec tag of the first sample description, e.g. b"gpmd" for GoPro telemetry
+    times: List[float]
+    sizes: List[int]
+    offsets: List[int]
+    keyframes: Optional[List[int]]  # sample indices (0 based), None if every sample is a keyframe
+    composition_offsets: List[int]
+    edit_offset: int
+
+    def __init__(self: 'TrackSamples', timescale: int, handler_type: bytes, times: List[float], sizes: List[int], offsets: List[int], keyframes: Optional[List[int]], composition_offsets: List[int], edit_offset: int, sample_format: bytes = b"") -> None:
+        self.timescale = timescale
+        self.handler_type = handler_type
+        self.sample_format = sample_format
+        self.times = times
+        self.sizes = sizes
+        self.offsets = offsets
+        self.keyframes = keyframes
+        self.composition_offsets = composition_offsets
+        self.edit_offset = edit_offset
+
+    def presentation_time(self: 'TrackSamples', sample: int) -> float:
+        composition_offset = self.composition_offsets[sample] if sample < len(self.composition_offsets) else 0
+        return self.times[sample] + (composition_offset - self.edit_offset) / self.timescale
+
+
+def _unpack_table(moov: bytes, offset: int, entry_format: str) -> List[Tuple[int, ...]]:
+    """entries of a full box table: version/flags, u32 entry count, entries"""
+    count = struct.unpack_from("> I", moov, offset + 4)[0]
+    entry = struct.Struct(f"> {entry_format}")
+    return list(entry.iter_unpack(moov[offset + 8:offset + 8 + count * entry.size]))
+
+
+def read_track_samples(moov: bytes, stream: BinaryIO, trak: Tuple[int, int]) -> TrackSamples:
+    mdia = child_box(stream, trak, b"mdia")
+    mdhd_offset = payload_offset(stream, child_box(stream, mdia, b"mdhd"))
+    if moov[mdhd_offset] == 1:
+        timescale = struct.unpack_from("> I", moov, mdhd_offset + 20)[0]
+    else:
+        timescale = struct.unpack_from("> I", moov, mdhd_offset + 12)[0]
+    if timescale <= 0:
+        raise ValueError("track without timescale")
+
+    hdlr_offset = payload_offset(stream, child_box(stream, mdia, b"hdlr"))
+    handler_type = moov[hdlr_offset + 8:hdlr_offset + 12]
+
+    stbl = child_box(stream, child_box(stream, mdia, b"minf"), b"stbl")
+    tables: Dict[bytes, int] = {text: payload_offset(stream, (start, end)) for text, start, end in child_boxes(stream, stbl)}
+
+    sample_format = moov[tables[b"stsd"] + 12:tables[b"stsd"] + 16] if b"stsd" in tables else b""
+
+    # sample sizes
+    if b"stsz" not in tables:
+        raise ValueError("no stsz box (stz2 is not supported)")
+    sample_size, sample_count = struct.unpack_from("> I I", moov, tables[b"stsz"] + 4)
+    if sample_size != 0:
+        sizes = [sample_size] * sample_count
+    else:
+        sizes = list(struct.unpack_from(f"> {sample_count}I", moov, tables[b"stsz"] + 12))
+
+    # decode times
+    times: List[float] = []
+    decode_time = 0
+    for count, delta in _unpack_table(moov, tables[b"stts"], "I I"):
+        for _ in range(count):
+            times.append(decode_time / timescale)
+            decode_time += delta
+    times = times[:sample_count]
+
+    # composition offsets
+    composition_offsets: List[int] = []
+    if b"ctts" in tables:
+        ctts_format = "I i" if moov[tables[b"ctts"]] == 1 else "I I"
+        for count, composition_offset in _unpack_table(moov, tables[b"ctts"], ctts_format):
+            composition_offsets.extend([composition_offset] * count)
+
+    # keyframes
+    keyframes: Optional[List[int]] = None
+    if b"stss" in tables:
+        keyframes = [sample_number - 1 for (sample_number,) in _unpack_table(moov, tables[b"stss"], "I")]
+
+    # file offsets
+    if b"co64" in tables:
+        chunk_offsets = [offset for (offset,) in _unpack_table(moov, tables[b"co64"], "Q")]
+    else:
+        chunk_offsets = [offset for (offset,) in _unpack_table(moov, tables[b"stco"], "I")]
+    sample_to_chunk = _unpack_table(moov, tables[b"stsc"], "I I I")
+    offsets: List[int] = []
+    for run, (first_chunk, samples_per_chunk, _) in enumerate(sample_to_chunk):
+        last_chunk = sample_to_chunk[run + 1][0] - 1 if run + 1 < len(sample_to_chunk) else len(chunk_offsets)
+        for chunk in range(first_chunk - 1, last_chunk):
+            offset = chunk_offsets[chunk]
+            for _ in range(samples_per_chunk):
+                if len(offsets) >= sample_count:
+                    break
+                offsets.append(offset)
+                offset += sizes[len(offsets) - 1]
+
+    # edit list, media time the presentation starts at
+    edit_offset = 0
+    try:
+        elst_offset = payload_offset(stream, child_box(stream, child_box(stream, trak, b"edts"), b"elst"))
+        for entry in _unpack_table(moov, elst_offset, "Q q i" if moov[elst_offset] == 1 else "I i i"):
+            if entry[1] != -1:
+                edit_offset = entry[1]
+                break
+    except KeyError:
+        pass
+
+    return TrackSamples(
+        timescale=timescale,
+        handler_type=handler_type,
+        times=times,
+        sizes=sizes,
+        offsets=offsets,
+        keyframes=keyframes,
+        composition_offsets=composition_offsets,
+        edit_offset=edit_offset,
+        sample_format=sample_format,
+    )
+
+
+def read_all_track_samples(filename: str) -> List[TrackSamples]:
+    """samples of every track with complete sample tables, other tracks are left out"""
+    file_stream: BinaryIO
+    with open(filename, "rb") as file_stream:
+        moov = read_moov(file_stream)
+    instrumentation.record_read(filename, len(moov))
+
+    stream = io.BytesIO(moov)
+    tracks = []
+    for text, start, end in child_boxes(stream, (0, len(moov))):
+        if text != b"trak":
+            continue
+        try:
+            tracks.append(read_track_samples(moov, stream, (start, end)))
+        except (ValueError, KeyError, struct.error, IndexError):
+            pass
+    return tracks
+
+
+class KeyframeIndex:
+    """
+    presentation times and file offsets of the keyframes of the first video track,
+    and the number of bytes of all tracks before each keyframe
+    """
+    times: List[float]
+    offsets: List[int]
+    cumulative_bytes: List[int]
+    total_bytes: int
+    duration: float
+
+    def __init__(self: 'KeyframeIndex', times: List[float], offsets: List[int], cumulative_bytes: List[int], total_bytes: int, duration: float) -> None:
+        self.times = times
+        self.offsets = offsets
+        self.cumulative_bytes = cumulative_bytes
+        self.total_bytes = total_bytes
+        self.duration = duration
+
+    @staticmethod
+    def from_tracks(tracks: List[TrackSamples]) -> 'KeyframeIndex':
+        video_tracks = [track for track in tracks if track.handler_type == b"vide"]
+        if len(video_tracks) == 0 or len(video_tracks[0].times) == 0:
+            raise ValueError("no video track")
+        video = video_tracks[0]
+
+        keyframe_samples = video.keyframes if video.keyframes is not None else list(range(len(video.times)))
+        times = [max(video.presentation_time(sample), 0.0) for sample in keyframe_samples]
+        offsets = [video.offsets[sample] for sample in keyframe_samples]
+
+        # bytes of every track decoded before each keyframe
+        cumulative_bytes = [0] * len(keyframe_samples)
+        for track in tracks:
+            track_cumulative = [0] + list(accumulate(track.sizes))
+            for index, sample in enumerate(keyframe_samples):
+                cumulative_bytes[index] += track_cumulative[bisect_left(track.times, video.times[sample])]
+
+        total_bytes = sum(sum(track.sizes) for track in tracks)
+        last_sample = len(video.times) - 1
+        duration = video.times[last_sample] + (video.times[last_sample] - video.times[last_sample - 1] if last_sample > 0 else 0.0)
+
+        return KeyframeIndex(times=times, offsets=offsets, cumulative_bytes=cumulative_bytes, total_bytes=total_bytes, duration=duration)
+
+    def to_json(self: 'KeyframeIndex') -> Dict[str, object]:
+        return {
+            "times": self.times,
+            "offsets": self.offsets,
+            "cumulative_bytes": self.cumulative_bytes,
+            "total_bytes": self.total_bytes,
+            "duration": self.duration,
+        }
+
+    @staticmethod
+    def from_json(data: Dict[str, object]) -> 'KeyframeIndex':
+        times, offsets, cumulative_bytes = data["times"], data["offsets"], data["cumulative_bytes"]
+        total_bytes, duration = data["total_bytes"], data["duration"]
+        assert isinstance(times, list) and isinstance(offsets, list) and isinstance(cumulative_bytes, list)
+        assert isinstance(total_bytes, int) and isinstance(duration, (int, float))
+        return KeyframeIndex(
+            times=[float(t) for t in times],
+            offsets=[int(o) for o in offsets],
+            cumulative_bytes=[int(b) for b in cumulative_bytes],
+            total_bytes=total_bytes,
+            duration=float(duration),
+        )
+
+    def keyframe_before(self: 'KeyframeIndex', time: float) -> int:
+        """index of the last keyframe at or before time, where a stream copy starting at time really starts"""
+        return max(bisect_right(self.times, time + 1e-6) - 1, 0)
+
+    def keyframe_after(self: 'KeyframeIndex', time: float) -> Optional[int]:
+        """index of the first keyframe at or after time, None if there is none"""
+        index = bisect_left(self.times, time - 1e-6)
+        return index if index < len(self.times) else None
+
+    def snap_start(self: 'KeyframeIndex', start: float) -> float:
+        """start moved back onto the keyframe a stream copy starts at"""
+        return self.times[self.keyframe_before(start)]
+
+    def byte_range(self: 'KeyframeIndex', start: float, end: float) -> Tuple[int, Optional[int]]:
+        """file offsets of the keyframes enclosing [start, end), None as end means until the end of the file"""
+        end_keyframe = self.keyframe_after(end)
+        return self.offsets[self.keyframe_before(start)], self.offsets[end_keyframe] if end_keyframe is not None else None
+
+    def estimate_size(self: 'KeyframeIndex', start: float, end: float) -> int:
+        """bytes of all tracks a stream copy of [start, end) writes"""
+        end_keyframe = self.keyframe_after(end)
+        end_bytes = self.cumulative_bytes[end_keyframe] if end_keyframe is not None else self.total_bytes
+        return max(end_bytes - self.cumulative_bytes[self.keyframe_before(start)], 0)
+
+
+def read_keyframe_index(filename: str) -> KeyframeIndex:
+    """raises ValueError if filename has no readable video sample tables"""
+    return KeyframeIndex.from_tracks(read_all_track_samples(filename))
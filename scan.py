@@ -0,0 +1,137 @@
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import GP_Highlight_Extractor
+import probe_cache
+import telemetry
+from instrumentation import instrumentation, stage
+from video_file_data import VideoFileData
+from video_metadata import VideoMetadata, get_metadata, read_metadata
+
+ScanResult = Tuple[str, Dict[str, object], bool, Optional[List[float]], Optional[List[float]], Optional[Dict[str, Dict[str, object]]]]
+
+# set in scan worker processes, they send their instrumentation along with each result
+_in_worker = False
+
+
+def get_files_in_folder(folder: str) -> Iterable[str]:
+    """
+    all files below folder (recursively, without following links to folders).
+    os.scandir gets the file types with the folder listing, no file is opened or stat'ed on its own
+    """
+    folders = [os.path.abspath(folder)]
+    while len(folders) > 0:
+        current_folder = folders.pop()
+        try:
+            with os.scandir(current_folder) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append(entry.path)
+                    elif entry.is_file():
+                        yield entry.path
+        except OSError as e:
+            print(f"""could not list folder "{current_folder}": {e}""", file=sys.stderr)
+
+
+def _list_folder(folder: str) -> List[str]:
+    return list(get_files_in_folder(folder))
+
+
+def _scan_file(filename: str) -> ScanResult:
+    """
+    probes a single file in a worker process,
+    returns (filename, metadata, is_video, hilights, events, instrumentation report).
+    hilights is None if they could not be parsed, 'VideoFileData.get_hilights' raises the error later on.
+    events are None unless the detection of telemetry events is enabled.
+    The instrumentation report is None when not running in a worker process.
+    """
+    with stage("metadata"):
+        metadata = probe_cache.cached(filename, "metadata", lambda: read_metadata(filename))
+    video_metadata = VideoMetadata(filename)
+    video_metadata.load(metadata)
+    is_video = video_metadata.is_video()
+
+    hilights: Optional[List[float]] = None
+    if is_video:
+        try:
+            with stage("hilights"):
+                hilights = probe_cache.cached(filename, "hilights", lambda: GP_Highlight_Extractor.get_hilights(filename))
+        except Exception:
+            pass
+
+    events: Optional[List[float]] = None
+    if is_video and telemetry.detect_events_enabled:
+        with stage("events"):
+            events = telemetry.get_events(filename)
+
+    report: Optional[Dict[str, Dict[str, object]]] = None
+    if _in_worker:
+        report = instrumentation.to_json()
+        instrumentation.reset()
+
+    return filename, metadata, is_video, hilights, events, report
+
+
+def _init_worker(cache_path: Optional[str], max_entries: int, max_age: float, detect_events: bool) -> None:
+    global _in_worker
+    _in_worker = True
+    telemetry.configure(detect_events=detect_events)
+    if cache_path is not None:
+        probe_cache.open_cache(cache_path, max_entries=max_entries, max_age=max_age)
+
+
+def _create_pool(jobs: int) -> ProcessPoolExecutor:
+    cache = probe_cache.get_cache()
+    return ProcessPoolExecutor(
+        max_workers=jobs,
+        # spawn, the parent's sqlite connection must not be shared with forked children
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(
+            cache.db_path if cache is not None else None,
+            cache.max_entries if cache is not None else 0,
+            cache.max_age if cache is not None else 0,
+            telemetry.detect_events_enabled,
+        ),
+    )
+
+
+def discover_files(folders: List[str], jobs: int = 1) -> List[str]:
+    """all files in all folders (recursively), one folder per worker process"""
+    if jobs <= 1 or len(folders) <= 1:
+        return [filename for folder in folders for filename in get_files_in_folder(folder)]
+
+    with _create_pool(min(jobs, len(folders))) as pool:
+        return [filename for filenames in pool.map(_list_folder, folders) for filename in filenames]
+
+
+def scan_files(filenames: List[str], jobs: int = 1) -> Dict[str, Optional[VideoFileData]]:
+    """
+    probes metadata and parses the HiLights of all files in a pool of 'jobs' processes.
+    returns a populated 'VideoFileData' per video file, None for files that are no video files
+    """
+    if jobs <= 1:
+        results: Iterable[ScanResult] = map(_scan_file, filenames)
+        return _collect(results)
+
+    with _create_pool(jobs) as pool:
+        return _collect(pool.map(_scan_file, filenames, chunksize=max(1, len(filenames) // (jobs * 4))))
+
+
+def _collect(results: Iterable[ScanResult]) -> Dict[str, Optional[VideoFileData]]:
+    scanned: Dict[str, Optional[VideoFileData]] = {}
+    for filename, metadata, is_video, hilights, events, report in results:
+        if report is not None:
+            instrumentation.merge(report)
+        get_metadata(filename).load(metadata)
+        if not is_video:
+            scanned[filename] = None
+            continue
+        video_file_data = VideoFileData(filename)
+        video_file_data.hilights = hilights
+        video_file_data.events = events
+        scanned[filename] = video_file_data
+    return scanned
@@ -0,0 +1,143 @@
+"""
+Frame accurate cuts at a fraction of the cost of a transcode:
+only the partial GOPs at both edges of a clip are re-encoded, the whole GOPs in between are stream copied.
+
+    start      first keyframe         last keyframe      end
+      |  encode  |        stream copy       |  encode   |
+
+The pieces are written as MPEG-TS, which repeats the codec parameter sets in band, and the concatenation
+keeps them in the packets. Matroska outputs (the default) play back as one stream with them.
+In mp4/mov the sample entry only holds the parameter sets of the first piece, so those outputs are tagged
+avc3/hev1, which allows parameter sets in band. Clips without a keyframe index,
+or of a codec without an encoder in ENCODERS, are stream copied as usual.
+"""
+
+import asyncio
+import os
+import sys
+from functools import partial
+from typing import List, Optional, Tuple
+
+import ffmpeg_runner
+from clip import Clip
+from ffconcat import build_ffmetadata, concat_file_line, get_concat_arguments
+from staging import get_partial_name, remove_if_exists
+
+# codec_name of the source -> encoder options for the re-encoded edges
+ENCODERS = {
+    "h264": ["-c:v", "libx264", "-preset", "medium", "-crf", "18"],
+    "hevc": ["-c:v", "libx265", "-preset", "medium", "-crf", "20", "-x265-params", "log-level=error"],
+}
+
+# sample entry tags of mp4/mov allowing parameter sets in band, by codec_name of the source
+IN_BAND_TAGS = {
+    "h264": "avc3",
+    "hevc": "hev1",
+}
+
+# edges shorter than this are not worth an encoder run
+MIN_EDGE_LENGTH = 0.001
+
+# the copied middle is seeked this far past its keyframe: a keyframe time rounded a hair below the
+# real pts would make the demuxer seek to the keyframe before and duplicate a whole GOP at the splice.
+# Less than a frame at any frame rate a GoPro records
+SEEK_EPSILON = 0.001
+
+
+class Piece:
+    start: float
+    end: float
+    copy: bool  # stream copied, re-encoded otherwise
+
+    def __init__(self: 'Piece', start: float, end: float, copy: bool) -> None:
+        self.start = start
+        self.end = end
+        self.copy = copy
+
+    def __repr__(self: 'Piece') -> str:
+        return f"PIECE=[{self.start=}, {self.end=}, {self.copy=}]"
+
+
+def get_video_codec(clip: Clip) -> Optional[str]:
+    for stream in clip.metadata.streams:
+        if stream.get("codec_type") == "video":
+            return stream.get("codec_name")
+    return None
+
+
+def plan_pieces(clip: Clip) -> Optional[List[Piece]]:
+    """the pieces of a smart cut of clip, None if it can only be stream copied"""
+    if get_video_codec(clip) not in ENCODERS:
+        return None
+    keyframe_index = clip.metadata.get_keyframe_index()
+    if keyframe_index is None:
+        return None
+
+    first = keyframe_index.keyframe_after(clip.start)
+    last = keyframe_index.keyframe_before(clip.end)
+    if first is None or keyframe_index.times[first] >= keyframe_index.times[last]:
+        # no whole GOP inside the clip
+        return [Piece(clip.start, clip.end, copy=False)]
+
+    copy_start, copy_end = keyframe_index.times[first], keyframe_index.times[last]
+    pieces = []
+    if copy_start - clip.start >= MIN_EDGE_LENGTH:
+        pieces.append(Piece(clip.start, copy_start, copy=False))
+    pieces.append(Piece(copy_start, copy_end, copy=True))
+    if clip.end - copy_end >= MIN_EDGE_LENGTH:
+        pieces.append(Piece(copy_end, clip.end, copy=False))
+    return pieces
+
+
+def get_piece_arguments(clip: Clip, piece: Piece, piece_name: str) -> List[ffmpeg_runner.Argument]:
+    # input seeking: a copy starts at the keyframe at or before piece.start, an encode decodes from the keyframe before and drops up to piece.start
+    codec_options = ["-c", "copy"] if piece.copy else [*ENCODERS[get_video_codec(clip) or ""], "-c:a", "copy"]
+    seek = piece.start + SEEK_EPSILON if piece.copy else piece.start
+    # measured from the seek, a copy past piece.end would repeat the keyframe the next piece starts with
+    return [
+        "-y", "-ss", f"{seek}", "-i", clip.abs_filename, "-t", f"{piece.end - seek}",
+        "-map", "0:v:0", "-map", "0:a:0?", *codec_options, "-f", "mpegts", piece_name,
+    ]
+
+
+def get_tag_options(clip: Clip, out_name: str) -> List[ffmpeg_runner.Argument]:
+    """the sample entry tag for parameter sets in band, for mp4/mov outputs"""
+    tag = IN_BAND_TAGS.get(get_video_codec(clip) or "")
+    if tag is None or os.path.splitext(out_name)[1].lower() not in (".mp4", ".mov"):
+        return []
+    return ["-tag:v", tag]
+
+
+async def smart_cut_clip(clip: Clip, out_name: str) -> str:
+    """extracts clip to out_name with exact cuts, the pieces are written next to out_name"""
+    pieces = plan_pieces(clip)
+    if pieces is None:
+        print(f"""no keyframe index or no encoder for the codec of "{clip.abs_filename}", stream copying it.""", file=sys.stderr)
+        await ffmpeg_runner.runner.run(["-y", "-i", clip.abs_filename, *clip.get_cut_options(), "-codec", "copy", out_name], duration=clip.get_clip_length())
+        return out_name
+
+    base_name = os.path.splitext(out_name)[0]
+    piece_names = [get_partial_name(os.path.dirname(out_name), f"{base_name}.ts", f"piece{index}") for index in range(len(pieces))]
+    try:
+        # the edges are encoded while the middle is copied
+        await asyncio.gather(*(
+            ffmpeg_runner.runner.run(get_piece_arguments(clip, piece, piece_name), duration=piece.end - piece.start)
+            for piece, piece_name in zip(pieces, piece_names)
+        ))
+
+        combine_list = "".join(concat_file_line(piece_name) for piece_name in piece_names)
+        await ffmpeg_runner.runner.run(
+            ["-y", *get_concat_arguments(combine_list, build_ffmetadata([]), clip.abs_filename), "-c", "copy", *get_tag_options(clip, out_name), out_name],
+            duration=clip.get_clip_length(),
+        )
+    finally:
+        for piece_name in piece_names:
+            remove_if_exists(piece_name)
+    return out_name
+
+
+def create_smart_cut_extractions(clip_outputs: List[Tuple[Clip, str]]) -> List[str]:
+    """smart cuts every (clip, out_name) pair from one event loop, returns the out_names in the given order"""
+    out_names = [out_name.replace(os.sep * 2, os.sep) for _, out_name in clip_outputs]
+    ffmpeg_runner.run_ffmpeg_all([partial(smart_cut_clip, clip, out_name) for (clip, _), out_name in zip(clip_outputs, out_names)])
+    return out_names
@@ -0,0 +1,93 @@
+"""
+Staging of outputs: ffmpeg writes every output and intermediary file into a scratch folder (or a hidden
+file next to the final output), the finished output is then published with a single rename,
+so nothing half-written ever shows up in the output folder.
+If the scratch folder is on another filesystem the output is copied next to its final name first.
+"""
+
+import errno
+import os
+import shutil
+import tempfile
+from typing import Optional
+
+# estimates from the keyframe index are not exact, keep some room on top of them
+FREE_SPACE_MARGIN = 64 * 2**20
+
+COPY_BUFFER_SIZE = 4 * 2**20
+
+
+def get_partial_name(folder: str, out_name: str, tag: str) -> str:
+    """a hidden name in folder for a not yet published out_name, with the same extension so ffmpeg picks the same container"""
+    base_name, extension = os.path.splitext(os.path.basename(out_name))
+    return os.path.join(folder, f".{base_name.lstrip('.')}.{tag}.partial{extension}")
+
+
+def check_free_space(folder: str, needed_bytes: Optional[int], description: str) -> None:
+    """raises OSError(ENOSPC) if folder has less than needed_bytes plus FREE_SPACE_MARGIN free, unknown sizes are not checked"""
+    if needed_bytes is None:
+        return
+    os.makedirs(folder, exist_ok=True)
+    free = shutil.disk_usage(folder).free
+    if free < needed_bytes + FREE_SPACE_MARGIN:
+        raise OSError(errno.ENOSPC, f"""{description} needs about {needed_bytes / 2**20:.0f} MiB and {FREE_SPACE_MARGIN / 2**20:.0f} MiB to spare, "{folder}" has {free / 2**20:.0f} MiB free""")
+
+
+def publish(staged_name: str, out_name: str) -> None:
+    """moves the finished staged_name to out_name, which appears at once and complete"""
+    out_folder = os.path.dirname(out_name)
+    os.makedirs(out_folder, exist_ok=True)
+    try:
+        os.replace(staged_name, out_name)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    # another filesystem: copy next to out_name, then rename
+    check_free_space(out_folder, os.path.getsize(staged_name), f"""publishing "{out_name}\"""")
+    temp_name = get_partial_name(out_folder, out_name, f"{os.getpid()}-copy")
+    try:
+        with open(staged_name, "rb") as source, open(temp_name, "wb") as target:
+            shutil.copyfileobj(source, target, COPY_BUFFER_SIZE)
+            target.flush()
+            os.fsync(target.fileno())
+        os.replace(temp_name, out_name)
+    except BaseException:
+        try:
+            os.remove(temp_name)
+        except FileNotFoundError:
+            pass
+        raise
+    os.remove(staged_name)
+
+
+def remove_if_exists(filename: str) -> None:
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
+
+
+class ScratchFolder:
+    """
+    a private folder below scratch_path for the staged files of one run, removed with everything left in it on exit.
+    Without a scratch_path 'path' is None and files are staged in the output folders
+    """
+    scratch_path: Optional[str]
+    path: Optional[str]
+
+    def __init__(self: 'ScratchFolder', scratch_path: Optional[str]) -> None:
+        self.scratch_path = scratch_path
+        self.path = None
+
+    def __enter__(self: 'ScratchFolder') -> Optional[str]:
+        if self.scratch_path is not None:
+            os.makedirs(self.scratch_path, exist_ok=True)
+            self.path = tempfile.mkdtemp(prefix="gopro_dashcam_", dir=self.scratch_path)
+        return self.path
+
+    def __exit__(self: 'ScratchFolder', *args: object) -> None:
+        if self.path is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.path = None
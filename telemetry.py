@@ -0,0 +1,247 @@
+"""
+Streaming decoder of the GoPro telemetry track and detection of events nobody marked with a HiLight,
+like hard braking and impacts, which are added to the HiLights of a file as virtual HiLights.
+
+The telemetry track ('gpmd' samples, about one second each) is located with the sample tables,
+its samples are sliced one at a time out of a memory map of the file, never reading a whole chapter.
+ACCL, GYRO and GPS5 are decoded from the GPMF KLV entries of each sample into NumPy arrays,
+the samples of a stream spread evenly over the duration of their telemetry sample.
+The detection is vectorized over the decoded arrays:
+
+    ACCL  smoothed |a| - g above ACCEL_THRESHOLD (impacts, hard braking or swerving)
+          jerk of the smoothed acceleration above JERK_THRESHOLD (sudden hits)
+    GYRO  rotation rate above GYRO_THRESHOLD (spins)
+    GPS5  deceleration of the 2D speed above BRAKE_THRESHOLD, only with a GPS fix (hard braking)
+
+Detections closer than MIN_EVENT_GAP are one event, at the time of its strongest detection.
+NumPy is only needed for the events, everything else works without it.
+"""
+
+import mmap
+import struct
+import sys
+from typing import Dict, Iterator, List, Optional, Tuple, cast
+
+import probe_cache
+from GP_Highlight_Extractor import iter_klv
+from instrumentation import instrumentation
+from sample_index import TrackSamples, read_all_track_samples
+
+try:
+    import numpy as np
+    from numpy.typing import NDArray
+except ImportError:
+    np = None  # type: ignore
+
+STREAM_KEYS = (b"ACCL", b"GYRO", b"GPS5")
+
+# GPMF value types to NumPy dtypes, telemetry is big endian
+VALUE_TYPES = {
+    "b": ">i1", "B": ">u1", "s": ">i2", "S": ">u2", "l": ">i4", "L": ">u4", "f": ">f4", "d": ">f8", "j": ">i8", "J": ">u8",
+}
+
+GRAVITY = 9.81  # m/s²
+ACCEL_THRESHOLD = 0.8 * GRAVITY  # m/s² on top of gravity
+JERK_THRESHOLD = 20 * GRAVITY  # m/s³
+GYRO_THRESHOLD = 3.0  # rad/s
+BRAKE_THRESHOLD = 0.45 * GRAVITY  # m/s² of deceleration
+SMOOTHING_TIME = 0.1  # seconds, accelerometer noise and engine vibration
+GPS_SMOOTHING_TIME = 1.0  # seconds, GPS speeds are noisy from sample to sample
+MIN_GPS_FIX = 2  # GPSF of a 2D fix
+MIN_EVENT_GAP = 5.0  # seconds
+
+# column of the 2D speed in GPS5
+GPS5_SPEED_2D = 3
+
+# set in this process (and scan workers) by 'configure'
+detect_events_enabled = False
+
+
+def numpy_available() -> bool:
+    return np is not None
+
+
+def configure(detect_events: bool) -> None:
+    """whether 'VideoFileData.get_hilights' adds the events detected in the telemetry"""
+    global detect_events_enabled
+    detect_events_enabled = detect_events
+
+
+class TelemetryStream:
+    """the samples of one telemetry stream of a file"""
+    times: 'NDArray[np.float64]'  # seconds in file time, one per sample
+    values: 'NDArray[np.float64]'  # (samples, axes), scaled to SI units
+
+    def __init__(self: 'TelemetryStream', times: 'NDArray[np.float64]', values: 'NDArray[np.float64]') -> None:
+        self.times = times
+        self.values = values
+
+    def __repr__(self: 'TelemetryStream') -> str:
+        return f"TELEMETRY_STREAM=[samples={len(self.times)}, axes={self.values.shape[1] if self.values.ndim > 1 else 1}]"
+
+
+def find_telemetry_track(tracks: List[TrackSamples]) -> Optional[TrackSamples]:
+    for track in tracks:
+        if track.sample_format == b"gpmd" and len(track.times) > 0:
+            return track
+    return None
+
+
+def iter_telemetry_samples(mapped: mmap.mmap, track: TrackSamples) -> Iterator[Tuple[float, float, bytes]]:
+    """(start, duration, payload) of every telemetry sample of the memory mapped file, one by one"""
+    sample_count = len(track.times)
+    for sample in range(sample_count):
+        start = track.times[sample]
+        if sample + 1 < sample_count:
+            duration = track.times[sample + 1] - start
+        else:
+            duration = start - track.times[sample - 1] if sample > 0 else 1.0
+        offset = track.offsets[sample]
+        yield start, duration, mapped[offset:offset + track.sizes[sample]]
+
+
+def decode_payload(data: bytes, keys: Tuple[bytes, ...] = STREAM_KEYS) -> Dict[bytes, 'NDArray[np.float64]']:
+    """
+    the scaled values of the streams in keys of one telemetry sample, (samples, axes) each.
+    A SCAL entry applies to the data of its STRM, GPS5 without a fix (GPSF) is NaN
+    """
+    decoded: Dict[bytes, NDArray[np.float64]] = {}
+    scale: Optional[NDArray[np.float64]] = None
+    gps_fix: Optional[int] = None
+    for key, value_type, start, end in iter_klv(data):
+        if key == b"STRM":
+            scale, gps_fix = None, None
+            continue
+        dtype = VALUE_TYPES.get(chr(value_type))
+        if dtype is None or end <= start:
+            continue
+        if key == b"SCAL":
+            scale = np.frombuffer(data, dtype=dtype, count=(end - start) // np.dtype(dtype).itemsize, offset=start).astype(np.float64)
+        elif key == b"GPSF":
+            gps_fix = int(np.frombuffer(data, dtype=dtype, count=1, offset=start)[0])
+        elif key in keys:
+            struct_size, repeat = struct.unpack_from("> B H", data, start - 3)
+            axes = struct_size // np.dtype(dtype).itemsize
+            if axes == 0 or repeat == 0:
+                continue
+            values = np.frombuffer(data, dtype=dtype, count=repeat * axes, offset=start).reshape(repeat, axes).astype(np.float64)
+            if scale is not None and scale.size in (1, axes):
+                values /= np.where(scale == 0, 1.0, scale)
+            if key == b"GPS5" and gps_fix is not None and gps_fix < MIN_GPS_FIX:
+                values[:] = np.nan
+            decoded[key] = values
+    return decoded
+
+
+def read_telemetry(filename: str, keys: Tuple[bytes, ...] = STREAM_KEYS) -> Dict[str, TelemetryStream]:
+    """the streams in keys of filename by name, empty if it has no telemetry track"""
+    track = find_telemetry_track(read_all_track_samples(filename))
+    if track is None:
+        return {}
+
+    times: Dict[bytes, List[NDArray[np.float64]]] = {key: [] for key in keys}
+    values: Dict[bytes, List[NDArray[np.float64]]] = {key: [] for key in keys}
+    read_bytes = 0
+    # only the pages of the telemetry samples are ever read, without a read call per sample
+    with open(filename, "rb") as file_stream, mmap.mmap(file_stream.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        for start, duration, data in iter_telemetry_samples(mapped, track):
+            read_bytes += len(data)
+            for key, decoded in decode_payload(data, keys).items():
+                times[key].append(start + np.arange(len(decoded), dtype=np.float64) * (duration / len(decoded)))
+                values[key].append(decoded)
+    instrumentation.record_read(filename, read_bytes)
+
+    streams = {}
+    for key in keys:
+        if len(values[key]) == 0:
+            continue
+        # the number of axes never changes within a stream, unless the file is corrupt
+        axes = values[key][0].shape[1]
+        chunks = [(chunk_times, chunk) for chunk_times, chunk in zip(times[key], values[key]) if chunk.shape[1] == axes]
+        streams[key.decode("ascii")] = TelemetryStream(np.concatenate([chunk_times for chunk_times, _ in chunks]), np.concatenate([chunk for _, chunk in chunks]))
+    return streams
+
+
+def _moving_average(values: 'NDArray[np.float64]', window: int) -> 'NDArray[np.float64]':
+    """centered moving average along the first axis, shorter at both ends"""
+    if window <= 1 or len(values) == 0:
+        return values
+    cumulative = np.cumsum(np.concatenate([np.zeros((1,) + values.shape[1:]), values]), axis=0)
+    indices = np.arange(len(values))
+    low = np.clip(indices - window // 2, 0, len(values))
+    high = np.clip(indices + (window - window // 2), 0, len(values))
+    counts = (high - low).reshape((-1,) + (1,) * (values.ndim - 1))
+    return cast('NDArray[np.float64]', (cumulative[high] - cumulative[low]) / counts)
+
+
+def _window(times: 'NDArray[np.float64]', seconds: float) -> int:
+    """samples in seconds at the average rate of times"""
+    if len(times) < 2 or times[-1] <= times[0]:
+        return 1
+    return max(int(round(seconds * (len(times) - 1) / (times[-1] - times[0]))), 1)
+
+
+def _rate(values: 'NDArray[np.float64]', times: 'NDArray[np.float64]') -> 'NDArray[np.float64]':
+    """derivative of values by time, between each sample and the next"""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.diff(values, axis=0) / np.diff(times).reshape((-1,) + (1,) * (values.ndim - 1))
+
+
+def find_detections(streams: Dict[str, TelemetryStream]) -> Tuple['NDArray[np.float64]', 'NDArray[np.float64]']:
+    """(times, scores) of every sample above a threshold, scores relative to the threshold"""
+    times: List[NDArray[np.float64]] = []
+    scores: List[NDArray[np.float64]] = []
+
+    def add(sample_times: 'NDArray[np.float64]', score: 'NDArray[np.float64]') -> None:
+        above = score > 1.0  # NaN never is
+        times.append(sample_times[above])
+        scores.append(score[above])
+
+    accl = streams.get("ACCL")
+    if accl is not None and len(accl.times) > 1:
+        smoothed = _moving_average(accl.values, _window(accl.times, SMOOTHING_TIME))
+        add(accl.times, np.abs(np.linalg.norm(smoothed, axis=1) - GRAVITY) / ACCEL_THRESHOLD)
+        add(accl.times[1:], np.linalg.norm(_rate(smoothed, accl.times), axis=1) / JERK_THRESHOLD)
+
+    gyro = streams.get("GYRO")
+    if gyro is not None and len(gyro.times) > 1:
+        smoothed = _moving_average(gyro.values, _window(gyro.times, SMOOTHING_TIME))
+        add(gyro.times, np.linalg.norm(smoothed, axis=1) / GYRO_THRESHOLD)
+
+    gps = streams.get("GPS5")
+    if gps is not None and len(gps.times) > 1 and gps.values.shape[1] > GPS5_SPEED_2D:
+        speed = _moving_average(gps.values[:, GPS5_SPEED_2D], _window(gps.times, GPS_SMOOTHING_TIME))
+        add(gps.times[1:], -_rate(speed, gps.times) / BRAKE_THRESHOLD)
+
+    if len(times) == 0:
+        return np.zeros(0), np.zeros(0)
+    return np.concatenate(times), np.concatenate(scores)
+
+
+def merge_detections(times: 'NDArray[np.float64]', scores: 'NDArray[np.float64]', min_gap: float = MIN_EVENT_GAP) -> List[float]:
+    """one event per group of detections less than min_gap apart, at the time of the group's highest score"""
+    if len(times) == 0:
+        return []
+    order = np.argsort(times, kind="stable")
+    times, scores = times[order], scores[order]
+    groups = np.concatenate([[0], np.cumsum(np.diff(times) >= min_gap)])
+    # highest score first within each group, np.unique returns the first index of every group
+    by_score = np.lexsort((-scores, groups))
+    _, first = np.unique(groups[by_score], return_index=True)
+    return [float(time) for time in times[by_score[first]]]
+
+
+def detect_events(filename: str) -> List[float]:
+    """times of the events in the telemetry of filename in seconds, empty without telemetry"""
+    if np is None:
+        raise RuntimeError("detecting events in the telemetry needs NumPy")
+    return merge_detections(*find_detections(read_telemetry(filename)))
+
+
+def get_events(filename: str) -> List[float]:
+    """the cached events of filename, none if its telemetry cannot be read"""
+    try:
+        return probe_cache.cached(filename, "events", lambda: detect_events(filename))
+    except (OSError, ValueError, KeyError, IndexError, struct.error) as e:
+        print(f"""could not read the telemetry of "{filename}", no events for it: {e}""", file=sys.stderr)
+        return []
@@ -0,0 +1,168 @@
+"""
+Export of the telemetry and HiLights of every recording into a compressed columnar file (.npz),
+so analyses never have to decode the GPMF of the videos again.
+
+One file per recording, '<date>_<first chapter>_telemetry.npz', with the columns
+
+    chapters, chapter_sizes, chapter_mtimes_ns   the chapters and the files they were exported from
+    chapter_starts, chapter_durations           seconds in recording time
+    ACCL_time, ACCL_chapter, ACCL               (samples, 3) m/s²
+    GYRO_time, GYRO_chapter, GYRO               (samples, 3) rad/s
+    GPS5_time, GPS5_chapter, GPS5               (samples, 5) latitude, longitude, altitude, 2D and 3D speed, NaN without fix
+    hilights_time, hilights_chapter             the HiLights marked on the camera
+    events_time, events_chapter                 the events detected in the telemetry, only with -events
+
+Times are seconds since the start of the recording. np.load only decompresses the columns that are accessed.
+The export is incremental: the columns of chapters whose file did not change are taken from the existing
+export, only new or changed chapters are decoded again, and an export whose chapters all match is not rewritten.
+"""
+
+import os
+import sys
+from typing import Dict, List, Optional, Tuple, Union
+
+import telemetry
+from instrumentation import instrumentation, stage
+from staging import get_partial_name, publish, remove_if_exists
+from telemetry import STREAM_KEYS, TelemetryStream, read_telemetry
+from video_file_data import VideoFileData
+
+try:
+    import numpy as np
+    from numpy.typing import NDArray
+except ImportError:
+    np = None  # type: ignore
+
+EXPORT_VERSION = 1
+EXPORT_SUFFIX = "_telemetry.npz"
+
+STREAM_NAMES = tuple(key.decode("ascii") for key in STREAM_KEYS)
+STREAM_AXES = {"ACCL": 3, "GYRO": 3, "GPS5": 5}
+
+# times and values, chapter indices and file sizes, chapter names
+Column = Union['NDArray[np.float64]', 'NDArray[np.int64]', 'NDArray[np.int32]', 'NDArray[np.str_]']
+
+
+def get_export_name(recording: List[VideoFileData], output_path: str) -> str:
+    return os.path.join(output_path, f"{os.path.splitext(recording[0].get_out_name())[0]}{EXPORT_SUFFIX}")
+
+
+def get_source(chapter: VideoFileData) -> Tuple[int, int]:
+    """(size, mtime_ns) of the file of chapter"""
+    stat = os.stat(chapter.abs_filename)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def read_previous_streams(export_name: str, recording: List[VideoFileData]) -> Tuple[Dict[str, Dict[str, TelemetryStream]], List[str], bool]:
+    """
+    the streams of every chapter of recording unchanged since the existing export_name by chapter file name,
+    the chapters of the export and whether it had the events column
+    """
+    if not os.path.exists(export_name):
+        return {}, [], False
+    try:
+        with np.load(export_name) as previous:
+            if int(previous["version"]) != EXPORT_VERSION:
+                return {}, [], False
+            chapters = [str(chapter) for chapter in previous["chapters"]]
+            sources = dict(zip(chapters, zip(previous["chapter_sizes"].tolist(), previous["chapter_mtimes_ns"].tolist())))
+            starts = previous["chapter_starts"]
+            reused = {}
+            for chapter in recording:
+                if sources.get(chapter.base_filename) != get_source(chapter):
+                    continue
+                index = chapters.index(chapter.base_filename)
+                streams = {}
+                for name in STREAM_NAMES:
+                    if f"{name}_time" not in previous:
+                        continue
+                    rows = previous[f"{name}_chapter"] == index
+                    # back to file time, the chapter may start elsewhere in the recording now
+                    streams[name] = TelemetryStream(previous[f"{name}_time"][rows] - starts[index], previous[name][rows])
+                reused[chapter.base_filename] = streams
+            return reused, chapters, "events_time" in previous
+    except (OSError, ValueError, KeyError) as e:
+        print(f"""could not read the export "{export_name}", exporting it again: {e}""", file=sys.stderr)
+        return {}, [], False
+
+
+def build_columns(recording: List[VideoFileData], streams: List[Dict[str, TelemetryStream]]) -> Dict[str, Column]:
+    """the columns of the export of recording, streams of each chapter in file time"""
+    durations = np.array([chapter.get_video_length() for chapter in recording], dtype=np.float64)
+    starts = np.concatenate([[0.0], np.cumsum(durations)[:-1]])
+    sources = [get_source(chapter) for chapter in recording]
+    columns: Dict[str, Column] = {
+        "version": np.array(EXPORT_VERSION),
+        "chapters": np.array([chapter.base_filename for chapter in recording]),
+        "chapter_sizes": np.array([size for size, _ in sources], dtype=np.int64),
+        "chapter_mtimes_ns": np.array([mtime_ns for _, mtime_ns in sources], dtype=np.int64),
+        "chapter_starts": starts,
+        "chapter_durations": durations,
+    }
+
+    def add_times(name: str, chapter_times: List['NDArray[np.float64]']) -> None:
+        columns[f"{name}_time"] = np.concatenate([times + start for times, start in zip(chapter_times, starts)])
+        columns[f"{name}_chapter"] = np.concatenate([np.full(len(times), index, dtype=np.int32) for index, times in enumerate(chapter_times)])
+
+    for name in STREAM_NAMES:
+        chapter_streams = [chapter_stream.get(name) for chapter_stream in streams]
+        add_times(name, [stream.times if stream is not None else np.zeros(0) for stream in chapter_streams])
+        columns[name] = np.concatenate([
+            stream.values if stream is not None and stream.values.shape[1:] == (STREAM_AXES[name],) else np.zeros((0, STREAM_AXES[name]))
+            for stream in chapter_streams
+        ])
+
+    for chapter in recording:
+        # fills in the HiLights, and with -events the events, unless the scan did
+        chapter.get_hilights()
+    add_times("hilights", [np.array(chapter.hilights or [], dtype=np.float64) for chapter in recording])
+    if telemetry.detect_events_enabled:
+        add_times("events", [np.array(chapter.events or [], dtype=np.float64) for chapter in recording])
+    return columns
+
+
+def export_recording(recording: List[VideoFileData], output_path: str) -> Optional[str]:
+    """
+    writes the export of recording into output_path, decoding only the chapters changed since the last export.
+    Returns its name, None if the existing export was up to date
+    """
+    export_name = get_export_name(recording, output_path)
+    reused, previous_chapters, had_events = read_previous_streams(export_name, recording)
+    chapter_names = [chapter.base_filename for chapter in recording]
+    if len(reused) == len(recording) and previous_chapters == chapter_names and had_events == telemetry.detect_events_enabled:
+        return None
+
+    streams = []
+    for chapter in recording:
+        chapter_streams = reused.get(chapter.base_filename)
+        streams.append(chapter_streams if chapter_streams is not None else read_telemetry(chapter.abs_filename))
+    columns = build_columns(recording, streams)
+
+    staged_name = get_partial_name(output_path, export_name, f"{os.getpid()}")
+    try:
+        with open(staged_name, "wb") as export_file:
+            # the stubs type **kwds as allow_pickle's bool too, every column is an array
+            np.savez_compressed(export_file, **columns)  # type: ignore[arg-type]
+        publish(staged_name, export_name)
+    finally:
+        remove_if_exists(staged_name)
+    instrumentation.record_written(export_name, os.path.getsize(export_name))
+    return export_name
+
+
+def export_recordings(recordings: List[List[VideoFileData]], output_path: str) -> List[str]:
+    """exports every recording, returns the names of the exports written"""
+    if np is None:
+        raise RuntimeError("exporting the telemetry needs NumPy")
+    os.makedirs(output_path, exist_ok=True)
+    written = []
+    with stage("export"):
+        for recording in recordings:
+            try:
+                export_name = export_recording(recording, output_path)
+            except (OSError, ValueError, KeyError, IndexError) as e:
+                print(f"""could not export the telemetry of "{recording[0].abs_filename}": {e}""", file=sys.stderr)
+                continue
+            if export_name is not None:
+                written.append(export_name)
+    return written
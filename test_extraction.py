@@ -0,0 +1,44 @@
+import os
+import tempfile
+import unittest
+from typing import List
+
+from clip import Clip
+from extraction import Extraction
+from fixtures import write_recordings
+from staging import get_partial_name
+
+
+class IntermediateClipNamesTest(unittest.TestCase):
+    def test_identically_named_chapters(self: 'IntermediateClipNamesTest') -> None:
+        """two cards with the same chapter names, planned into one output folder, must not share intermediary files"""
+        with tempfile.TemporaryDirectory() as folder:
+            output_path = os.path.join(folder, "out")
+            extractions = []
+            for card in ("card_a", "card_b"):
+                first, second = write_recordings(os.path.join(folder, card), 2, seconds=10.0, other_files=False)
+                # the extraction numbers restart for every recording, both are extraction 0 spanning the two chapters
+                extraction = Extraction(0, output_path)
+                extraction.add_clip(Clip(first, 5.0, 10.0, [8.0]))
+                extraction.add_clip(Clip(second, 0.0, 5.0, [2.0]))
+                extractions.append(extraction)
+
+            intermediary_names: List[str] = []
+            for index, extraction in enumerate(extractions):
+                out_name = extraction.get_out_name()
+                assert out_name is not None
+                # staged like the executor does
+                staged_name = get_partial_name(output_path, out_name, f"{os.getpid()}-{index}")
+                clip_outputs = extraction.get_clip_outputs(staged_name)
+                self.assertEqual([clip for clip, _ in clip_outputs], extraction.clips)
+                intermediary_names.extend(clip_out_name for _, clip_out_name in clip_outputs)
+
+            self.assertEqual(len(intermediary_names), 4)
+            self.assertEqual(len(set(intermediary_names)), 4)
+            for intermediary_name in intermediary_names:
+                self.assertTrue(os.path.basename(intermediary_name).startswith("."))
+                self.assertTrue(intermediary_name.endswith(".partial.mkv"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+"""
+Plans the extractions of a recording on one continuous timeline:
+every chapter starts where the previous one ends (cumulative durations),
+the windows around all HiLights are merged with a single sweep over their sorted starts
+and only split back into per-chapter clips at the end.
+"""
+
+import sys
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from typing import List, Optional
+
+from clip import Clip
+from extraction import Extraction
+from transcode import TranscodeSettings
+from video_file_data import VideoFileData
+
+
+class Window:
+    """
+    a span of the recording timeline and the HiLights in it, in recording time
+    """
+    start: float
+    end: float
+    hilights: List[float]
+
+    def __init__(self: 'Window', start: float, end: float, hilights: List[float]) -> None:
+        self.start = start
+        self.end = end
+        self.hilights = hilights
+
+    def __repr__(self: 'Window') -> str:
+        return f"WINDOW=[{self.start=: 19.14f}, {self.end=: 19.14f}, {self.hilights=}]"
+
+
+def merge_windows(windows: List[Window]) -> List[Window]:
+    """merges overlapping or touching windows, sorted by start, in O(n log n)"""
+    merged: List[Window] = []
+    for window in sorted(windows, key=lambda w: w.start):
+        if len(merged) > 0 and window.start <= merged[-1].end:
+            merged[-1].end = max(merged[-1].end, window.end)
+            merged[-1].hilights.extend(window.hilights)
+        else:
+            merged.append(Window(window.start, window.end, list(window.hilights)))
+
+    for window in merged:
+        window.hilights.sort()
+    return merged
+
+
+class RecordingTimeline:
+    """
+    the chapters of one recording laid out back to back
+    """
+    chapters: List[VideoFileData]
+    offsets: List[float]  # recording time each chapter starts at, the last entry is the end of the recording
+
+    def __init__(self: 'RecordingTimeline', chapters: List[VideoFileData]) -> None:
+        self.chapters = chapters
+
+        durations = []
+        for chapter in chapters:
+            try:
+                durations.append(chapter.get_video_length())
+            except Exception as e:
+                print(f"""no duration for "{chapter.abs_filename}", leaving it out of the recording: {e}""", file=sys.stderr)
+                durations.append(0.0)
+        self.offsets = [0.0] + list(accumulate(durations))
+
+    def get_duration(self: 'RecordingTimeline') -> float:
+        return self.offsets[-1]
+
+    def get_hilights(self: 'RecordingTimeline') -> List[float]:
+        """HiLights of all chapters in recording time"""
+        hilights: List[float] = []
+        for index, chapter in enumerate(self.chapters):
+            if self.offsets[index + 1] <= self.offsets[index]:
+                continue
+            try:
+                hilights.extend(self.offsets[index] + hilight for hilight in chapter.get_hilights())
+            except Exception as e:
+                print(e, file=sys.stderr)
+        return hilights
+
+    def get_windows(self: 'RecordingTimeline', time_before: float, time_after: float) -> List[Window]:
+        """merged windows of time_before/time_after around every HiLight, clamped to the recording"""
+        return merge_windows([
+            Window(max(hilight - time_before, 0.0), min(hilight + time_after, self.get_duration()), [hilight])
+            for hilight in self.get_hilights()
+        ])
+
+    def split(self: 'RecordingTimeline', window: Window) -> List[Clip]:
+        """one clip per chapter the window covers, in recording order"""
+        clips = []
+        last = len(self.chapters) - 1
+        index = max(bisect_right(self.offsets, window.start) - 1, 0)
+        while index <= last and self.offsets[index] < window.end:
+            chapter_start, chapter_end = self.offsets[index], self.offsets[index + 1]
+            start, end = max(window.start, chapter_start), min(window.end, chapter_end)
+            if end > start:
+                # a HiLight on a chapter boundary belongs to the later chapter, except at the end of the recording
+                first_hilight = bisect_left(window.hilights, chapter_start)
+                end_hilight = bisect_right(window.hilights, chapter_end) if index == last else bisect_left(window.hilights, chapter_end)
+                chapter = self.chapters[index]
+                clips.append(
+                    Clip(
+                        chapter.abs_filename,
+                        start=start - chapter_start,
+                        end=end - chapter_start,
+                        hilights=[hilight - chapter_start for hilight in window.hilights[first_hilight:end_hilight]],
+                        metadata=chapter.metadata,
+                        proxy_filename=chapter.proxy_filename,
+                    )
+                )
+            index += 1
+        return clips
+
+
+def plan_recording_extractions(recording: List[VideoFileData], output_path: str, time_before: float, time_after: float, direct_concat: bool = False, keyframe_snap: bool = True, smart_cut: bool = False, transcode: Optional[TranscodeSettings] = None) -> List[Extraction]:
+    """
+    one extraction per merged window of the recording, its chapters have to be sorted.
+    Smart cut and transcoded extractions cut exactly where asked, they are never snapped to keyframes
+    """
+    timeline = RecordingTimeline(recording)
+
+    extractions: List[Extraction] = []
+    for extraction_number, window in enumerate(timeline.get_windows(time_before, time_after)):
+        extraction = Extraction(extraction_number=extraction_number, output_path=output_path, direct_concat=direct_concat, smart_cut=smart_cut, transcode=transcode)
+        for clip in timeline.split(window):
+            extraction.add_clip(clip)
+        if keyframe_snap and not smart_cut and transcode is None:
+            extraction.snap_to_keyframes()
+        extractions.append(extraction)
+
+    return extractions
@@ -0,0 +1,187 @@
+"""
+Transcoding of an extraction into a small H.264/AAC mp4, e.g. for sharing 4K HEVC recordings.
+
+The timeline of the extraction is split into chunks at keyframes of the sources, the chunks are encoded
+by several ffmpegs at once, each with a share of the cpu cores, while one more ffmpeg encodes the audio
+of the whole timeline (AAC encoded per chunk would click at every chunk border).
+All chunks use the same encoder settings, so they are concatenated by a stream copy,
+together with the audio and the chapter markers of the HiLights.
+
+    source |K    K    K    K    K    K    K|
+    chunks   [ ffmpeg 1 ][ ffmpeg 2 ][ 3 ]     -> concat (copy) + audio + chapters -> mp4
+"""
+
+import os
+from functools import partial
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import ffmpeg_runner
+from clip import Clip
+from ffconcat import build_concat_list, build_ffmetadata, concat_file_line
+from staging import get_partial_name, remove_if_exists
+
+# chunks are at least this long unless their clip is shorter, the encoder's startup is not worth it for less
+CHUNK_LENGTH = 10.0
+
+# chunks encoded at the same time
+transcode_jobs = os.cpu_count() or 1
+
+AUDIO_BITRATE = 160_000
+
+OUT_EXTENSION = ".mp4"
+
+BITRATE_SUFFIXES = {"k": 10**3, "m": 10**6, "g": 10**9}
+
+
+def parse_bitrate(bitrate: str) -> int:
+    """bits per second of e.g. '6M', '800k' or '2500000'"""
+    bitrate = bitrate.strip().lower()
+    factor = BITRATE_SUFFIXES.get(bitrate[-1:], 1)
+    number = bitrate[:-1] if factor != 1 else bitrate
+    try:
+        value = float(number)
+    except ValueError:
+        raise ValueError(f"""invalid bitrate "{bitrate}", expected e.g. 6M or 800k""") from None
+    if value <= 0:
+        raise ValueError(f"""invalid bitrate "{bitrate}", it has to be positive""")
+    return int(value * factor)
+
+
+class TranscodeSettings:
+    preset: str  # x264 preset, slower ones give smaller files at the same quality
+    video_bitrate: int  # bits per second
+    max_height: Optional[int]  # taller videos are scaled down to this, None keeps the size
+
+    def __init__(self: 'TranscodeSettings', preset: str = "medium", video_bitrate: int = 6_000_000, max_height: Optional[int] = 1080) -> None:
+        self.preset = preset
+        self.video_bitrate = video_bitrate
+        self.max_height = max_height
+
+    def estimate_size(self: 'TranscodeSettings', length: float) -> int:
+        """bytes of length seconds of output"""
+        return int((self.video_bitrate + AUDIO_BITRATE) * length / 8)
+
+    def to_json(self: 'TranscodeSettings') -> Dict[str, object]:
+        return {"preset": self.preset, "video_bitrate": self.video_bitrate, "max_height": self.max_height}
+
+    @staticmethod
+    def from_json(data: Dict[str, object]) -> 'TranscodeSettings':
+        preset, video_bitrate, max_height = data["preset"], data["video_bitrate"], data.get("max_height")
+        assert isinstance(preset, str) and isinstance(video_bitrate, int) and (max_height is None or isinstance(max_height, int))
+        return TranscodeSettings(preset=preset, video_bitrate=video_bitrate, max_height=max_height)
+
+    def __repr__(self: 'TranscodeSettings') -> str:
+        return f"TRANSCODE=[{self.preset=}, {self.video_bitrate=}, {self.max_height=}]"
+
+
+class Chunk:
+    filename: str
+    start: float
+    end: float
+
+    def __init__(self: 'Chunk', filename: str, start: float, end: float) -> None:
+        self.filename = filename
+        self.start = start
+        self.end = end
+
+    def __repr__(self: 'Chunk') -> str:
+        return f"CHUNK=[{self.filename=}, {self.start=}, {self.end=}]"
+
+
+def configure(jobs: int) -> None:
+    """sets the number of chunks encoded at the same time"""
+    global transcode_jobs
+    transcode_jobs = max(jobs, 1)
+
+
+def plan_chunks(clips: List[Clip], chunk_length: float = CHUNK_LENGTH) -> List[Chunk]:
+    """
+    the clips split at the first keyframe after every chunk_length seconds,
+    a chunk starting on a keyframe decodes nothing it drops. Clips without keyframe index are a single chunk
+    """
+    chunks: List[Chunk] = []
+    for clip in clips:
+        keyframe_index = clip.metadata.get_keyframe_index()
+        keyframe_times = keyframe_index.times if keyframe_index is not None else []
+        start = clip.start
+        for keyframe_time in keyframe_times:
+            if keyframe_time >= clip.end - chunk_length:
+                break
+            if keyframe_time - start >= chunk_length:
+                chunks.append(Chunk(clip.abs_filename, start, keyframe_time))
+                start = keyframe_time
+        chunks.append(Chunk(clip.abs_filename, start, clip.end))
+    return chunks
+
+
+def has_audio(clips: List[Clip]) -> bool:
+    """clips of unknown streams are expected to have audio, like all GoPro recordings"""
+    for clip in clips:
+        if len(clip.metadata.streams) > 0 and not any(stream.get("codec_type") == "audio" for stream in clip.metadata.streams):
+            return False
+    return True
+
+
+def get_chunk_arguments(chunk: Chunk, settings: TranscodeSettings, chunk_name: str, threads: int) -> List[ffmpeg_runner.Argument]:
+    # input seeking: decoding starts at the keyframe at or before chunk.start, chunks planned on keyframes drop nothing
+    scale = ["-vf", f"scale=-2:'min({settings.max_height},ih)'"] if settings.max_height is not None else []
+    return [
+        "-y", "-ss", f"{chunk.start}", "-i", chunk.filename, "-t", f"{chunk.end - chunk.start}",
+        "-map", "0:v:0", "-an", *scale,
+        "-c:v", "libx264", "-preset", settings.preset, "-b:v", f"{settings.video_bitrate}", "-pix_fmt", "yuv420p",
+        "-threads", f"{threads}", "-f", "mpegts", chunk_name,
+    ]
+
+
+def get_audio_arguments(clips: List[Clip], audio_name: str) -> List[ffmpeg_runner.Argument]:
+    return [
+        "-y", "-f", "concat", "-safe", "0", "-protocol_whitelist", "file,pipe", "-i", ffmpeg_runner.PipeInput(build_concat_list(clips)),
+        "-map", "0:a:0", "-vn", "-c:a", "aac", "-b:a", f"{AUDIO_BITRATE}", "-f", "mp4", audio_name,
+    ]
+
+
+def get_mux_arguments(chunk_names: List[str], audio_name: Optional[str], chapter_times: List[float], metadata_source: str, out_name: str) -> List[ffmpeg_runner.Argument]:
+    """the chunks concatenated by a stream copy, with the audio, the chapters and the global metadata of metadata_source"""
+    combine_list = "".join(concat_file_line(chunk_name) for chunk_name in chunk_names)
+    audio_input: List[ffmpeg_runner.Argument] = ["-i", audio_name] if audio_name is not None else []
+    audio_map = ["-map", "1:a:0"] if audio_name is not None else []
+    ffmetadata_index = 2 if audio_name is not None else 1
+    return [
+        "-y", "-f", "concat", "-safe", "0", "-protocol_whitelist", "file,pipe", "-i", ffmpeg_runner.PipeInput(combine_list),
+        *audio_input,
+        "-f", "ffmetadata", "-i", ffmpeg_runner.PipeInput(build_ffmetadata(chapter_times)),
+        "-i", metadata_source,
+        "-map", "0:v:0", *audio_map, "-map_metadata", f"{ffmetadata_index + 1}", "-map_chapters", f"{ffmetadata_index}",
+        "-c", "copy", "-movflags", "+faststart", out_name,
+    ]
+
+
+async def transcode_clips(clips: List[Clip], settings: TranscodeSettings, chapter_times: List[float], out_name: str) -> str:
+    """transcodes the clips one after another into out_name, chunks and audio are written next to out_name"""
+    chunks = plan_chunks(clips)
+    folder, base_name = os.path.dirname(out_name), os.path.splitext(out_name)[0]
+    chunk_names = [get_partial_name(folder, f"{base_name}.ts", f"chunk{index}") for index in range(len(chunks))]
+    audio_name = get_partial_name(folder, f"{base_name}.m4a", "audio") if has_audio(clips) else None
+    length = sum(clip.get_clip_length() for clip in clips)
+    # a share of the cores for every encoder running at once, x264 scales badly on short chunks anyway
+    jobs = min(transcode_jobs, len(chunks))
+    threads = max((os.cpu_count() or 1) // jobs, 1)
+
+    runs: List[Callable[[], Awaitable[object]]] = [
+        partial(ffmpeg_runner.runner.run, get_chunk_arguments(chunk, settings, chunk_name, threads), duration=chunk.end - chunk.start)
+        for chunk, chunk_name in zip(chunks, chunk_names)
+    ]
+    if audio_name is not None:
+        runs.insert(0, partial(ffmpeg_runner.runner.run, get_audio_arguments(clips, audio_name), duration=length))
+    try:
+        await ffmpeg_runner.runner.run_all(runs, max_concurrency=jobs + (1 if audio_name is not None else 0))
+        await ffmpeg_runner.runner.run(get_mux_arguments(chunk_names, audio_name, chapter_times, clips[0].abs_filename, out_name), duration=length)
+    finally:
+        for filename in chunk_names + ([audio_name] if audio_name is not None else []):
+            remove_if_exists(filename)
+    return out_name
+
+
+def create_transcode(clips: List[Clip], settings: TranscodeSettings, chapter_times: List[float], out_name: str) -> str:
+    ffmpeg_runner.run_ffmpeg_all([partial(transcode_clips, clips, settings, chapter_times, out_name)])
+    return out_name
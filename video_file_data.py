@@ -1,72 +1,50 @@
 import os
-import subprocess
 from typing import List, Optional
 
 import GP_Highlight_Extractor
+import probe_cache
+import telemetry
+from video_metadata import VideoMetadata, get_metadata
 
 
 def get_date_taken(filename: str) -> str:
-    p = subprocess.Popen(
-        [
-            "ffprobe",
-            "-v", "quiet",
-            "-select_streams",
-            "v:0",
-            "-show_entries",
-            "stream_tags=creation_time",
-            "-of", "default=noprint_wrappers=1:nokey=1",
-            filename
-        ],
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE)
-    stdout, _ = p.communicate()
-    return stdout.decode("ascii")[:10]
+    return get_metadata(filename).get_date_taken()
 
 
 class VideoFileData:
     """
     data on individual file as is on disc
     """
-    video_length: Optional[float]
     abs_filename: str
     base_filename: str
-    hilights: Optional[List[float]]
+    hilights: Optional[List[float]]  # the HiLights marked on the camera
+    events: Optional[List[float]]  # virtual HiLights detected in the telemetry, see telemetry.py
+    metadata: VideoMetadata
+    proxy_filename: Optional[str]  # the low resolution proxy (.LRV) found next to the file during discovery
 
     def __init__(self: 'VideoFileData', filename: str) -> None:
-        self.video_length = None
         self.abs_filename = filename
         self.base_filename = os.path.basename(filename)
         self.hilights = None
-        pass
+        self.events = None
+        self.metadata = get_metadata(filename)
+        self.proxy_filename = None
 
     def get_hilights(self: 'VideoFileData') -> List[float]:
         if self.hilights is None:
-            self.hilights = GP_Highlight_Extractor.get_hilights(self.abs_filename)
+            self.hilights = probe_cache.cached(self.abs_filename, "hilights", lambda: GP_Highlight_Extractor.get_hilights(self.abs_filename))
 
-        return self.hilights
+        if not telemetry.detect_events_enabled:
+            return self.hilights
+        if self.events is None:
+            self.events = telemetry.get_events(self.abs_filename)
+        return sorted(self.hilights + self.events)
 
     def get_video_length(self: 'VideoFileData') -> float:
-        if self.video_length is None:
-            result = subprocess.run(
-                [
-                    "ffprobe",
-                    "-v",
-                    "error",
-                    "-show_entries",
-                    "format=duration",
-                    "-of",
-                    "default=noprint_wrappers=1:nokey=1",
-                    self.abs_filename
-                ],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT
-            )
-            self.video_length = float(result.stdout)
-        return self.video_length
+        return self.metadata.get_duration()
 
     def get_out_name(self: 'VideoFileData') -> str:
-        return f"{get_date_taken(self.base_filename)}_{self.base_filename}"
+        return f"{self.metadata.get_date_taken()}_{self.base_filename}"
 
     def __str__(self: 'VideoFileData') -> str:
         return self.abs_filename
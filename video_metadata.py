@@ -0,0 +1,172 @@
+import json
+import os
+import subprocess
+import threading
+from typing import Dict, List, Optional
+
+import mp4_metadata
+import probe_cache
+from instrumentation import run_subprocess
+from sample_index import KeyframeIndex, read_keyframe_index
+
+
+class VideoMetadata:
+    """
+    everything probed from a single file on disc.
+    All fields are read together on first access,
+    from the mp4 headers or, if that fails, by one ffprobe call.
+    """
+    abs_filename: str
+    duration: Optional[float]
+    creation_time: Optional[str]
+    streams: List[Dict[str, str]]
+    format_tags: Dict[str, str]
+    probed: bool
+    keyframe_index: Optional[KeyframeIndex]
+    keyframe_index_read: bool
+
+    def __init__(self: 'VideoMetadata', filename: str) -> None:
+        self.abs_filename = os.path.abspath(filename)
+        self.duration = None
+        self.creation_time = None
+        self.streams = []
+        self.format_tags = {}
+        self.probed = False
+        self.keyframe_index = None
+        self.keyframe_index_read = False
+        self._lock = threading.Lock()
+
+    def probe(self: 'VideoMetadata') -> 'VideoMetadata':
+        with self._lock:
+            if not self.probed:
+                # a failed probe may be transient (e.g. a file still being copied), it is tried again next time
+                self.load(probe_cache.cached(self.abs_filename, "metadata", lambda: read_metadata(self.abs_filename), should_store=is_probed))
+        return self
+
+    def load(self: 'VideoMetadata', data: Dict[str, object]) -> None:
+        duration = data.get("duration")
+        creation_time = data.get("creation_time")
+        streams = data.get("streams")
+        format_tags = data.get("format_tags")
+        self.duration = float(duration) if isinstance(duration, (int, float, str)) else None
+        self.creation_time = creation_time if isinstance(creation_time, str) else None
+        self.streams = [{str(k): str(v) for k, v in stream.items()} for stream in streams if isinstance(stream, dict)] if isinstance(streams, list) else []
+        self.format_tags = {str(k): str(v) for k, v in format_tags.items()} if isinstance(format_tags, dict) else {}
+        self.probed = True
+
+    def get_duration(self: 'VideoMetadata') -> float:
+        self.probe()
+        if self.duration is None:
+            raise ValueError(f"""could not read the duration of "{self.abs_filename}".""")
+        return self.duration
+
+    def get_date_taken(self: 'VideoMetadata') -> str:
+        self.probe()
+        return (self.creation_time or "")[:10]
+
+    def is_video(self: 'VideoMetadata') -> bool:
+        self.probe()
+        return any(stream.get("codec_type") == "video" for stream in self.streams)
+
+    def get_keyframe_index(self: 'VideoMetadata') -> Optional[KeyframeIndex]:
+        """keyframes from the sample tables, None if the file has none that can be read"""
+        with self._lock:
+            if not self.keyframe_index_read:
+                data = probe_cache.cached(self.abs_filename, "keyframes", lambda: read_keyframe_index_json(self.abs_filename))
+                self.keyframe_index = KeyframeIndex.from_json(data) if data is not None else None
+                self.keyframe_index_read = True
+        return self.keyframe_index
+
+    def __repr__(self: 'VideoMetadata') -> str:
+        return f"METADATA=[{self.abs_filename=}, {self.duration=}, {self.creation_time=}, streams={len(self.streams)}]"
+
+
+def read_metadata(filename: str) -> Dict[str, object]:
+    """
+    reads the mp4 headers in-process,
+    ffprobe is only used for files that are no (complete) mp4 files
+    """
+    try:
+        return mp4_metadata.read_mp4_info(filename).to_metadata()
+    except (ValueError, OSError):
+        return probe_metadata(filename)
+
+
+def is_probed(data: Dict[str, object]) -> bool:
+    """whether data is the metadata of a successful probe"""
+    return data.get("duration") is not None
+
+
+def read_keyframe_index_json(filename: str) -> Optional[Dict[str, object]]:
+    try:
+        return read_keyframe_index(filename).to_json()
+    except (ValueError, OSError):
+        return None
+
+
+def probe_metadata(filename: str) -> Dict[str, object]:
+    """duration, creation_time and stream info of filename in a single ffprobe call"""
+    result = run_subprocess(
+        [
+            "ffprobe",
+            "-v", "error",
+            "-show_entries",
+            "format=duration:format_tags:stream=index,codec_type,codec_name,codec_tag_string,width,height,time_base,avg_frame_rate:stream_tags=creation_time,handler_name",
+            "-of", "json",
+            filename
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    try:
+        probed = json.loads(result.stdout or b"{}")
+    except json.JSONDecodeError:
+        probed = {}
+
+    format_info = probed.get("format", {})
+    streams = []
+    creation_time: Optional[str] = None
+    for stream in probed.get("streams", []):
+        tags = stream.pop("tags", {})
+        if creation_time is None and stream.get("codec_type") == "video":
+            # same as 'ffprobe -select_streams v:0 -show_entries stream_tags=creation_time'
+            creation_time = tags.get("creation_time", "")
+        streams.append({str(k): str(v) for k, v in stream.items()})
+    if creation_time is None:
+        creation_time = format_info.get("tags", {}).get("creation_time")
+
+    return {
+        "duration": format_info.get("duration"),
+        "creation_time": creation_time,
+        "streams": streams,
+        "format_tags": format_info.get("tags", {}),
+    }
+
+
+class MetadataRegistry:
+    """
+    one 'VideoMetadata' per file, shared by everything working on that file
+    """
+    _entries: Dict[str, VideoMetadata]
+
+    def __init__(self: 'MetadataRegistry') -> None:
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self: 'MetadataRegistry', filename: str) -> VideoMetadata:
+        abs_filename = os.path.abspath(filename)
+        with self._lock:
+            if abs_filename not in self._entries:
+                self._entries[abs_filename] = VideoMetadata(abs_filename)
+            return self._entries[abs_filename]
+
+    def clear(self: 'MetadataRegistry') -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+registry = MetadataRegistry()
+
+
+def get_metadata(filename: str) -> VideoMetadata:
+    return registry.get(filename)
@@ -0,0 +1,71 @@
+import os
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from gopro_names import is_video_candidate
+from scan import get_files_in_folder
+
+FileState = Tuple[int, int]  # (size, mtime_ns)
+
+
+def get_file_state(filename: str) -> Optional[FileState]:
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+class StableFileWatcher:
+    """
+    polls input folders for new or changed files.
+    A file is reported once its size and modification time did not change for 'settle_time' seconds,
+    i.e. once it has been copied completely, a file that changes again afterwards is reported again.
+    """
+    folders: List[str]
+    filenames: List[str]
+    settle_time: float
+    pending: Dict[str, Tuple[FileState, float]]  # filename -> (state, unchanged since)
+    reported: Dict[str, FileState]
+
+    def __init__(self: 'StableFileWatcher', folders: List[str], filenames: List[str], settle_time: float) -> None:
+        self.folders = folders
+        self.filenames = filenames
+        self.settle_time = settle_time
+        self.pending = {}
+        self.reported = {}
+
+    def list_files(self: 'StableFileWatcher') -> Set[str]:
+        """video candidates by name, other files are not even stat'ed"""
+        files = set(self.filenames)
+        for folder in self.folders:
+            files.update(get_files_in_folder(folder))
+        return {filename for filename in files if is_video_candidate(filename)}
+
+    def poll(self: 'StableFileWatcher', now: Optional[float] = None) -> List[str]:
+        """files that became stable since the last poll, sorted"""
+        if now is None:
+            now = time.monotonic()
+
+        files = self.list_files()
+        for filename in set(self.pending) - files:
+            del self.pending[filename]
+        for filename in set(self.reported) - files:
+            del self.reported[filename]
+
+        stable = []
+        for filename in files:
+            state = get_file_state(filename)
+            if state is None or self.reported.get(filename) == state:
+                continue
+            previous = self.pending.get(filename)
+            if previous is None or previous[0] != state:
+                # new or still growing, wait for it to settle
+                self.pending[filename] = (state, now)
+                continue
+            if now - previous[1] >= self.settle_time:
+                del self.pending[filename]
+                self.reported[filename] = state
+                stable.append(filename)
+
+        return sorted(stable)